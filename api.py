@@ -1,11 +1,311 @@
 from nilmtk.dataset import DataSet
 from nilmtk.metergroup import MeterGroup
+from nilmtk.elecmeter import ElecMeter
+from nilmtk.timeframe import TimeFrame
+from nilmtk.utils import get_datastore
 import pandas as pd
 from nilmtk.losses import *
 import numpy as np
 import matplotlib.pyplot as plt
+import sys
+import json
 import datetime
+import logging
+import multiprocessing
 from IPython.display import clear_output
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from metrics import compute_metrics, metric_table
+from convert_mimos import resolution_location, resolution_device_model, resolution_meter_devices
+from timings import Timings, frame_bytes
+from results_store import ResultsStore, new_run_id
+
+
+logger = logging.getLogger(__name__)
+
+
+class DataSetPool():
+
+    """
+    Keeps one open, read-only DataSet per HDF5 path so that buildings and epochs reuse the same store handle.
+    """
+
+    def __init__(self):
+        self.datasets = {}
+
+    def get(self, path, start=None, end=None):
+        """
+        Returns the DataSet for the path, opening it on first use, with its window reset to [start, end)
+        """
+        if path not in self.datasets:
+            dataset = DataSet()
+            dataset.import_metadata(get_datastore(path, 'HDF', mode='r'))
+            self.datasets[path] = dataset
+        dataset = self.datasets[path]
+        dataset.set_window(start=start, end=end)
+        return dataset
+
+    def close(self):
+        for dataset in self.datasets.values():
+            dataset.store.close()
+        self.datasets = {}
+
+    def __getstate__(self):
+        # Open HDF5 handles cannot be pickled, so exported models start with an empty pool
+        return {'datasets': {}}
+
+
+def select_resolution(dataset, building, sample_period):
+    """
+    Points every meter of the building at the level of the store that is already aggregated to sample_period, and at the meter
+    device of that level, if the store has one (see convert_mimos). Returns the keyword arguments to load with: none when a
+    level is used, since its readings need no resampling (nilmtk resamples whenever sample_period is given), else the sample_period.
+    """
+    resolutions = dataset.metadata.get('resolutions', {})
+    use_level = sample_period in resolutions.get('periods', []) and 'mean' in resolutions.get('aggregations', [])
+    resampled = False
+    for meter in dataset.buildings[building].elec.meters:
+        # The pooled DataSet is reused, so the original location and device are kept to switch back
+        data_location = meter.metadata.setdefault('base_data_location', meter.metadata['data_location'])
+        device_model = meter.metadata.setdefault('base_device_model', meter.metadata.get('device_model'))
+        meter.metadata['data_location'] = resolution_location(data_location, sample_period) if use_level else data_location
+        meter.metadata['device_model'] = device_model
+        if use_level and device_model:
+            meter.metadata['device_model'] = resolution_device_model(device_model, sample_period)
+            if meter.metadata['device_model'] not in ElecMeter.meter_devices:
+                # Stores converted before the devices of the levels were recorded
+                ElecMeter.meter_devices.update(resolution_meter_devices({device_model: ElecMeter.meter_devices[device_model]}, [sample_period]))
+        elif not use_level:
+            resampled |= ElecMeter.meter_devices.get(device_model, {}).get('sample_period') != sample_period
+    if resampled:
+        # nilmtk resamples with forward filling, which gives different readings than the mean of a level
+        logger.warning("%s has no %s second level, building %s is resampled when loaded", dataset.metadata.get('name', 'The dataset'), sample_period, building)
+    return {} if use_level else {'sample_period': sample_period}
+
+
+def load_building(dataset, building, appliances, power, sample_period, mains_ac_type=None, first_column=False, load_appliances=True):
+    """
+    Loads the mains and appliance readings of one building from an already windowed DataSet.
+    Returns (mains_df, appliance_readings) with the appliances in the given order.
+    """
+    load_kwargs = select_resolution(dataset, building, sample_period)
+    elec = dataset.buildings[building].elec
+    mains_df = next(elec.mains().load(physical_quantity='power', ac_type=mains_ac_type or power['mains'], **load_kwargs))
+    if first_column:
+        mains_df = mains_df[[list(mains_df.columns)[0]]]
+
+    appliance_readings = []
+    if load_appliances:
+        for appliance_name in appliances:
+            appliance_df = next(elec[appliance_name].load(physical_quantity='power', ac_type=power['appliance'], **load_kwargs))
+            if first_column:
+                appliance_df = appliance_df[[list(appliance_df.columns)[0]]]
+            appliance_readings.append(appliance_df)
+    return mains_df, appliance_readings
+
+
+def load_key(path, start, end, building, *load_args):
+    """
+    Identifies the readings load_building returns for a building window, so readings loaded once can be passed to API as 'preloaded'
+    """
+    return json.dumps([path, str(start), str(end), building] + list(load_args), default=str)
+
+
+def planned_loads(params):
+    """
+    The buildings API(params) loads when training and testing jointly, as (path, start, end, building, load_args) for load_building
+    """
+    appliances = list(params['appliances'])
+    sample_period = params.get('sample_rate', 1)
+    train_args = (appliances, params['power'], sample_period, None, True, True)
+    test_args = (appliances, params['power'], sample_period, 'active', False, params.get('site_only', False) != True)
+    loads = []
+    for d, load_args in ((params['train']['datasets'], train_args), (params['test']['datasets'], test_args)):
+        for dataset in d.values():
+            for building, window in dataset['buildings'].items():
+                loads.append((dataset['path'], window['start_time'], window['end_time'], building, load_args))
+    return loads
+
+
+def align_frames(mains_df, appliance_dfs=None, dtype='float32'):
+    """
+    Aligns the mains and appliance readings on the mains timestamps, keeping only the timestamps that are present and not NaN in every frame.
+    Where an appliance repeats a timestamp, its first reading is used.
+    The surviving rows are copied once into a single contiguous (Fortran-ordered) block.
+    Returns (index, block, column_slices), where block[:, column_slices[0]] holds the mains and block[:, column_slices[i + 1]] the i-th appliance.
+    """
+    frames = [mains_df] + list(appliance_dfs or [])
+    index = mains_df.index
+    valid = np.ones(len(index), dtype=bool)
+    positions = []
+    for frame in frames:
+        row_has_nan = pd.isna(frame.values).any(axis=1)
+        if frame.index.equals(index):
+            # Fast path: nilmtk loads over the same window usually share the mains index
+            position = None
+            valid &= ~row_has_nan
+        else:
+            if frame.index.is_unique:
+                position = frame.index.get_indexer(index)
+            else:
+                # get_indexer needs unique timestamps, so only the first reading of a repeated timestamp is used
+                first_rows = np.flatnonzero(~frame.index.duplicated(keep='first'))
+                position = frame.index[first_rows].get_indexer(index)
+                position = np.where(position >= 0, first_rows[position], -1)
+            found = position >= 0
+            frame_valid = np.zeros(len(index), dtype=bool)
+            frame_valid[found] = ~row_has_nan[position[found]]
+            valid &= frame_valid
+        positions.append(position)
+
+    rows = np.flatnonzero(valid)
+    all_rows = len(rows) == len(index)
+    widths = [frame.shape[1] for frame in frames]
+    block = np.empty((len(rows), sum(widths)), dtype=dtype, order='F')
+    column_slices = []
+    start = 0
+    for frame, position, width in zip(frames, positions, widths):
+        columns = slice(start, start + width)
+        if position is None:
+            block[:, columns] = frame.values if all_rows else frame.values[rows]
+        else:
+            block[:, columns] = frame.values[position[rows]]
+        column_slices.append(columns)
+        start += width
+    return index[rows], block, column_slices
+
+
+def build_aggregate(appliance_readings, noise_std=0, baseline=0, rng=None):
+    """
+    Builds an artificial aggregate by summing the appliance readings into one float32 array, without pandas index alignment or per-appliance frames.
+    A constant baseline load (W) and zero-mean gaussian noise with standard deviation noise_std (W) can be added; the result is clipped at 0 when noise is used.
+    The noise is drawn from rng (a numpy Generator), so successive aggregates of one experiment get different noise.
+    """
+    first = appliance_readings[0]
+    total = np.full(first.shape, baseline, dtype='float32')
+    for reading in appliance_readings:
+        # Readings coming out of dropna already share the index, anything else is aligned to the first appliance
+        values = reading.values if reading.index.equals(first.index) else reading.reindex(first.index).values
+        np.add(total, values, out=total, casting='unsafe')
+
+    if noise_std:
+        if rng is None:
+            rng = np.random.default_rng()
+        total += rng.normal(0, noise_std, size=total.shape).astype('float32')
+        np.maximum(total, 0, out=total)
+    return pd.DataFrame(total, index=first.index, columns=first.columns, copy=False)
+
+
+def assemble_ground_truth(test_submeters):
+    """
+    Writes the readings of every test meter into one preallocated float32 (n_samples x n_appliances) array.
+    Returns (index, values, meter_names), where the index is the one shared by the meters after dropna.
+    """
+    meters = [meter for meter, data in test_submeters]
+    if len(meters) == 0:
+        return pd.Index([]), np.empty((0, 0), dtype='float32'), meters
+
+    frames = [data[0] if len(data) == 1 else pd.concat(data, axis=1) for meter, data in test_submeters]
+    index = frames[0].index
+    values = np.empty((len(index), len(meters)), dtype='float32', order='F')
+    for i, frame in enumerate(frames):
+        if not frame.index.equals(index):
+            frame = frame.reindex(index)
+        values[:, i] = frame.values.ravel()
+    return index, values, meters
+
+
+def assemble_predictions(pred_list, n_rows=None):
+    """
+    Writes the per-chunk predictions of a classifier straight into one preallocated float32 (n_samples x n_appliances) array.
+    Neural nets pad their input to fit the sequence length, so predictions beyond n_rows are dropped; rows without a prediction stay NaN.
+    Returns (appliance_names, values).
+    """
+    columns = list(pred_list[0].columns) if len(pred_list) else []
+    if n_rows is None:
+        n_rows = sum(len(pred) for pred in pred_list)
+
+    values = np.full((n_rows, len(columns)), np.nan, dtype='float32', order='F')
+    offset = 0
+    for pred in pred_list:
+        length = min(len(pred), n_rows - offset)
+        if length <= 0:
+            break
+        for i, app_name in enumerate(columns):
+            values[offset:offset + length, i] = pred[app_name].values[:length]
+        offset += length
+    return columns, values
+
+
+def disaggregate_in_blocks(clf, mains_list, block_size):
+    """
+    Runs clf.disaggregate_chunk on blocks of block_size readings, so the sliding-window input of Seq2Point / Seq2Seq never
+    holds more than block_size + 2 * sequence_length windows, however long the mains are.
+
+    Every block is extended by the readings its outputs depend on: sequence_length // 2 after it, and sequence_length - 1
+    + sequence_length // 2 before it, since Seq2Seq averages the outputs of the sequence_length windows that cover a reading.
+    The stitched predictions are therefore the same as those of one disaggregate_chunk call on the whole mains.
+    Returns a pred_list like disaggregate_chunk.
+    """
+    length = getattr(clf, 'sequence_length', 1)
+    before = length - 1 + length // 2
+    after = length // 2
+    pred_list = []
+    for mains in mains_list:
+        n_rows = len(mains)
+        if n_rows <= block_size:
+            pred_list.extend(clf.disaggregate_chunk([mains]))
+            continue
+
+        columns, values = None, None
+        for start in range(0, n_rows, block_size):
+            end = min(start + block_size, n_rows)
+            first, last = max(0, start - before), min(n_rows, end + after)
+            pred = clf.disaggregate_chunk([mains.iloc[first:last]])[0]
+            if values is None:
+                columns = list(pred.columns)
+                values = np.empty((n_rows, len(columns)), dtype='float32')
+            values[start:end] = pred[columns].values[start - first:end - first]
+        pred_list.append(pd.DataFrame(values, columns=columns, copy=False))
+    return pred_list
+
+
+def configure_logging(level='INFO'):
+    """
+    Shows the progress and results of the API at the given logging level on stdout, e.g. in notebooks.
+    Headless runs can leave logging unconfigured, so nothing is written to stdout.
+    """
+    logger.setLevel(level)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+
+def configure_inference_threads(intra_op_threads):
+    """
+    Limits the number of threads TensorFlow uses inside a single op, so that concurrent classifiers do not oversubscribe the CPU
+    """
+    if not intra_op_threads:
+        return
+    import tensorflow as tf
+    if tf.config.threading.get_intra_op_parallelism_threads() == intra_op_threads:
+        return
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    except RuntimeError:
+        # TensorFlow only accepts this before its runtime is initialised
+        logger.warning("TensorFlow is already initialised, intra-op threads could not be limited to %s", intra_op_threads)
+
+
+# Each loader process keeps its own pool, so a worker reuses its store handles across buildings
+_worker_datasets = None
+
+def _load_building_in_worker(path, start, end, building, *load_args):
+    global _worker_datasets
+    if _worker_datasets is None:
+        _worker_datasets = DataSetPool()
+    dataset = _worker_datasets.get(path, start, end)
+    return dataset.metadata.get('timezone'), load_building(dataset, building, *load_args)
 
 
 class API():
@@ -43,7 +343,32 @@ class API():
         self.display_predictions = params.get('display_predictions', False)
         self.DROP_ALL_NANS = params.get("DROP_ALL_NANS", True)
         self.site_only = params.get('site_only',False)
-        self.experiment()
+        self.load_workers = params.get('load_workers', None)
+        self.aggregate_noise = params.get('aggregate_noise', 0)
+        self.aggregate_baseline = params.get('aggregate_baseline', 0)
+        self.aggregate_seed = params.get('aggregate_seed', None)
+        # One generator per experiment, so the noise of every building and chunk is different but reproducible from aggregate_seed
+        self.aggregate_rng = np.random.default_rng(self.aggregate_seed)
+        self.inference_workers = params.get('inference_workers', None)
+        self.inference_memory_mb = params.get('inference_memory_mb', None)
+        self.inference_intra_op_threads = params.get('inference_intra_op_threads', None)
+        self.prediction_block_size = params.get('prediction_block_size', None)
+        # load_key -> (timezone, mains_df, appliance_readings) of buildings already loaded elsewhere, e.g. shared by sweep.py
+        self.preloaded = params.get('preloaded', {})
+        self.timings = Timings(profile=params.get('profile', None), profile_stages=params.get('profile_stages', None))
+        if params.get('log_level'):
+            configure_logging(params['log_level'])
+        self.run_id = params.get('run_id') or new_run_id()
+        self.results_store = ResultsStore(params['results_store']) if params.get('results_store') else None
+        if self.results_store is not None:
+            self.results_store.record_run(self.run_id, self.sample_period, list(self.methods), {key: value for key, value in params.items() if key != 'preloaded'})
+        self.datasets = DataSetPool()
+        # TensorFlow only takes the thread limit before its runtime starts, i.e. before the classifiers build their networks
+        configure_inference_threads(self.inference_intra_op_threads)
+        try:
+            self.experiment()
+        finally:
+            self.close()
         
 
     def experiment(self):
@@ -56,53 +381,59 @@ class API():
 
         for model_name, clf in self.classifiers:
             # If the model is a neural net, it has an attribute n_epochs, Ex: DAE, Seq2Point
-            print ("Started training for ",clf.MODEL_NAME)
+            logger.info("Started training for %s", clf.MODEL_NAME)
 
             # If the model has the filename specified for loading the pretrained model, then we don't need to load training data
 
             if hasattr(clf,'load_model_path'):
                 if clf.load_model_path:
-                    print (clf.MODEL_NAME," is loading the pretrained model")
+                    logger.info("%s is loading the pretrained model", clf.MODEL_NAME)
                     continue
 
-            # if user wants to train chunk wise
-            if self.chunk_size:
-                # If the classifier supports chunk wise training
-                if clf.chunk_wise_training:
-                    # if it has an attribute n_epochs. Ex: neural nets. Then it is trained chunk wise for every wise
-                    if hasattr(clf,'n_epochs'):
-                        n_epochs = clf.n_epochs
-                        clf.n_epochs = 1
+            with self.span('train', classifier=model_name):
+                # if user wants to train chunk wise
+                if self.chunk_size:
+                    # If the classifier supports chunk wise training
+                    if clf.chunk_wise_training:
+                        # if it has an attribute n_epochs. Ex: neural nets. Then it is trained chunk wise for every wise
+                        if hasattr(clf,'n_epochs'):
+                            n_epochs = clf.n_epochs
+                            clf.n_epochs = 1
+                        else:
+                            # If it doesn't have the attribute n_epochs, this is executed. Ex: Mean, Zero
+                            n_epochs = 1
+                        # Training on those many chunks for those many epochs
+                        logger.info("Chunk wise training for %s", clf.MODEL_NAME)
+                        for i in range(n_epochs):
+                            with self.span('epoch', epoch=i):
+                                self.train_chunk_wise(clf, d, i)
+
                     else:
-                        # If it doesn't have the attribute n_epochs, this is executed. Ex: Mean, Zero
-                        n_epochs = 1
-                    # Training on those many chunks for those many epochs
-                    print ("Chunk wise training for ",clf.MODEL_NAME)
-                    for i in range(n_epochs):
-                        self.train_chunk_wise(clf, d, i)
+                        logger.info("Joint training for %s", clf.MODEL_NAME)
+                        self.train_jointly(clf,d)            
 
+                # if it doesn't support chunk wise training
                 else:
-                    print ("Joint training for ",clf.MODEL_NAME)
+                    logger.info("Joint training for %s", clf.MODEL_NAME)
                     self.train_jointly(clf,d)            
 
-            # if it doesn't support chunk wise training
-            else:
-                print ("Joint training for ",clf.MODEL_NAME)
-                self.train_jointly(clf,d)            
-
-            print ("Finished training for ",clf.MODEL_NAME)
+            logger.info("Finished training for %s", clf.MODEL_NAME)
             clear_output()
 
         d=self.test_datasets_dict
 
-        if self.chunk_size:
-            print ("Chunk Wise Testing for all algorithms")
-            # It means that, predictions can also be done on chunks
-            self.test_chunk_wise(d)
+        with self.span('test'):
+            if self.chunk_size:
+                logger.info("Chunk Wise Testing for all algorithms")
+                # It means that, predictions can also be done on chunks
+                self.test_chunk_wise(d)
 
-        else:
-            print ("Joint Testing for all algorithms")
-            self.test_jointly(d)
+            else:
+                logger.info("Joint Testing for all algorithms")
+                self.test_jointly(d)
+
+        if self.results_store is not None:
+            self.results_store.append_timings(self.run_id, self.timings)
 
     def train_chunk_wise(self, clf, d, current_epoch):
         """
@@ -111,125 +442,128 @@ class API():
             
         for dataset in d:
             # Loading the dataset
-            print("Loading data for ",dataset, " dataset")          
+            logger.info("Loading data for %s dataset", dataset)
             for building in d[dataset]['buildings']:
                 # Loading the building
-                train=DataSet(d[dataset]['path'])
-                print("Loading building ... ",building)
-                train.set_window(start=d[dataset]['buildings'][building]['start_time'],end=d[dataset]['buildings'][building]['end_time'])
-                mains_iterator = train.buildings[building].elec.mains().load(chunksize = self.chunk_size, physical_quantity='power', ac_type = self.power['mains'], sample_period=self.sample_period)
-                appliance_iterators = [train.buildings[building].elec[app_name].load(chunksize = self.chunk_size, physical_quantity='power', ac_type=self.power['appliance'], sample_period=self.sample_period) for app_name in self.appliances]
-                print(train.buildings[building].elec.mains())
-                for chunk_num,chunk in enumerate (train.buildings[building].elec.mains().load(chunksize = self.chunk_size, physical_quantity='power', ac_type = self.power['mains'], sample_period=self.sample_period)):
-                    # Loading the chunk for the specifeid building
-                    #Dummry loop for executing on outer level. Just for looping till end of a chunk
-                    print("Starting enumeration..........")
-                    train_df = next(mains_iterator)
-                    appliance_readings = []
-                    for i in appliance_iterators:
-                        try:
-                            appliance_df = next(i)
-                        except StopIteration:
-                            appliance_df = pd.DataFrame()
-                        appliance_readings.append(appliance_df)
-
-                    if self.DROP_ALL_NANS:
-                        train_df, appliance_readings = self.dropna(train_df, appliance_readings)
+                logger.info("Loading building ... %s", building)
+                train=self.get_dataset(d[dataset]['path'], start=d[dataset]['buildings'][building]['start_time'],end=d[dataset]['buildings'][building]['end_time'])
+                for chunk_num, (train_df, appliance_readings) in enumerate(self.load_aligned_chunks(train, building, dataset)):
+                    with self.span('chunk', dataset=dataset, building=building, chunk=chunk_num):
+                        # Loading the chunk for the specifeid building
+                        if self.DROP_ALL_NANS:
+                            train_df, appliance_readings = self.dropna(train_df, appliance_readings)
                     
-                    if self.artificial_aggregate:
-                        print ("Creating an Artificial Aggregate")
-                        train_df = pd.DataFrame(np.zeros(appliance_readings[0].shape),index = appliance_readings[0].index,columns=appliance_readings[0].columns)
-                        for app_reading in appliance_readings:
-                            train_df+=app_reading
-                    train_appliances = []
-
-                    for cnt,i in enumerate(appliance_readings):
-                        train_appliances.append((self.appliances[cnt],[i]))
-
-                    self.train_mains = [train_df]
-                    self.train_submeters = train_appliances
-                    clf.partial_fit(self.train_mains, self.train_submeters, current_epoch)
+                        if self.artificial_aggregate:
+                            train_df = self.create_artificial_aggregate(appliance_readings)
+                        train_appliances = []
+
+                        for cnt,i in enumerate(appliance_readings):
+                            train_appliances.append((self.appliances[cnt],[i]))
+
+                        self.train_mains = [train_df]
+                        self.train_submeters = train_appliances
+                        with self.span('partial_fit') as span:
+                            span.add(rows=len(train_df), bytes=frame_bytes(train_df))
+                            clf.partial_fit(self.train_mains, self.train_submeters, current_epoch)
                 
 
-        print("...............Finished the Training Process ...................")
+        logger.info("...............Finished the Training Process ...................")
 
     def test_chunk_wise(self,d):
 
-        print("...............Started  the Testing Process ...................")
+        logger.info("...............Started  the Testing Process ...................")
 
         for dataset in d:
-            print("Loading data for ",dataset, " dataset")
+            logger.info("Loading data for %s dataset", dataset)
             for building in d[dataset]['buildings']:
-                test=DataSet(d[dataset]['path'])
-                test.set_window(start=d[dataset]['buildings'][building]['start_time'],end=d[dataset]['buildings'][building]['end_time'])
-                mains_iterator = test.buildings[building].elec.mains().load(chunksize = self.chunk_size, physical_quantity='power', ac_type = self.power['mains'], sample_period=self.sample_period)
-                appliance_iterators = [test.buildings[building].elec[app_name].load(chunksize = self.chunk_size, physical_quantity='power', ac_type=self.power['appliance'], sample_period=self.sample_period) for app_name in self.appliances]
-                for chunk_num,chunk in enumerate (test.buildings[building].elec.mains().load(chunksize = self.chunk_size, physical_quantity='power', ac_type = self.power['mains'], sample_period=self.sample_period)):
-                    test_df = next(mains_iterator)
-                    appliance_readings = []
-                    for i in appliance_iterators:
-                        try:
-                            appliance_df = next(i)
-                        except StopIteration:
-                            appliance_df = pd.DataFrame()
+                test=self.get_dataset(d[dataset]['path'], start=d[dataset]['buildings'][building]['start_time'],end=d[dataset]['buildings'][building]['end_time'])
+                for chunk_num, (test_df, appliance_readings) in enumerate(self.load_aligned_chunks(test, building, dataset)):
+                    with self.span('chunk', dataset=dataset, building=building, chunk=chunk_num):
+                        if self.DROP_ALL_NANS:
+                            test_df, appliance_readings = self.dropna(test_df, appliance_readings)
 
-                        appliance_readings.append(appliance_df)
+                        if self.artificial_aggregate:
+                            test_df = self.create_artificial_aggregate(appliance_readings)
 
-                    if self.DROP_ALL_NANS:
-                        test_df, appliance_readings = self.dropna(test_df, appliance_readings)
+                        test_appliances = []
 
-                    if self.artificial_aggregate:
-                        print ("Creating an Artificial Aggregate")
-                        test_df = pd.DataFrame(np.zeros(appliance_readings[0].shape),index = appliance_readings[0].index,columns=appliance_readings[0].columns)
-                        for app_reading in appliance_readings:
-                            test_df+=app_reading
+                        for cnt,i in enumerate(appliance_readings):
+                            test_appliances.append((self.appliances[cnt],[i]))
 
-                    test_appliances = []
+                        self.test_mains = [test_df]
+                        self.test_submeters = test_appliances
+                        logger.info("Results for Dataset %s Building %s Chunk %s", dataset, building, chunk_num)
+                        self.storing_key = str(dataset) + "_" + str(building) + "_" + str(chunk_num) 
+                        self.storing_context = {'dataset': dataset, 'building': building, 'chunk': chunk_num}
+                        with self.span('predict'):
+                            self.call_predict(self.classifiers, test.metadata['timezone'])
 
-                    for cnt,i in enumerate(appliance_readings):
-                        test_appliances.append((self.appliances[cnt],[i]))
 
-                    self.test_mains = [test_df]
-                    self.test_submeters = test_appliances
-                    print("Results for Dataset {dataset} Building {building} Chunk {chunk_num}".format(dataset=dataset,building=building,chunk_num=chunk_num))
-                    self.storing_key = str(dataset) + "_" + str(building) + "_" + str(chunk_num) 
-                    self.call_predict(self.classifiers, test.metadata['timezone'])
+    def load_aligned_chunks(self, dataset, building, dataset_name=None):
+        """
+        Loads the mains of a building chunk by chunk and, for every mains chunk, loads the appliance readings over exactly the same timeframe.
+        Yields (mains_df, appliance_readings) so every chunk is only loaded and resampled once.
+        """
+        load_kwargs = select_resolution(dataset, building, self.sample_period)
+        elec = dataset.buildings[building].elec
+        mains = elec.mains().load(chunksize = self.chunk_size, physical_quantity='power', ac_type = self.power['mains'], **load_kwargs)
+        chunk_num = 0
+        while True:
+            # Only the loading is timed, not the work done on the chunk between two iterations
+            with self.span('load', dataset=dataset_name, building=building, chunk=chunk_num) as span:
+                mains_df = next(mains, None)
+                if mains_df is None:
+                    span.set(exhausted=True)
+                    return
+                timeframe = self.chunk_timeframe(mains_df)
+                appliance_readings = []
+                for app_name in self.appliances:
+                    if timeframe is None:
+                        appliance_df = pd.DataFrame()
+                    else:
+                        appliance_chunks = list(elec[app_name].load(sections=[timeframe], physical_quantity='power', ac_type=self.power['appliance'], **load_kwargs))
+                        if len(appliance_chunks) == 0:
+                            appliance_df = pd.DataFrame()
+                        elif len(appliance_chunks) == 1:
+                            appliance_df = appliance_chunks[0]
+                        else:
+                            appliance_df = pd.concat(appliance_chunks)
+                    appliance_readings.append(appliance_df)
+                span.add(rows=len(mains_df), bytes=frame_bytes([mains_df] + appliance_readings))
+            yield mains_df, appliance_readings
+            chunk_num += 1
 
+    def chunk_timeframe(self, chunk):
+        """
+        Returns the timeframe covered by a loaded chunk, or None if the chunk is empty
+        """
+        timeframe = getattr(chunk, 'timeframe', None)
+        if timeframe is not None and not timeframe.empty:
+            return timeframe
+        if len(chunk) == 0:
+            return None
+        return TimeFrame(start=chunk.index[0], end=chunk.index[-1] + pd.Timedelta(seconds=self.sample_period))
 
     def train_jointly(self,clf,d):
 
         # This function has a few issues, which should be addressed soon
-        print("............... Loading Data for training ...................")
+        logger.info("............... Loading Data for training ...................")
         # store the train_main readings for all buildings
         self.train_mains = []
         self.train_submeters = [[] for i in range(len(self.appliances))]
-        for dataset in d:
-            print("Loading data for ",dataset, " dataset")
-            train=DataSet(d[dataset]['path'])
-            for building in d[dataset]['buildings']:
-                print("Loading building ... ",building)
-                train.set_window(start=d[dataset]['buildings'][building]['start_time'],end=d[dataset]['buildings'][building]['end_time'])
-                train_df = next(train.buildings[building].elec.mains().load(physical_quantity='power', ac_type=self.power['mains'], sample_period=self.sample_period))
-                train_df = train_df[[list(train_df.columns)[0]]]
-                appliance_readings = []
-                
-                for appliance_name in self.appliances:
-                    appliance_df = next(train.buildings[building].elec[appliance_name].load(physical_quantity='power', ac_type=self.power['appliance'], sample_period=self.sample_period))
-                    appliance_df = appliance_df[[list(appliance_df.columns)[0]]]
-                    appliance_readings.append(appliance_df)
+        for dataset, building, timezone, train_df, appliance_readings in self.load_buildings(d, first_column=True):
+            logger.info("Loaded building ... %s of %s dataset", building, dataset)
 
+            with self.span('building', dataset=dataset, building=building):
                 if self.DROP_ALL_NANS:
                     train_df, appliance_readings = self.dropna(train_df, appliance_readings)
 
                 if self.artificial_aggregate:
-                    print ("Creating an Artificial Aggregate")
-                    train_df = pd.DataFrame(np.zeros(appliance_readings[0].shape),index = appliance_readings[0].index,columns=appliance_readings[0].columns)
-                    for app_reading in appliance_readings:
-                        train_df+=app_reading
+                    train_df = self.create_artificial_aggregate(appliance_readings)
 
-                self.train_mains.append(train_df)
-                for i,appliance_name in enumerate(self.appliances):
-                    self.train_submeters[i].append(appliance_readings[i])
+            self.train_mains.append(train_df)
+            for i,appliance_name in enumerate(self.appliances):
+                self.train_submeters[i].append(appliance_readings[i])
 
         appliance_readings = []
         for i,appliance_name in enumerate(self.appliances):
@@ -237,62 +571,138 @@ class API():
 
         self.train_submeters = appliance_readings   
 
-        clf.partial_fit(self.train_mains,self.train_submeters)
+        with self.span('partial_fit') as span:
+            span.add(rows=sum(len(train_df) for train_df in self.train_mains), bytes=frame_bytes(self.train_mains))
+            clf.partial_fit(self.train_mains,self.train_submeters)
 
     
     def test_jointly(self,d):
         # store the test_main readings for all buildings
-        for dataset in d:
-            print("Loading data for ",dataset, " dataset")
-            test=DataSet(d[dataset]['path'])
-            for building in d[dataset]['buildings']:
-                test.set_window(start=d[dataset]['buildings'][building]['start_time'],end=d[dataset]['buildings'][building]['end_time'])
-                test_mains=next(test.buildings[building].elec.mains().load(physical_quantity='power', ac_type='active', sample_period=self.sample_period))
+        for dataset, building, timezone, test_mains, appliance_readings in self.load_buildings(d, mains_ac_type='active', load_appliances=self.site_only != True):
+            logger.info("Loaded building ... %s of %s dataset", building, dataset)
+            with self.span('building', dataset=dataset, building=building):
                 if self.DROP_ALL_NANS and self.site_only:
                     test_mains, _= self.dropna(test_mains,[])
 
+                self.test_submeters = []
                 if self.site_only != True:
-                    appliance_readings=[]
-
-                    for appliance in self.appliances:
-                        test_df=next((test.buildings[building].elec[appliance].load(physical_quantity='power', ac_type=self.power['appliance'], sample_period=self.sample_period)))
-                        appliance_readings.append(test_df)
-                    
                     if self.DROP_ALL_NANS:
                         test_mains , appliance_readings = self.dropna(test_mains,appliance_readings)
-                
+            
                     if self.artificial_aggregate:
-                        print ("Creating an Artificial Aggregate")
-                        test_mains = pd.DataFrame(np.zeros(appliance_readings[0].shape),index = appliance_readings[0].index,columns=appliance_readings[0].columns)
-                        for app_reading in appliance_readings:
-                            test_mains+=app_reading
+                        test_mains = self.create_artificial_aggregate(appliance_readings)
                     for i, appliance_name in enumerate(self.appliances):
                         self.test_submeters.append((appliance_name,[appliance_readings[i]]))
 
                 self.test_mains = [test_mains]
                 self.storing_key = str(dataset) + "_" + str(building) 
-                self.call_predict(self.classifiers, test.metadata["timezone"])
+                self.storing_context = {'dataset': dataset, 'building': building}
+                with self.span('predict'):
+                    self.call_predict(self.classifiers, timezone)
+
+    def load_buildings(self, d, mains_ac_type=None, first_column=False, load_appliances=True):
+        """
+        Loads every building of every dataset in d and yields (dataset, building, timezone, mains_df, appliance_readings) in the order of d.
+        Buildings found in self.preloaded are not loaded again. With load_workers > 1 the other buildings are loaded and resampled in
+        parallel worker processes, but every building is still yielded in the same order.
+        """
+        jobs = [(dataset, building) for dataset in d for building in d[dataset]['buildings']]
+        load_args = (self.appliances, self.power, self.sample_period, mains_ac_type, first_column, load_appliances)
+        load_workers = getattr(self, 'load_workers', None)
+        preloaded = getattr(self, 'preloaded', {})
+        keys = {}
+        for dataset, building in jobs:
+            window = d[dataset]['buildings'][building]
+            keys[dataset, building] = load_key(d[dataset]['path'], window['start_time'], window['end_time'], building, *load_args)
+        # Only the buildings that were not loaded elsewhere are loaded here
+        to_load = [job for job in jobs if keys[job] not in preloaded]
+
+        executor = None
+        futures = {}
+        if load_workers and load_workers >= 2 and len(to_load) >= 2:
+            logger.info("Loading %d buildings with %d workers", len(to_load), load_workers)
+            # HDF5 handles cannot be shared between threads safely, so every worker process opens its own read-only store. The
+            # workers are spawned: forked ones would inherit the open HDF5 handles and the TensorFlow runtime of this process
+            executor = ProcessPoolExecutor(max_workers=min(load_workers, len(to_load)), mp_context=multiprocessing.get_context('spawn'))
+        try:
+            if executor is not None:
+                for dataset, building in to_load:
+                    window = d[dataset]['buildings'][building]
+                    futures[dataset, building] = executor.submit(_load_building_in_worker, d[dataset]['path'], window['start_time'], window['end_time'], building, *load_args)
+
+            for dataset, building in jobs:
+                window = d[dataset]['buildings'][building]
+                if keys[dataset, building] in preloaded:
+                    with self.span('load', dataset=dataset, building=building, preloaded=True) as span:
+                        timezone, mains_df, appliance_readings = preloaded[keys[dataset, building]]
+                        span.add(rows=len(mains_df), bytes=frame_bytes([mains_df] + appliance_readings))
+                elif (dataset, building) in futures:
+                    # Only the time spent waiting for the worker is seen here
+                    with self.span('load', dataset=dataset, building=building, workers=load_workers) as span:
+                        timezone, (mains_df, appliance_readings) = futures[dataset, building].result()
+                        span.add(rows=len(mains_df), bytes=frame_bytes([mains_df] + appliance_readings))
+                else:
+                    with self.span('load', dataset=dataset, building=building) as span:
+                        data = self.get_dataset(d[dataset]['path'], start=window['start_time'], end=window['end_time'])
+                        mains_df, appliance_readings = load_building(data, building, *load_args)
+                        span.add(rows=len(mains_df), bytes=frame_bytes([mains_df] + appliance_readings))
+                    timezone = data.metadata.get('timezone')
+                yield dataset, building, timezone, mains_df, appliance_readings
+        finally:
+            if executor is not None:
+                executor.shutdown()
     
+    def create_artificial_aggregate(self, appliance_readings):
+        """
+        Replaces the mains with the sum of the appliance readings, plus the configured baseline load and noise
+        """
+        logger.info("Creating an Artificial Aggregate")
+        if not hasattr(self, 'aggregate_rng'):
+            # Models exported before the generator existed do not have it yet
+            self.aggregate_rng = np.random.default_rng(getattr(self, 'aggregate_seed', None))
+        return build_aggregate(appliance_readings, noise_std=getattr(self, 'aggregate_noise', 0), baseline=getattr(self, 'aggregate_baseline', 0), rng=self.aggregate_rng)
+
+    def get_dataset(self, path, start=None, end=None):
+        """
+        Returns the pooled read-only DataSet for the path, windowed to the given building time range
+        """
+        if not hasattr(self, 'datasets'):
+            # Models exported before the pool existed do not have one yet
+            self.datasets = DataSetPool()
+        return self.datasets.get(path, start, end)
+
+    def close(self):
+        """
+        Closes every HDF5 store opened by this API. The stores are reopened on demand if testing is called again.
+        """
+        if hasattr(self, 'datasets'):
+            self.datasets.close()
+        # Shared readings are not part of the trained model
+        self.preloaded = {}
+
+    def span(self, name, **attrs):
+        """
+        Times a stage in self.timings, see timings.Timings.span
+        """
+        if not hasattr(self, 'timings'):
+            # Models exported before timings existed do not have them yet
+            self.timings = Timings()
+        return self.timings.span(name, **attrs)
+
     def dropna(self,mains_df, appliance_dfs=[]):
         """
         Drops the missing values in the Mains reading and appliance readings and returns consistent data by copmuting the intersection
         """
-        print ("Dropping missing values")
-
-        # The below steps are for making sure that data is consistent by doing intersection across appliances
-        mains_df = mains_df.dropna()
-        ix = mains_df.index
-        mains_df = mains_df.loc[ix]
-        for i in range(len(appliance_dfs)):
-            appliance_dfs[i] = appliance_dfs[i].dropna()
-    
-        for  app_df in appliance_dfs:
-            ix = ix.intersection(app_df.index)
-        mains_df = mains_df.loc[ix]
-        new_appliances_list = []
-        for app_df in appliance_dfs:
-            new_appliances_list.append(app_df.loc[ix])
-        return mains_df,new_appliances_list
+        logger.info("Dropping missing values")
+
+        with self.span('dropna') as span:
+            # One combined validity mask over the mains timestamps, then a single copy of the surviving rows
+            index, block, column_slices = align_frames(mains_df, appliance_dfs)
+            frames = [mains_df] + list(appliance_dfs)
+            aligned = [pd.DataFrame(block[:, columns], index=index, columns=frame.columns, copy=False) for frame, columns in zip(frames, column_slices)]
+            span.add(rows=len(mains_df), bytes=frame_bytes(frames))
+            span.set(rows_kept=len(index))
+        return aligned[0], aligned[1:]
     
     
     def store_classifier_instances(self):
@@ -307,8 +717,7 @@ class API():
                 self.classifiers.append((name,clf))
 
             except Exception as e:
-                print ("\n\nThe method {model_name} specied does not exist. \n\n".format(model_name=name))
-                print (e)
+                logger.error("The method {model_name} specied does not exist. {error}".format(model_name=name, error=e))
     
     def call_predict(self, classifiers, timezone):
 
@@ -318,28 +727,34 @@ class API():
         
         pred_overall={}
         gt_overall={}           
+        pred_lists = self.run_concurrent_inference(classifiers, self.test_mains)
         for name,clf in classifiers:
-            gt_overall,pred_overall[name]=self.predict(clf,self.test_mains,self.test_submeters, self.sample_period, timezone)
+            if name not in pred_lists:
+                with self.span('disaggregate_chunk', classifier=name) as span:
+                    span.add(rows=sum(len(mains) for mains in self.test_mains), bytes=frame_bytes(self.test_mains))
+                    pred_lists[name] = self.disaggregate(clf, self.test_mains)
+            gt_overall,pred_overall[name]=self.predict(clf,self.test_mains,self.test_submeters, self.sample_period, timezone, pred_lists[name])
 
         self.gt_overall=gt_overall
         self.pred_overall=pred_overall
         if self.site_only != True:
             if gt_overall.size==0:
-                print ("No samples found in ground truth")
+                logger.warning("No samples found in ground truth")
                 return None
+            with self.span('metrics') as span:
+                span.add(rows=len(gt_overall), bytes=frame_bytes([gt_overall] + list(pred_overall.values())))
+                results = compute_metrics(gt_overall, pred_overall, self.metrics)
+            if getattr(self, 'results_store', None) is not None:
+                sequence_lengths = {name: getattr(clf, 'sequence_length', 0) for name, clf in classifiers}
+                self.results_store.append_results(results, self.run_id, self.sample_period, sequence_lengths, **self.storing_context)
+            classifier_names = [clf_name for clf_name, clf in classifiers]
             for metric in self.metrics:
-                try:
-                    loss_function = globals()[metric]                
-                except:
-                    print ("Loss function ",metric, " is not supported currently!")
+                if not (results['metric'] == metric).any():
+                    logger.warning("Loss function %s is not supported currently!", metric)
                     continue
 
-                computed_metric={}
-                for clf_name,clf in classifiers:
-                    computed_metric[clf_name] = self.compute_loss(gt_overall, pred_overall[clf_name], loss_function)
-                computed_metric = pd.DataFrame(computed_metric)
-                print("............ " ,metric," ..............")
-                print(computed_metric) 
+                computed_metric = metric_table(results, metric, classifier_names, list(gt_overall.columns))
+                logger.info("............ %s ..............\n%s", metric, computed_metric)
                 self.errors.append(computed_metric)
                 self.errors_keys.append(self.storing_key + "_" + metric)
 
@@ -369,48 +784,81 @@ class API():
                     
         
         
-    def predict(self, clf, test_elec, test_submeters, sample_period, timezone ):
-        print ("Generating predictions for :",clf.MODEL_NAME)        
+    def run_concurrent_inference(self, classifiers, test_mains):
+        """
+        Runs disaggregate_chunk of every classifier at the same time on the shared, read-only test mains when inference_workers > 1.
+        Returns {classifier name: pred_list}, or an empty dict when inference should run sequentially inside predict.
+        """
+        workers = self.inference_worker_count(classifiers, test_mains)
+        if workers < 2:
+            return {}
+
+        logger.info("Running inference for %d classifiers with %d workers", len(classifiers), workers)
+        # Threads rather than processes: the trained networks stay in this process and TensorFlow releases the GIL while it runs
+        with self.span('disaggregate_chunk', classifier=', '.join(name for name, clf in classifiers), workers=workers) as span:
+            span.add(rows=sum(len(mains) for mains in test_mains), bytes=frame_bytes(test_mains))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [(name, executor.submit(self.disaggregate, clf, test_mains)) for name, clf in classifiers]
+                return {name: future.result() for name, future in futures}
+
+    def inference_worker_count(self, classifiers, test_mains):
+        """
+        Number of classifiers to run at once, limited by inference_memory_mb using the size of the sliding-window input each one builds
+        """
+        workers = min(getattr(self, 'inference_workers', None) or 1, len(classifiers))
+        memory_limit = getattr(self, 'inference_memory_mb', None)
+        if workers < 2 or not memory_limit:
+            return workers
+
+        sequence_length = max(getattr(clf, 'sequence_length', 1) for name, clf in classifiers)
+        block_size = getattr(self, 'prediction_block_size', None)
+        # Block prediction only builds the windows of one block (plus its context) at a time
+        n_samples = sum(min(len(mains), block_size + 2 * sequence_length) if block_size else len(mains) for mains in test_mains)
+        # float32 windows of sequence_length samples for every mains sample
+        required_mb = n_samples * sequence_length * 4 / 2**20
+        if required_mb > 0:
+            workers = min(workers, max(1, int(memory_limit // required_mb)))
+        return workers
+
+    def disaggregate(self, clf, test_mains):
+        """
+        clf.disaggregate_chunk on the test mains, in overlapping blocks of prediction_block_size readings if it is set
+        """
+        block_size = getattr(self, 'prediction_block_size', None)
+        if block_size:
+            return disaggregate_in_blocks(clf, test_mains, block_size)
+        return clf.disaggregate_chunk(test_mains)
+
+    def predict(self, clf, test_elec, test_submeters, sample_period, timezone, pred_list=None):
+        logger.info("Generating predictions for : %s", clf.MODEL_NAME)
         """
         Generates predictions on the test dataset using the specified classifier.
+        pred_list can hold the output of clf.disaggregate_chunk if it has already been computed.
         """
         
         # "ac_type" varies according to the dataset used. 
         # Make sure to use the correct ac_type before using the default parameters in this code.   
         
-           
-        pred_list = clf.disaggregate_chunk(test_elec)
+        if pred_list is None:
+            pred_list = self.disaggregate(clf, test_elec)
 
         # It might not have time stamps sometimes due to neural nets
         # It has the readings for all the appliances
 
-        concat_pred_df = pd.concat(pred_list,axis=0)
-
-        gt = {}
-        for meter,data in test_submeters:
-                concatenated_df_app = pd.concat(data,axis=1)
-                index = concatenated_df_app.index
-                gt[meter] = pd.Series(concatenated_df_app.values.flatten(),index=index)
-
-        gt_overall = pd.DataFrame(gt, dtype='float32')
-        pred = {}
+        gt_index, gt_values, meters = assemble_ground_truth(test_submeters)
+        gt_overall = pd.DataFrame(gt_values, index=gt_index, columns=meters, copy=False)
 
         if self.site_only ==True:
-            for app_name in concat_pred_df.columns:
-                app_series_values = concat_pred_df[app_name].values.flatten()
-                pred[app_name] = pd.Series(app_series_values)
-            pred_overall = pd.DataFrame(pred,dtype='float32')
+            columns, pred_values = assemble_predictions(pred_list)
+            pred_overall = pd.DataFrame(pred_values, columns=columns, copy=False)
             pred_overall.plot(label="Pred")
             plt.title('Disaggregated Data')
             plt.legend()
 
         else:
-            for app_name in concat_pred_df.columns:
-                app_series_values = concat_pred_df[app_name].values.flatten()
-                # Neural nets do extra padding sometimes, to fit, so get rid of extra predictions
-                app_series_values = app_series_values[:len(gt_overall[app_name])]
-                pred[app_name] = pd.Series(app_series_values, index = gt_overall.index)
-            pred_overall = pd.DataFrame(pred,dtype='float32')
+            # Neural nets do extra padding sometimes, to fit, so get rid of extra predictions
+            columns, pred_values = assemble_predictions(pred_list, len(gt_index))
+            pred_overall = pd.DataFrame(pred_values, index=gt_index, columns=columns, copy=False)
         
         return gt_overall, pred_overall
 
@@ -0,0 +1,324 @@
+"""
+Offline benchmarks of the convert -> load -> dropna -> train -> predict -> score pipeline.
+
+Every stage is timed and its peak resident memory (RSS) recorded for each sample period (1, 3, 6 and 30 second)
+and sequence length (99, 199 and 599, the grid in results/). Every grid point runs in a fresh process,
+so memory and TensorFlow state do not leak between them. Results are written as JSON and compared
+against a stored baseline, e.g.
+
+python benchmark.py --quick --save-baseline benchmarks/baseline_quick.json
+python benchmark.py --quick --baseline benchmarks/baseline_quick.json
+
+The quick mode runs on a cropped building (and cropped CSV files for convert) at 1 second and sequence length 99,
+on CPU only, so it fits in CI.
+The exit code is 1 if any stage regressed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import statistics
+import multiprocessing
+import pandas as pd
+from os.path import join
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Sample period (seconds) -> store. The committed 1 second store has no levels yet (see data_converter.ipynb), so the other
+# periods read the stores resampled for them
+STORES = {1: 'data/mimos_1_sec.h5', 3: 'data/mimos_3_sec.h5', 6: 'data/mimos_6_sec.h5', 30: 'data/mimos_30_sec.h5'}
+SEQUENCE_LENGTHS = [99, 199, 599]
+
+APPLIANCES = ['fridge', 'air conditioner', 'washing machine', 'tumble dryer', 'kettle', 'vacuum cleaner', 'electric water heating appliance', 'oven']
+METRICS = ['mae', 'rmse', 'f1score', 'nde']
+
+# The train / test split of nilm.ipynb
+TRAIN_BUILDINGS = {
+    1: {'start_time': '2022-09-27', 'end_time': '2022-09-28'},
+    2: {'start_time': '2022-09-29', 'end_time': '2022-09-30'},
+    3: {'start_time': '2022-11-01', 'end_time': '2022-11-02'},
+    4: {'start_time': '2022-11-07', 'end_time': '2022-11-08'},
+    6: {'start_time': '2022-11-09', 'end_time': '2022-11-10'},
+    7: {'start_time': '2022-11-10', 'end_time': '2022-11-11'},
+}
+TEST_BUILDINGS = {5: {'start_time': '2022-11-08', 'end_time': '2022-11-09'}}
+
+# Quick mode: the first 30 minutes of building 1, for training and testing
+QUICK_BUILDINGS = {1: {'start_time': '2022-09-27 15:52:32', 'end_time': '2022-09-27 16:22:32'}}
+QUICK_ROWS = 1800
+
+STAGES = ['convert', 'load', 'dropna', 'train_jointly', 'train_chunk_wise', 'predict', 'score', 'compute_loss']
+
+# Relative slowdown (or memory growth) reported as a regression, and the smallest absolute changes that count
+TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+MIN_RSS_MB = 16
+
+
+class PeakRSS():
+
+    """
+    Samples the resident memory of this process in a background thread, so the peak of a single stage can be measured.
+    Falls back to the peak of the whole process where /proc is not available.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self.peak = 0
+        self.running = False
+
+    def current_mb(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self.page_size / 2**20
+        except OSError:
+            # ru_maxrss is in KB on Linux and in bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.current_mb())
+            time.sleep(self.interval)
+
+    @contextmanager
+    def measure(self):
+        self.peak = self.current_mb()
+        self.running = True
+        thread = threading.Thread(target=self._sample, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            self.running = False
+            thread.join()
+            self.peak = max(self.peak, self.current_mb())
+
+
+class StageTimer():
+
+    """
+    Collects one record per timed stage of a grid point
+    """
+
+    def __init__(self, sample_period, sequence_length):
+        self.sample_period = sample_period
+        self.sequence_length = sequence_length
+        self.records = []
+        self.rss = PeakRSS()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        record = {'stage': name, 'sample_period': self.sample_period, 'sequence_length': self.sequence_length, 'rows': rows}
+        start = time.perf_counter()
+        with self.rss.measure():
+            yield record
+        record['seconds'] = time.perf_counter() - start
+        record['peak_rss_mb'] = self.rss.peak
+        self.records.append(record)
+        print("{stage:>16} {sample_period:>4}s SL {sequence_length} {seconds:8.3f}s {peak_rss_mb:8.1f} MB".format(**record))
+
+
+def _experiment_api(sample_period, chunk_size=None):
+    """
+    An API object that has not loaded or trained anything yet, on which the stages can be called one by one
+    """
+    from api import API
+    return API({
+        'power': {'mains': ['active'], 'appliance': ['active']},
+        'sample_rate': sample_period,
+        'appliances': APPLIANCES,
+        'methods': {},
+        'chunk_size': chunk_size,
+        'train': {'datasets': {}},
+        'test': {'datasets': {}, 'metrics': METRICS},
+    })
+
+
+def _datasets(sample_period, buildings):
+    return {'MIMOS': {'path': STORES[sample_period], 'buildings': buildings}}
+
+
+def run_pipeline(sample_period, sequence_length, quick=False, n_epochs=1, batch_size=512, chunk_size=2**14):
+    """
+    Runs every stage but convert for one grid point and returns the stage records
+    """
+    from nilmtk.losses import nde
+    from nilmtk_contrib.disaggregate import Seq2Point
+    from metrics import compute_metrics
+
+    timer = StageTimer(sample_period, sequence_length)
+    train = _datasets(sample_period, QUICK_BUILDINGS if quick else TRAIN_BUILDINGS)
+    test = _datasets(sample_period, QUICK_BUILDINGS if quick else TEST_BUILDINGS)
+    api = _experiment_api(sample_period)
+
+    with timer.stage('load') as record:
+        loaded = list(api.load_buildings(train, first_column=True))
+        record['rows'] = sum(len(mains) for _, _, _, mains, _ in loaded)
+
+    with timer.stage('dropna') as record:
+        cleaned = [api.dropna(mains, appliance_readings) for _, _, _, mains, appliance_readings in loaded]
+        record['rows'] = sum(len(mains) for mains, _ in cleaned)
+    del loaded, cleaned
+
+    clf = Seq2Point({'sequence_length': sequence_length, 'n_epochs': n_epochs, 'batch_size': batch_size})
+    with timer.stage('train_jointly') as record:
+        api.train_jointly(clf, train)
+        record['rows'] = sum(len(mains) for mains in api.train_mains)
+
+    chunked_api = _experiment_api(sample_period, chunk_size)
+    chunked_clf = Seq2Point({'sequence_length': sequence_length, 'n_epochs': 1, 'batch_size': batch_size})
+    with timer.stage('train_chunk_wise') as record:
+        chunked_api.train_chunk_wise(chunked_clf, train, 0)
+    chunked_api.close()
+    del chunked_api, chunked_clf
+
+    (_, _, timezone, test_mains, appliance_readings), = list(api.load_buildings(test, mains_ac_type='active'))
+    test_mains, appliance_readings = api.dropna(test_mains, appliance_readings)
+    test_submeters = [(appliance, [reading]) for appliance, reading in zip(APPLIANCES, appliance_readings)]
+    with timer.stage('predict', rows=len(test_mains)):
+        gt_overall, pred_overall = api.predict(clf, [test_mains], test_submeters, sample_period, timezone)
+
+    with timer.stage('score', rows=len(gt_overall)):
+        compute_metrics(gt_overall, {'Seq2Point': pred_overall}, METRICS)
+
+    # The per-appliance pandas path that compute_metrics replaced, for comparison
+    with timer.stage('compute_loss', rows=len(gt_overall)):
+        api.compute_loss(gt_overall, pred_overall, nde)
+
+    api.close()
+    return timer.records
+
+
+def run_convert(sample_period, quick=False):
+    """
+    Times convert_mimos on a copy of the CSV files of one sample period (only the start of every building in quick mode)
+    """
+    from convert_mimos import convert_mimos
+
+    timer = StageTimer(sample_period, None)
+    input_sec = str(sample_period) + '_sec'
+    source = join('data', 'csv_files', input_sec)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        csv_path = join(temp_dir, input_sec)
+        if quick:
+            # Every building is kept, since the metadata describes all of them
+            os.makedirs(csv_path)
+            for file_name in os.listdir(source):
+                pd.read_csv(join(source, file_name), nrows=QUICK_ROWS).to_csv(join(csv_path, file_name), index=False)
+        else:
+            shutil.copytree(source, csv_path)
+        rows = sum(len(pd.read_csv(join(csv_path, file_name), usecols=['UNIX'])) for file_name in os.listdir(csv_path))
+        with timer.stage('convert', rows=rows):
+            convert_mimos(csv_path, join(temp_dir, 'mimos.h5'), input_sec, rebuild=True, resolutions=[])
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return timer.records
+
+
+def _hide_gpus():
+    # Benchmarks run on CPU only, so results are comparable between machines and CI
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+
+def _in_fresh_process(function, *args, **kwargs):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'), initializer=_hide_gpus) as executor:
+        return executor.submit(function, *args, **kwargs).result()
+
+
+def run_benchmarks(quick=False, sample_periods=None, sequence_lengths=None, stages=None, repeat=1):
+    """
+    Runs the benchmark grid and returns one record per stage, sample period and sequence length,
+    with the median time and the highest peak RSS over the repeats.
+    """
+    sample_periods = sample_periods or ([1] if quick else sorted(STORES))
+    sequence_lengths = sequence_lengths or ([99] if quick else SEQUENCE_LENGTHS)
+    stages = stages or STAGES
+
+    runs = []
+    for _ in range(repeat):
+        if 'convert' in stages:
+            for sample_period in sample_periods:
+                runs.extend(_in_fresh_process(run_convert, sample_period, quick))
+        if set(stages) - {'convert'}:
+            for sample_period in sample_periods:
+                for sequence_length in sequence_lengths:
+                    runs.extend(record for record in _in_fresh_process(run_pipeline, sample_period, sequence_length, quick) if record['stage'] in stages)
+
+    results = {}
+    for record in runs:
+        key = (record['stage'], record['sample_period'], record['sequence_length'])
+        results.setdefault(key, []).append(record)
+    return [dict(records[0], seconds=statistics.median(record['seconds'] for record in records), peak_rss_mb=max(record['peak_rss_mb'] for record in records))
+            for records in results.values()]
+
+
+def find_regressions(results, baseline, tolerance=TOLERANCE, min_seconds=MIN_SECONDS, min_rss_mb=MIN_RSS_MB):
+    """
+    Compares benchmark records with the baseline records of the same stage, sample period and sequence length.
+    Returns a list of (record, measure, baseline value, new value) for every time or peak RSS that grew by more than tolerance.
+    """
+    baseline_records = {(record['stage'], record['sample_period'], record['sequence_length']): record for record in baseline}
+    regressions = []
+    for record in results:
+        base = baseline_records.get((record['stage'], record['sample_period'], record['sequence_length']))
+        if base is None:
+            continue
+        for measure, minimum in (('seconds', min_seconds), ('peak_rss_mb', min_rss_mb)):
+            if record[measure] > base[measure] * (1 + tolerance) and record[measure] - base[measure] > minimum:
+                regressions.append((record, measure, base[measure], record[measure]))
+    return regressions
+
+
+def _report(results, quick):
+    return {
+        'created': pd.Timestamp.now().isoformat(),
+        'quick': quick,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the NILM pipeline stages")
+    parser.add_argument('--quick', action='store_true', help="cropped building, 1 second store and sequence length 99 only")
+    parser.add_argument('--sample-periods', type=int, nargs='+', choices=sorted(STORES), help="sample periods to benchmark")
+    parser.add_argument('--sequence-lengths', type=int, nargs='+', help="sequence lengths to benchmark")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, help="stages to benchmark")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per grid point, the median time is reported")
+    parser.add_argument('--output', default='benchmark_results.json', help="where the results are written")
+    parser.add_argument('--baseline', help="results file to compare against")
+    parser.add_argument('--save-baseline', help="also write the results to this baseline file")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="relative growth reported as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.quick, args.sample_periods, args.sequence_lengths, args.stages, args.repeat)
+    for filename in filter(None, [args.output, args.save_baseline]):
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(_report(results, args.quick), f, indent=2)
+    print("Wrote " + str(len(results)) + " results to " + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('quick') != args.quick:
+            print("Warning: the baseline was not recorded in the same mode")
+        regressions = find_regressions(results, baseline['results'], args.tolerance)
+        for record, measure, before, after in regressions:
+            print("REGRESSION {stage} {sample_period}s SL {sequence_length}: ".format(**record) + measure + " " + format(before, '.3f') + " -> " + format(after, '.3f'))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against " + args.baseline)
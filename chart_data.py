@@ -0,0 +1,68 @@
+"""
+Server-side downsampling of time series for the StreamLit charts.
+"""
+import numpy as np
+import pandas as pd
+
+
+class ChartPyramid():
+
+    """
+    Precomputed min/max decimation levels of one time series, so that any time range can be drawn within a point budget with a lookup
+    instead of re-slicing and re-serialising the full-resolution data.
+
+    Level 0 holds the raw samples and every further level merges `factor` buckets of the level below. Each bucket keeps its min and max,
+    which are drawn in the order of the bucket's first and last value, so ON/OFF edges keep their direction.
+    """
+
+    def __init__(self, series, factor=4, min_buckets=64):
+        self.name = series.name
+        values = series.values.astype('float64')
+        self.levels = [(series.index, values, values, values, values)]
+
+        times, mins, maxs, firsts, lasts = self.levels[0]
+        while len(times) > min_buckets:
+            starts = np.arange(0, len(times), factor)
+            ends = np.r_[starts[1:], len(times)]
+            times = times[starts]
+            mins = np.minimum.reduceat(mins, starts)
+            maxs = np.maximum.reduceat(maxs, starts)
+            firsts = firsts[starts]
+            lasts = lasts[ends - 1]
+            self.levels.append((times, mins, maxs, firsts, lasts))
+
+    def get(self, start=None, end=None, max_points=1000):
+        """
+        Returns the series between start and end with at most max_points (at least 2) points, using the finest level that fits the budget
+        """
+        for level, (times, mins, maxs, firsts, lasts) in enumerate(self.levels):
+            window = times.slice_indexer(start, end)
+            count = len(range(*window.indices(len(times))))
+            if level == 0 and count <= max_points:
+                return pd.Series(mins[window], index=times[window], name=self.name)
+            if level > 0 and 2 * count <= max_points:
+                break
+
+        times, mins, maxs, firsts, lasts = times[window], mins[window], maxs[window], firsts[window], lasts[window]
+        if len(times) == 0:
+            return pd.Series([], index=times, name=self.name, dtype='float64')
+
+        if 2 * len(times) > max_points:
+            # Even the coarsest level has too many buckets for the budget, so its buckets are merged further
+            starts = np.arange(0, len(times), -(-len(times) // max(1, max_points // 2)))
+            ends = np.r_[starts[1:], len(times)]
+            times, mins, maxs, firsts, lasts = times[starts], np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts), firsts[starts], lasts[ends - 1]
+
+        # The second point of a bucket sits half way to the next bucket
+        widths = np.diff(times.values)
+        widths = np.r_[widths, widths[-1:] if len(widths) else np.array([0], dtype='timedelta64[ns]')]
+        second_times = times + pd.to_timedelta(widths // 2)
+
+        rising = firsts <= lasts
+        first_values = np.where(rising, mins, maxs)
+        second_values = np.where(rising, maxs, mins)
+
+        index = times.append(second_times)
+        values = np.r_[first_values, second_values]
+        order = np.argsort(np.r_[np.arange(len(times)) * 2, np.arange(len(times)) * 2 + 1], kind='stable')
+        return pd.Series(values[order], index=index[order], name=self.name)
@@ -6,7 +6,12 @@ from os import listdir
 import fnmatch
 import os
 import re
+import shutil
+import hashlib
+import tables
 from sys import stdout
+from tempfile import mkdtemp
+from concurrent.futures import ProcessPoolExecutor
 from nilmtk.utils import get_datastore
 from nilmtk.datastore import Key
 from nilmtk.timeframe import TimeFrame
@@ -15,7 +20,27 @@ from nilmtk.utils import get_module_directory, check_directory_exists
 from nilm_metadata import convert_yaml_to_hdf5, save_yaml_to_datastore
 
 
-def convert_mimos(mimos_path, output_filename, input_sec, format='HDF'):
+# Source files of the MIMOS dataset, one per building
+HOUSE_FILE_PATTERN = re.compile(r'Building_(\d+)\.csv$')
+
+# Columns read from every Building_N.csv, and their dtypes
+USECOLS = ['UNIX', 'Active (W)', 'fridge', 'aircond', 'washing_machine', 'dryer', 'kettle', 'vacuum', 'water_heater', 'oven']
+DTYPES = dict({'UNIX': 'int64'}, **{col: 'float32' for col in USECOLS[1:]})
+
+# Number of CSV rows read at a time
+CHUNKSIZE = 500000
+
+# Coarser resolutions (seconds) computed from the readings in the same pass, and how the readings are aggregated into them
+RESOLUTIONS = (3, 6, 30)
+AGGREGATIONS = ('mean',)
+
+# Root attribute of the HDF5 store holding the conversion manifest. The manifest cannot be a node of its own,
+# since nilmtk treats every node below the root as a building.
+MANIFEST_ATTR = 'mimos_manifest'
+
+
+def convert_mimos(mimos_path, output_filename, input_sec, format='HDF', chunksize=CHUNKSIZE, n_workers=None, complevel=9, complib='blosc', rebuild=False,
+                  resolutions=RESOLUTIONS, aggregations=AGGREGATIONS):
     """
     Parameters
     ----------
@@ -23,18 +48,47 @@ def convert_mimos(mimos_path, output_filename, input_sec, format='HDF'):
         The root path of the MIMOS 1_sec interval dataset.
     output_filename : str
         The destination filename (including path and suffix).
+    input_sec : str
+        Name of the metadata folder to use, e.g. '1_sec'.
     format : str
         format of output. Either 'HDF' or 'CSV'. Defaults to 'HDF'
+    chunksize : int
+        Number of CSV rows read at a time (HDF only).
+    n_workers : int
+        Number of buildings converted in parallel worker processes (HDF only). Defaults to the number of CPUs.
+    complevel : int
+        Compression level of the HDF5 tables, 0 disables compression.
+    complib : str
+        Compression library of the HDF5 tables, e.g. 'blosc', 'zlib' or 'lzo'.
+    rebuild : bool
+        By default an existing HDF5 output is updated incrementally: buildings whose CSV is unchanged are skipped,
+        rows added to the end of a CSV are appended and only other changes re-convert a building.
+        Set to True to convert every building from scratch.
+    resolutions : list of int
+        Sample periods (seconds) of the coarser levels written next to the readings (HDF only), e.g. [3, 6, 30].
+        API loads the matching level instead of resampling the readings. Pass [] to only store the readings.
+    aggregations : list of str
+        How readings are aggregated into each level: 'mean' (used by API), plus optionally 'min' and 'max'.
     """
     
-    # Open DataStore
-    store = get_datastore(output_filename, format, mode='w')
+    if format == 'HDF':
+        # Stream every new or changed building into the store in bounded-size chunks
+        _convert_streaming(mimos_path, output_filename, 'Asia/Kuala_Lumpur', chunksize, n_workers, complevel, complib, rebuild, resolutions, aggregations)
+        store = get_datastore(output_filename, format, mode='a')
+    else:
+        # Open DataStore
+        store = get_datastore(output_filename, format, mode='w')
 
-    # Convert raw data to DataStore
-    _convert(mimos_path, store, 'Asia/Kuala_Lumpur')
+        # Convert raw data to DataStore
+        _convert(mimos_path, store, 'Asia/Kuala_Lumpur')
 
     # Add metadata
     save_yaml_to_datastore(join(os.getcwd(), 'metadata/' + input_sec), store)
+    if format == 'HDF':
+        # Record the levels, so API can load them instead of resampling
+        metadata = store.load_metadata('/')
+        add_resolutions_metadata(metadata, resolutions, aggregations)
+        store.save_metadata('/', metadata)
     store.close()
 
     print("Done converting MIMOS to HDF5 - " + input_sec + "!")
@@ -64,6 +118,378 @@ column_mapping = {
 # }
 
 
+def resolution_location(data_location, period, aggregation='mean'):
+    """
+    Location of the level of a meter aggregated to period seconds, e.g.
+    building1/elec/meter2 -> building1/elec/resolutions/mean_6s/meter2
+    """
+    head, meter = data_location.rsplit('/', 1)
+    return head + '/resolutions/' + aggregation + '_' + str(period) + 's/' + meter
+
+
+def resolution_device_model(device_model, period, aggregation='mean'):
+    """
+    Name of the meter device of a level, e.g. MIMOS_appliance -> MIMOS_appliance_mean_6s
+    """
+    return device_model + '_' + aggregation + '_' + str(period) + 's'
+
+
+def resolution_meter_devices(meter_devices, resolutions, aggregations=AGGREGATIONS):
+    """
+    A copy of every meter device for every level, with the sample period of the level
+    """
+    return {resolution_device_model(model, period, aggregation): dict(device, sample_period=period, max_sample_period=period)
+            for model, device in meter_devices.items() for period in resolutions for aggregation in aggregations}
+
+
+def add_resolutions_metadata(metadata, resolutions, aggregations=AGGREGATIONS):
+    """
+    Records the levels and their meter devices in the dataset metadata, which save_yaml_to_datastore has just written
+    """
+    metadata['resolutions'] = _resolutions_metadata(resolutions, aggregations)
+    meter_devices = metadata.get('meter_devices', {})
+    metadata['meter_devices'] = dict(meter_devices, **resolution_meter_devices(meter_devices, resolutions, aggregations))
+    return metadata
+
+
+def _resolutions_metadata(resolutions, aggregations):
+    return {'periods': sorted(int(period) for period in resolutions), 'aggregations': list(aggregations)}
+
+
+class Resampler():
+
+    """
+    Streaming equivalent of df.resample(period).agg(aggregation).dropna(how='all') over time-sorted chunks.
+    The rows of the last bucket of a chunk are held back until the next chunk, since the bucket may continue there.
+    """
+
+    def __init__(self, period, aggregations):
+        self.period = period
+        self.freq = pd.Timedelta(seconds=period)
+        self.aggregations = list(aggregations)
+        self.pending = None
+
+    def add(self, df):
+        """
+        Returns {aggregation: dataframe} for the buckets completed by this chunk
+        """
+        if self.pending is not None and len(self.pending):
+            df = pd.concat([self.pending, df])
+        if len(df) == 0:
+            return {}
+        buckets = df.index.floor(self.freq)
+        complete = buckets < buckets[-1]
+        self.pending = df[~complete]
+        return self._aggregate(df[complete], buckets[complete])
+
+    def flush(self):
+        """
+        Returns {aggregation: dataframe} for the last bucket
+        """
+        df, self.pending = self.pending, None
+        if df is None or len(df) == 0:
+            return {}
+        return self._aggregate(df, df.index.floor(self.freq))
+
+    def _aggregate(self, df, buckets):
+        if len(df) == 0:
+            return {}
+        grouped = df.groupby(buckets)
+        return {aggregation: grouped.agg(aggregation).dropna(how='all').astype('float32') for aggregation in self.aggregations}
+
+
+def _find_houses(input_path):
+    """
+    Returns the sorted house numbers of all Building_N.csv files in input_path
+    """
+    check_directory_exists(input_path)
+    houses = sorted(int(match.group(1)) for match in map(HOUSE_FILE_PATTERN.match, listdir(input_path)) if match)
+    if not houses:
+        raise RuntimeError('Could not find any Building_N.csv file. Please check the provided folder.')
+    return houses
+
+
+def _convert_streaming(input_path, output_filename, tz, chunksize, n_workers, complevel, complib, rebuild=False, resolutions=(), aggregations=AGGREGATIONS):
+    """
+    Converts every new or changed building in its own worker process into a temporary store, reading the CSV in chunks,
+    then copies (or appends) the results into the output store. Only `chunksize` rows per worker are held in memory.
+
+    The store keeps a manifest with the size, SHA-256, number of rows and time range of every converted CSV,
+    which decides what has to be done for each building on the next run.
+    """
+    houses = _find_houses(input_path)
+    manifest = None if rebuild else _read_manifest(output_filename, _resolutions_metadata(resolutions, aggregations))
+    if manifest is None:
+        mode, manifest = 'w', {}
+    else:
+        mode = 'a'
+
+    # Decide per building whether it is skipped, appended to or converted from scratch
+    jobs = []
+    for house_id in houses:
+        csv_filename = join(input_path, 'Building_' + str(house_id) + '.csv')
+        entry = manifest.get(house_id)
+        job = _plan_building(csv_filename, entry)
+        if job is None:
+            print("Building", house_id, "is up to date")
+        else:
+            jobs.append((house_id, csv_filename) + job)
+    removed = sorted(set(manifest) - set(houses))
+
+    if not jobs and not removed and mode == 'a':
+        return
+
+    n_workers = min(n_workers or os.cpu_count() or 1, max(len(jobs), 1))
+    temp_dir = mkdtemp(dir=os.path.dirname(os.path.abspath(output_filename)))
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = []
+            for house_id, csv_filename, offset, digest, size in jobs:
+                temp_filename = join(temp_dir, 'building' + str(house_id) + '.h5')
+                previous_end = manifest[house_id]['end'] if offset else None
+                # The last buckets of the levels may continue in the appended rows, so their readings are aggregated again
+                tail = _read_tail(output_filename, house_id, previous_end, resolutions, tz) if offset and resolutions else None
+                futures.append(executor.submit(_convert_building, csv_filename, temp_filename, house_id, tz, chunksize, complevel, complib, True,
+                                               offset, previous_end, resolutions, aggregations, tail))
+
+            with tables.open_file(output_filename, mode=mode) as output:
+                for house_id in removed:
+                    print("Removing building", house_id)
+                    if '/building' + str(house_id) in output:
+                        output.remove_node('/building' + str(house_id), recursive=True)
+                    del manifest[house_id]
+                    output.root._v_attrs[MANIFEST_ATTR] = manifest
+
+                # Write the buildings in order, each as soon as its worker has finished
+                for (house_id, csv_filename, offset, digest, size), future in zip(jobs, futures):
+                    temp_filename, stats = future.result()
+                    with tables.open_file(temp_filename, mode='r') as building_store:
+                        if stats['appended']:
+                            print("Appended", stats['rows'], "rows to building", house_id)
+                            _append_building(building_store, output, house_id, chunksize)
+                            stats['rows'] += manifest[house_id]['rows']
+                            stats['start'] = manifest[house_id]['start']
+                        else:
+                            print("Loaded building", house_id, "-", stats['rows'], "rows")
+                            if '/building' + str(house_id) in output:
+                                output.remove_node('/building' + str(house_id), recursive=True)
+                            building_store.copy_node('/building' + str(house_id), newparent=output.root, recursive=True, propindexes=True)
+                    os.remove(temp_filename)
+
+                    # Record the building only once its data is in the store, so an interrupted run is redone next time
+                    manifest[house_id] = {'file': os.path.basename(csv_filename), 'size': size, 'sha256': digest,
+                                          'rows': stats['rows'], 'start': stats['start'], 'end': stats['end']}
+                    output.root._v_attrs[MANIFEST_ATTR] = manifest
+                    output.flush()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _read_manifest(output_filename, resolutions):
+    """
+    Returns the conversion manifest of an existing store, or None if the store has to be rebuilt
+    """
+    if not isfile(output_filename):
+        return None
+    try:
+        with tables.open_file(output_filename, mode='r') as store:
+            manifest = dict(getattr(store.root._v_attrs, MANIFEST_ATTR))
+            metadata = getattr(store.root._v_attrs, 'metadata', {})
+    except Exception:
+        # Not an HDF5 file, or written before manifests were recorded
+        return None
+    if metadata.get('resolutions') != resolutions:
+        # Levels were added or removed
+        return None
+    return manifest
+
+
+def _read_tail(output_filename, house_id, end, resolutions, tz):
+    """
+    Returns the converted readings of a building from the start of the last bucket of the coarsest level on
+    """
+    end = pd.Timestamp(end, unit='s', tz='UTC').tz_convert(tz)
+    start = min(end.floor(pd.Timedelta(seconds=period)) for period in resolutions)
+    columns = {}
+    with pd.HDFStore(output_filename, mode='r') as store:
+        for chan_id, col in enumerate(USECOLS[1:], start=1):
+            columns[col] = store.select(str(Key(building=house_id, meter=chan_id)), where='index >= start').iloc[:, 0]
+    return pd.DataFrame(columns)
+
+
+def _plan_building(csv_filename, entry):
+    """
+    Compares a CSV with its manifest entry.
+
+    Returns None if the building is up to date, else (offset, sha256, size) where offset is the byte
+    position from which rows are appended, or 0 if the building has to be converted from scratch.
+    """
+    size = os.path.getsize(csv_filename)
+    if entry is None or size < entry['size']:
+        return 0, _file_hashes(csv_filename)[0], size
+
+    digest, prefix_digest, ends_with_newline = _file_hashes(csv_filename, entry['size'])
+    if digest == entry['sha256']:
+        return None
+    if prefix_digest == entry['sha256'] and ends_with_newline and entry['rows'] > 0:
+        # Rows were only added to the end of the file
+        return entry['size'], digest, size
+    return 0, digest, size
+
+
+def _file_hashes(filename, prefix_size=0, block_size=2**20):
+    """
+    SHA-256 of the whole file and of its first prefix_size bytes, computed in one pass,
+    and whether the prefix ends with a newline.
+    """
+    digest = hashlib.sha256()
+    last_byte = b''
+    with open(filename, 'rb') as f:
+        remaining = prefix_size
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+            last_byte = block[-1:]
+        prefix_digest = digest.hexdigest()
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest(), prefix_digest, last_byte == b'\n'
+
+
+def _append_building(building_store, output, house_id, chunksize):
+    """
+    Appends the rows of every meter table of a temporary building store to the same table of the output store
+    """
+    for src in building_store.walk_nodes('/building' + str(house_id), classname='Table'):
+        if src._v_pathname not in output:
+            _copy_table_group(src, output)
+            continue
+        dst = output.get_node(src._v_pathname)
+        if src.nrows == 0:
+            continue
+
+        # Buckets of the levels that were aggregated again replace the stored ones
+        first = src.read(0, 1)['index'][0]
+        keep = dst.nrows
+        while keep > 0 and dst.read(keep - 1, keep)['index'][0] >= first:
+            keep -= 1
+        if keep < dst.nrows:
+            dst.remove_rows(keep)
+
+        for start in range(0, src.nrows, chunksize):
+            dst.append(src.read(start, start + chunksize))
+        dst.flush()
+
+
+def _copy_table_group(src, output):
+    """
+    Copies the pandas group of a table that is not in the output yet, e.g. a level that had no readings so far
+    """
+    group = src._v_parent
+    parent_path, name = group._v_parent._v_pathname.rsplit('/', 1)
+    if group._v_parent._v_pathname in output:
+        parent = output.get_node(group._v_parent._v_pathname)
+    else:
+        parent = output.create_group(parent_path or '/', name, createparents=True)
+    group._f_copy(newparent=parent, recursive=True)
+
+
+def _convert_building(csv_filename, temp_filename, nilmtk_house_id, tz, chunksize, complevel, complib, sort_index, offset=0, previous_end=None,
+                      resolutions=(), aggregations=AGGREGATIONS, tail=None):
+    """
+    Streams one Building_N.csv into a compressed table-format store, one table per meter, and aggregates
+    the readings into every resolution on the way.
+    With an offset only the rows from that byte position on are converted, to be appended to the building;
+    if they do not all come after previous_end (UNIX seconds) the whole file is converted instead.
+    tail holds the converted readings of the last, possibly incomplete, buckets of the levels.
+
+    Returns (temp_filename, dict with the number of rows, the first and last UNIX timestamp and whether the rows are to be appended).
+    """
+    keys = [str(Key(building=nilmtk_house_id, meter=chan_id)) for chan_id in range(1, len(USECOLS))]
+    resamplers = [Resampler(period, aggregations) for period in resolutions]
+    n_rows = 0
+    start = end = previous_end
+    is_sorted = True
+    with pd.HDFStore(temp_filename, mode='w', complevel=complevel, complib=complib) as store:
+        if tail is not None:
+            for resampler in resamplers:
+                append_levels(store, keys, resampler, resampler.add(tail))
+
+        for df in _load_csv(csv_filename, USECOLS, tz, chunksize=chunksize, offset=offset):
+            if len(df) == 0:
+                continue
+            first, last = int(df.index[0].timestamp()), int(df.index[-1].timestamp())
+            if not df.index.is_monotonic_increasing or (end is not None and first <= end):
+                is_sorted = False
+                if offset:
+                    break
+            if n_rows == 0:
+                start = first
+            end = last if end is None else max(end, last)
+            n_rows += len(df)
+            for key, col in zip(keys, df.columns):
+                store.append(key, channel_df(df, col), format='table', index=False)
+            if is_sorted:
+                for resampler in resamplers:
+                    append_levels(store, keys, resampler, resampler.add(df))
+
+        if offset and not is_sorted:
+            print("New rows of building", nilmtk_house_id, "overlap the converted ones, converting it from scratch")
+        elif sort_index and not is_sorted:
+            # might not be sorted... this is the only case where a whole meter is loaded at once
+            print("Building", nilmtk_house_id, "is not sorted by time, sorting it in memory")
+            df = pd.concat([store.select(key).iloc[:, 0].rename(col) for key, col in zip(keys, USECOLS[1:])], axis=1).sort_index()
+            for key, col in zip(keys, df.columns):
+                store.put(key, channel_df(df, col), format='table', index=False)
+            for period in resolutions:
+                for aggregation in aggregations:
+                    for key in keys:
+                        if resolution_location(key, period, aggregation) in store:
+                            store.remove(resolution_location(key, period, aggregation))
+            resamplers = [Resampler(period, aggregations) for period in resolutions]
+            for resampler in resamplers:
+                append_levels(store, keys, resampler, resampler.add(df))
+
+        if not (offset and not is_sorted):
+            for resampler in resamplers:
+                append_levels(store, keys, resampler, resampler.flush())
+            for key in keys:
+                for location in [key] + [resolution_location(key, period, aggregation) for period in resolutions for aggregation in aggregations]:
+                    if location in store:
+                        store.create_table_index(location, columns=['index'], kind='full', optlevel=9)
+
+    if offset and not is_sorted:
+        return _convert_building(csv_filename, temp_filename, nilmtk_house_id, tz, chunksize, complevel, complib, sort_index,
+                                 resolutions=resolutions, aggregations=aggregations)
+    return temp_filename, {'rows': n_rows, 'start': start, 'end': end, 'appended': bool(offset)}
+
+
+def append_levels(store, keys, resampler, levels):
+    """
+    Appends the levels returned by resampler.add / resampler.flush to the tables of the meters at keys
+    """
+    for aggregation, level in levels.items():
+        if len(level) == 0:
+            continue
+        for key, col in zip(keys, level.columns):
+            store.append(resolution_location(key, resampler.period, aggregation), channel_df(level, col), format='table', index=False)
+
+
+def channel_df(df, col):
+    """
+    One column of the readings as a meter table, with the nilmtk (physical quantity, type) column labels
+    """
+    chan_df = pd.DataFrame(df[col])
+    chan_df.columns = pd.MultiIndex.from_tuples([column_mapping[x] for x in chan_df.columns])
+
+    # Modify the column labels to reflect the power measurements recorded.
+    chan_df.columns.set_names(LEVEL_NAMES, inplace=True)
+    return chan_df
+
+
 def _convert(input_path, store, tz, sort_index=True):
     """
     Parameters
@@ -82,24 +508,18 @@ def _convert(input_path, store, tz, sort_index=True):
     sort_index : bool
     """
 
-    check_directory_exists(input_path)
-
     # Iterate though all buildings
-    houses = [1,2,3,4,5,6,7]
-    nilmtk_house_id = 0
+    houses = _find_houses(input_path)
     
     for house_id in houses:
-        nilmtk_house_id += 1
+        nilmtk_house_id = house_id
         print("Loading building", house_id, end="... ")
         stdout.flush()
         csv_filename = join(input_path, 'Building_' + str(house_id) + '.csv')
            
         if not exists(csv_filename):
             raise RuntimeError('Could not find the file. Please check the provided folder.')
-#         usecols = ['UNIX', 'Apparent (VA)', 'Active (W)', 'fridge', 'aircond', 'washing_machine', 'dryer', 'kettle', 'vacuum', 'water_heater', 'oven']
-        usecols = ['UNIX', 'Active (W)', 'fridge', 'aircond', 'washing_machine', 'dryer', 'kettle', 'vacuum', 'water_heater', 'oven']
-        
-        df = _load_csv(csv_filename, usecols, tz)
+        df = _load_csv(csv_filename, USECOLS, tz)
         if sort_index:
             df = df.sort_index() # might not be sorted...
         chan_id = 0
@@ -108,36 +528,49 @@ def _convert(input_path, store, tz, sort_index=True):
             print(chan_id, end=" ")
             stdout.flush()
             key = Key(building=nilmtk_house_id, meter=chan_id)
-            
-            chan_df = pd.DataFrame(df[col])
-            chan_df.columns = pd.MultiIndex.from_tuples([column_mapping[x] for x in chan_df.columns])
-            
-            # Modify the column labels to reflect the power measurements recorded.
-            chan_df.columns.set_names(LEVEL_NAMES, inplace=True)
-            
-            store.put(str(key), chan_df)
+            store.put(str(key), channel_df(df, col))
             
         print('')
 
 
-def _load_csv(filename, usecols, tz):
+def _load_csv(filename, usecols, tz, chunksize=None, offset=0):
     """
     Parameters
     ----------
     filename : str
     usecols : list of columns to keep
     tz : str e.g. 'US/Eastern'
+    chunksize : int, optional
+        If given, the file is read in chunks of this many rows.
+    offset : int
+        Byte position of the first row to read, 0 reads the whole file. Requires chunksize.
 
     Returns
     -------
-    dataframe
+    dataframe, or an iterator of dataframes if chunksize is given
     """
-    # Load data
-    df = pd.read_csv(filename, usecols=usecols)
-    
+    # Load data with explicit dtypes and the C parser
+    dtype = {col: DTYPES[col] for col in usecols if col in DTYPES}
+    if offset:
+        return _load_csv_from(filename, usecols, dtype, tz, chunksize, offset)
+    if chunksize is None:
+        return _index_by_time(pd.read_csv(filename, usecols=usecols, dtype=dtype, engine='c'), tz)
+    return (_index_by_time(df, tz) for df in pd.read_csv(filename, usecols=usecols, dtype=dtype, engine='c', chunksize=chunksize))
+
+
+def _load_csv_from(filename, usecols, dtype, tz, chunksize, offset):
+    # The header is only at the start of the file
+    names = pd.read_csv(filename, nrows=0).columns.tolist()
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for df in pd.read_csv(f, header=None, names=names, usecols=usecols, dtype=dtype, engine='c', chunksize=chunksize):
+            yield _index_by_time(df, tz)
+
+
+def _index_by_time(df, tz):
     # Convert the integer index column to timezone-aware datetime 
     df['UNIX'] = pd.to_datetime(df['UNIX'], unit='s', utc=True)
     df.set_index('UNIX', inplace=True)
     df = df.tz_convert(tz)
     
-    return df
\ No newline at end of file
+    return df
@@ -0,0 +1,100 @@
+"""
+Lightweight validation of NILMTK HDF5 files.
+
+Only the HDF5 node layout and the metadata stored by nilm_metadata are read, so no nilmtk DataSet, buildings or MeterGroups are built.
+"""
+import re
+import hashlib
+import pandas as pd
+
+
+class H5ValidationError(Exception):
+
+    """
+    Raised for an invalid HDF5 file. errors maps each building number (None for problems with the whole file) to its error messages.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        lines = ["Invalid HDF5 file format. Please upload a valid file."]
+        for messages in errors.values():
+            lines.extend(messages)
+        super().__init__("\n".join(lines))
+
+
+def find_h5_errors(filename):
+    """
+    Checks that every building has metadata, that the data of every meter is present and that
+    the mains and all sub-meters only measure active power, as required by the trained models.
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    dict of building number (None for the whole file) -> list of error messages. Empty if the file is valid.
+    """
+    try:
+        store = pd.HDFStore(filename, mode='r')
+    except Exception:
+        return {None: ["The file could not be opened as an HDF5 file."]}
+
+    with store:
+        dataset_metadata = getattr(store.root._v_attrs, 'metadata', None)
+        if dataset_metadata is None:
+            return {None: ["The file does not contain NILMTK dataset metadata."]}
+
+        buildings = sorted(int(name[len('building'):]) for name in store.root._v_children if re.match(r'building\d+$', name))
+        if not buildings:
+            return {None: ["The file does not contain any buildings."]}
+
+        errors = {}
+        meter_devices = dataset_metadata.get('meter_devices', {})
+        for building in buildings:
+            building_errors = _building_errors(store, building, meter_devices)
+            if building_errors:
+                errors[building] = building_errors
+        return errors
+
+
+def _building_errors(store, building, meter_devices):
+    metadata = getattr(store.get_node('/building' + str(building))._v_attrs, 'metadata', None)
+    if metadata is None:
+        return [f"Building {building} does not contain any metadata."]
+    elec_meters = metadata.get('elec_meters', {})
+    if not elec_meters:
+        return [f"Building {building} does not contain any meters."]
+
+    errors = []
+    mains_types = set()
+    submeter_types = set()
+    for meter_id, meter in elec_meters.items():
+        data_location = meter.get('data_location', f'building{building}/elec/meter{meter_id}')
+        if store.get_node('/' + data_location.lstrip('/')) is None:
+            errors.append(f"The readings of meter {meter_id} in building {building} are missing.")
+
+        # The same power types nilmtk reports through available_ac_types('power')
+        device = meter_devices.get(meter.get('device_model'), {})
+        ac_types = {measurement.get('type') for measurement in device.get('measurements', []) if measurement.get('physical_quantity') == 'power'}
+        if meter.get('site_meter'):
+            mains_types |= ac_types
+        else:
+            submeter_types |= ac_types
+
+    if mains_types != {'active'}:
+        errors.append(f"The power type for main meter in building {building} should be Active(W) only.")
+    if submeter_types != {'active'}:
+        errors.append(f"The power type for all appliances (sub-meters) in building {building} should be Active(W) only.")
+    return errors
+
+
+def file_digest(filename, block_size=2**20):
+    """
+    SHA-256 of the file contents, read in blocks
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,267 @@
+"""
+Local HTTP inference service for many meters, with only the standard library (asyncio) around a trained model.
+
+Clients post mains readings of their meter, which make one window per reading. Requests of all meters are grouped into
+one batched forward pass per appliance network, bounded by max_batch windows and max_wait seconds, and requests are
+rejected with 503 once max_queue windows are waiting, e.g.
+
+python inference_server.py trained_models/1sec_99SL --port 8080 --cpu
+
+POST /disaggregate  {"meter": "house-1", "mains": [readings]}, at least sequence_length readings. Every reading gets the
+                    power and ON/OFF state of every appliance that disaggregate_chunk gives it for the same readings:
+                    the readings are padded with zeros and windowed like there (see streaming.window_estimates).
+GET  /stats         throughput, batch sizes, queue depth and latency.
+
+load_generator.py benchmarks a running server.
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from metrics import F1_THRESHOLD
+from streaming import predict_windows, chunk_windows, window_estimates
+
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+# Latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 10000
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class InferenceServer():
+
+    """
+    Parameters
+    ----------
+    clf : trained Seq2Point or Seq2Seq classifier, e.g. from model_bundle.import_model(...).classifiers
+    max_batch : int
+        Windows run through the networks at once. A single larger request runs in a batch of its own.
+    max_wait : float
+        Seconds the oldest request may wait for a batch to fill up.
+    max_queue : int
+        Windows allowed to wait. Requests beyond it are answered with 503 (backpressure).
+    thresholds : dict of appliance -> ON threshold (W), defaults to the F1 score threshold
+    """
+
+    def __init__(self, clf, max_batch=256, max_wait=0.01, max_queue=8192, thresholds=None):
+        self.clf = clf
+        self.appliances = list(clf.models)
+        self.sequence_length = clf.sequence_length
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.thresholds = np.array([(thresholds or {}).get(appliance, F1_THRESHOLD) for appliance in self.appliances], dtype='float32')
+        self.means = np.array([clf.appliance_params[appliance]['mean'] for appliance in self.appliances], dtype='float32')
+        self.stds = np.array([clf.appliance_params[appliance]['std'] for appliance in self.appliances], dtype='float32')
+        # (windows, future, arrival time) of the waiting requests
+        self.queue = collections.deque()
+        self.queued_windows = 0
+        # One forward pass at a time, outside the event loop so requests keep being accepted meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.counts = collections.Counter()
+        self.max_queue_depth = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.started = time.perf_counter()
+        self.wakeup = None
+
+    async def disaggregate(self, mains):
+        """
+        Returns the (power, on) estimates of every reading, once its batch has run
+        """
+        windows = chunk_windows(mains, self.sequence_length)
+        if self.queued_windows + len(windows) > self.max_queue:
+            self.counts['rejected'] += 1
+            raise HTTPError(503, 'Too many windows waiting, retry later')
+
+        future = asyncio.get_event_loop().create_future()
+        self.queue.append((windows, future, time.perf_counter()))
+        self.queued_windows += len(windows)
+        self.max_queue_depth = max(self.max_queue_depth, self.queued_windows)
+        self.wakeup.set()
+        return await future
+
+    async def batcher(self):
+        """
+        Groups the waiting requests into batches and runs them, forever
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.wakeup.wait()
+            if not self.queue:
+                self.wakeup.clear()
+                continue
+            # Wait for the batch to fill up, at most max_wait after the oldest request arrived
+            deadline = self.queue[0][2] + self.max_wait
+            while self.queued_windows < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = []
+            n_windows = 0
+            while self.queue and (not batch or n_windows + len(self.queue[0][0]) <= self.max_batch):
+                request = self.queue.popleft()
+                batch.append(request)
+                n_windows += len(request[0])
+            self.queued_windows -= n_windows
+            if not self.queue:
+                self.wakeup.clear()
+
+            try:
+                outputs = await loop.run_in_executor(self.executor, predict_windows, self.clf, self.appliances, np.concatenate([windows for windows, future, arrival in batch]))
+            except Exception as e:
+                for windows, future, arrival in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.counts['batches'] += 1
+            self.counts['windows'] += n_windows
+            done = time.perf_counter()
+            offset = 0
+            for windows, future, arrival in batch:
+                output = outputs[offset:offset + len(windows)]
+                offset += len(windows)
+                self.latencies.append(done - arrival)
+                if not future.done():
+                    future.set_result(self._estimates(output))
+
+    def _estimates(self, output):
+        normalised = window_estimates(output)[0]
+        power = np.maximum(self.means + normalised * self.stds, 0)
+        return power, power > self.thresholds
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'sequence_length': self.sequence_length,
+            'appliances': self.appliances,
+            'uptime_s': elapsed,
+            'requests': self.counts['requests'],
+            'rejected': self.counts['rejected'],
+            'windows': self.counts['windows'],
+            'batches': self.counts['batches'],
+            'requests_per_s': self.counts['requests'] / elapsed,
+            'windows_per_s': self.counts['windows'] / elapsed,
+            'mean_batch_windows': self.counts['windows'] / self.counts['batches'] if self.counts['batches'] else 0,
+            'queue_depth': self.queued_windows,
+            'queued_requests': len(self.queue),
+            'max_queue_depth': self.max_queue_depth,
+            'p50_latency_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_latency_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+    async def route(self, method, path, body):
+        if path == '/stats':
+            if method != 'GET':
+                raise HTTPError(405, 'Use GET')
+            return self.stats()
+        if path != '/disaggregate':
+            raise HTTPError(404, 'Unknown path ' + path)
+        if method != 'POST':
+            raise HTTPError(405, 'Use POST')
+
+        try:
+            request = json.loads(body)
+            mains = np.asarray(request['mains'], dtype='float32')
+        except (ValueError, TypeError, KeyError):
+            raise HTTPError(400, 'The body must be JSON with the mains readings, {"meter": ..., "mains": [...]}')
+        if mains.ndim != 1 or len(mains) < self.sequence_length or not np.isfinite(mains).all():
+            raise HTTPError(400, 'mains must hold at least ' + str(self.sequence_length) + ' finite readings')
+        if len(mains) > self.max_queue:
+            raise HTTPError(413, 'A request may hold at most ' + str(self.max_queue) + ' readings')
+
+        power, on = await self.disaggregate(mains)
+        self.counts['requests'] += 1
+        return {'meter': request.get('meter'), 'appliances': self.appliances,
+                'power': np.round(power, 2).tolist(), 'on': on.astype(int).tolist()}
+
+    async def handle(self, reader, writer):
+        """
+        Serves the HTTP/1.1 requests of one keep-alive connection
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                extra_headers = ''
+                try:
+                    status, payload = 200, await self.route(method, path.split('?')[0], body)
+                except HTTPError as e:
+                    status, payload = e.status, {'error': str(e)}
+                    if e.status == 503:
+                        extra_headers = 'Retry-After: 1\r\n'
+                data = json.dumps(payload).encode()
+                writer.write(('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n'
+                              .format(status, HTTP_REASONS[status], len(data), extra_headers)).encode() + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        self.wakeup = asyncio.Event()
+        self.started = time.perf_counter()
+        batcher = asyncio.ensure_future(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving", type(self.clf).__name__, "for", len(self.appliances), "appliances on http://" + host + ":" + str(port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a trained model over HTTP with micro-batching")
+    parser.add_argument('model', help="model bundle folder or pickled model")
+    parser.add_argument('--classifier', help="name of the classifier, defaults to the first one")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=256, help="windows run through the networks at once")
+    parser.add_argument('--max-wait', type=float, default=0.01, help="seconds a request may wait for a batch")
+    parser.add_argument('--max-queue', type=int, default=8192, help="windows allowed to wait before requests are rejected")
+    parser.add_argument('--cpu', action='store_true', help="hide the GPUs from TensorFlow")
+    args = parser.parse_args()
+
+    if args.cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    from model_bundle import import_model
+    model = import_model(args.model)
+    clf = dict(model.classifiers)[args.classifier] if args.classifier else model.classifiers[0][1]
+    try:
+        asyncio.run(InferenceServer(clf, args.max_batch, args.max_wait, args.max_queue).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
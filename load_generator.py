@@ -0,0 +1,109 @@
+"""
+Load generator for inference_server.py.
+
+Every simulated meter keeps one connection open and posts windows of mains readings back to back, taken from a converted
+MIMOS file or drawn at random, e.g.
+
+python load_generator.py --meters 200 --requests 50 --path data/mimos_1_sec.h5
+"""
+import json
+import time
+import asyncio
+import argparse
+import collections
+import numpy as np
+import pandas as pd
+
+
+async def _request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                  .format(method, path, len(body))).encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+
+async def get_stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        status, stats = await _request(reader, writer, 'GET', '/stats')
+    finally:
+        writer.close()
+    return stats
+
+
+async def _meter(host, port, meter, mains, window_readings, n_requests, results):
+    reader, writer = await asyncio.open_connection(host, port)
+    rng = np.random.default_rng(meter)
+    try:
+        for i in range(n_requests):
+            start = int(rng.integers(len(mains) - window_readings + 1))
+            payload = {'meter': meter, 'mains': np.round(mains[start:start + window_readings], 2).tolist()}
+            sent = time.perf_counter()
+            status, response = await _request(reader, writer, 'POST', '/disaggregate', payload)
+            results[status].append(time.perf_counter() - sent)
+            if status == 503:
+                # Backpressure: back off before the next request
+                await asyncio.sleep(0.05)
+    finally:
+        writer.close()
+
+
+def load_mains(path, building=1, rows=100000):
+    """
+    The first mains readings of a building of a converted MIMOS file
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        df = store.select('/building' + str(building) + '/elec/meter1', stop=rows)
+    return df.iloc[:, 0].fillna(0).values.astype('float32')
+
+
+async def run_load(host='127.0.0.1', port=8080, n_meters=100, n_requests=20, windows_per_request=1, mains=None):
+    """
+    Returns the client side results: requests per status code, requests per second and latency percentiles
+    """
+    stats = await get_stats(host, port)
+    # The server makes one window of every reading, and takes at least sequence_length readings per request
+    window_readings = max(stats['sequence_length'], windows_per_request)
+    if mains is None:
+        mains = np.random.default_rng(0).gamma(1.5, 400, size=100000).astype('float32')
+
+    results = collections.defaultdict(list)
+    started = time.perf_counter()
+    await asyncio.gather(*[_meter(host, port, meter, mains, window_readings, n_requests, results) for meter in range(n_meters)])
+    seconds = time.perf_counter() - started
+
+    latencies = np.array(results.get(200, [np.nan])) * 1000
+    return {
+        'requests': {status: len(times) for status, times in results.items()},
+        'seconds': seconds,
+        'requests_per_s': len(results.get(200, [])) / seconds,
+        'windows_per_s': len(results.get(200, [])) * window_readings / seconds,
+        'p50_latency_ms': float(np.percentile(latencies, 50)),
+        'p99_latency_ms': float(np.percentile(latencies, 99)),
+        'server': await get_stats(host, port),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a running inference_server.py")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--meters', type=int, default=100, help="concurrent meters, one connection each")
+    parser.add_argument('--requests', type=int, default=20, help="requests per meter")
+    parser.add_argument('--windows', type=int, default=1, help="windows (readings) per request, at least the sequence length of the model")
+    parser.add_argument('--path', help="converted MIMOS file the mains windows are taken from, random readings if not given")
+    parser.add_argument('--building', type=int, default=1)
+    args = parser.parse_args()
+
+    mains = load_mains(args.path, args.building) if args.path else None
+    results = asyncio.run(run_load(args.host, args.port, args.meters, args.requests, args.windows, mains))
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,119 @@
+"""
+Vectorized versions of the nilmtk.losses metrics.
+
+Every metric takes the ground truth, the predictions and their difference as (n_samples x n_appliances) arrays
+and returns one value per appliance, so all appliances of a classifier are scored in a single pass.
+"""
+import numpy as np
+import pandas as pd
+
+
+# Same ON threshold (W) as nilmtk.losses.f1score
+F1_THRESHOLD = 10
+
+
+def mae(gt, pred, diff):
+    return np.mean(np.abs(diff), axis=0, dtype=np.float64)
+
+
+def rmse(gt, pred, diff):
+    return np.sqrt(np.mean(np.square(diff, dtype=np.float64), axis=0))
+
+
+def f1score(gt, pred, diff):
+    gt_on = gt >= F1_THRESHOLD
+    pred_on = pred >= F1_THRESHOLD
+    true_positives = np.count_nonzero(gt_on & pred_on, axis=0)
+    denominator = np.count_nonzero(gt_on, axis=0) + np.count_nonzero(pred_on, axis=0)
+    # sklearn returns 0 when there are no positive samples at all
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, 2.0 * true_positives / denominator, 0.0)
+
+
+def relative_error(gt, pred, diff):
+    return np.mean(np.abs(diff) / (1 + pred), axis=0, dtype=np.float64)
+
+
+def r2score(gt, pred, diff):
+    residual = np.sum(np.square(diff, dtype=np.float64), axis=0)
+    total = np.sum(np.square(gt - gt.mean(axis=0, dtype=np.float64)), axis=0)
+    # Same convention as sklearn for constant ground truth
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = 1 - residual / total
+    return np.where(total > 0, score, np.where(residual > 0, 0.0, 1.0))
+
+
+def nep(gt, pred, diff):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(np.abs(diff), axis=0, dtype=np.float64) / np.sum(gt, axis=0, dtype=np.float64)
+
+
+VECTORIZED_METRICS = {
+    'mae': mae,
+    'rmse': rmse,
+    'f1score': f1score,
+    'relative_error': relative_error,
+    'r2score': r2score,
+    'nep': nep,
+}
+
+
+def compute_metrics(gt_overall, pred_overall, metrics):
+    """
+    Scores every classifier on every appliance for all the requested metrics.
+
+    Parameters
+    ----------
+    gt_overall : pd.DataFrame
+        Ground truth, one column per appliance.
+    pred_overall : dict
+        Classifier name -> pd.DataFrame of predictions with the same rows as gt_overall.
+    metrics : list of str
+        Names of nilmtk.losses metrics. Metrics without a vectorized version fall back to the nilmtk function per appliance.
+
+    Returns
+    -------
+    pd.DataFrame with the columns metric, classifier, appliance and value. Unsupported metrics have no rows.
+    """
+    appliances = list(gt_overall.columns)
+    gt = gt_overall.values
+    fallbacks = {}
+    for metric in metrics:
+        if metric not in VECTORIZED_METRICS:
+            loss_function = _nilmtk_loss(metric)
+            if loss_function is not None:
+                fallbacks[metric] = loss_function
+
+    rows = {'metric': [], 'classifier': [], 'appliance': [], 'value': []}
+    for clf_name, clf_pred in pred_overall.items():
+        pred = clf_pred[appliances].values
+        # The difference is shared by every error based metric of this classifier
+        diff = pred - gt
+        for metric in metrics:
+            if metric in VECTORIZED_METRICS:
+                values = VECTORIZED_METRICS[metric](gt, pred, diff)
+            elif metric in fallbacks:
+                values = [fallbacks[metric](gt_overall[app_name], clf_pred[app_name]) for app_name in appliances]
+            else:
+                continue
+            rows['metric'].extend([metric] * len(appliances))
+            rows['classifier'].extend([clf_name] * len(appliances))
+            rows['appliance'].extend(appliances)
+            rows['value'].extend(np.asarray(values, dtype=np.float64))
+    return pd.DataFrame(rows)
+
+
+def metric_table(results, metric, classifiers, appliances):
+    """
+    Returns the appliances x classifiers table of one metric, in the layout stored in API.errors
+    """
+    table = results[results['metric'] == metric].pivot(index='appliance', columns='classifier', values='value')
+    table = table.reindex(index=appliances, columns=classifiers)
+    table.index.name = None
+    table.columns.name = None
+    return table
+
+
+def _nilmtk_loss(metric):
+    import nilmtk.losses
+    return getattr(nilmtk.losses, metric, None)
@@ -0,0 +1,158 @@
+import os
+import re
+import sys
+import json
+import pickle
+import importlib
+from os.path import join, isdir, isfile
+from collections.abc import Mapping
+
+
+# Version of the on-disk layout, bumped whenever the manifest changes incompatibly
+BUNDLE_VERSION = 1
+MANIFEST_NAME = 'bundle.json'
+
+
+class LazyNetworks(Mapping):
+
+    """
+    Appliance -> Keras network mapping that loads each network from disk the first time it is used.
+    Seq2Point and Seq2Seq only look networks up by appliance name, so they can use it in place of clf.models.
+    """
+
+    def __init__(self, files):
+        self.files = dict(files)
+        self.loaded = {}
+
+    def __getitem__(self, appliance):
+        if appliance not in self.loaded:
+            from tensorflow.keras.models import load_model
+            # Inference only, so the optimiser state does not need to be restored
+            self.loaded[appliance] = load_model(self.files[appliance], compile=False)
+        return self.loaded[appliance]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getstate__(self):
+        return {'files': self.files, 'loaded': {}}
+
+
+def export_bundle(model, path):
+    """
+    Writes a trained API object as a model bundle: one Keras file per classifier and appliance
+    plus a manifest with the normalisation stats, appliances, sample period and sequence lengths.
+
+    Parameters
+    ----------
+    model : API
+        A trained API object, e.g. the one returned by API(experiment) or an unpickled model.
+    path : str
+        Destination directory of the bundle.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = {
+        'version': BUNDLE_VERSION,
+        'sample_period': model.sample_period,
+        'appliances': list(model.appliances),
+        'power': model.power,
+        'metrics': list(model.metrics),
+        'DROP_ALL_NANS': model.DROP_ALL_NANS,
+        'classifiers': [],
+    }
+
+    for name, clf in model.classifiers:
+        networks = {}
+        os.makedirs(join(path, _file_name(name)), exist_ok=True)
+        for appliance in clf.models:
+            file_name = join(_file_name(name), _file_name(appliance) + '.h5')
+            clf.models[appliance].save(join(path, file_name))
+            networks[appliance] = file_name
+
+        manifest['classifiers'].append({
+            'name': name,
+            'module': type(clf).__module__,
+            'class': type(clf).__name__,
+            'params': {key: getattr(clf, key) for key in ('sequence_length', 'n_epochs', 'batch_size') if hasattr(clf, key)},
+            'mains_mean': float(clf.mains_mean),
+            'mains_std': float(clf.mains_std),
+            'appliance_params': {appliance: {'mean': float(stats['mean']), 'std': float(stats['std'])} for appliance, stats in clf.appliance_params.items()},
+            'networks': networks,
+        })
+
+    with open(join(path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print("Exported model bundle to " + path)
+
+
+def load_bundle(path):
+    """
+    Rebuilds an inference-only API object from a model bundle. No training data is loaded,
+    and every appliance network is only read from disk when it is first used for a prediction.
+
+    Parameters
+    ----------
+    path : str
+        Directory written by export_bundle.
+
+    Returns
+    -------
+    API object on which test_jointly / test_chunk_wise can be called.
+    """
+    from api import API
+
+    manifest_path = join(path, MANIFEST_NAME)
+    if not isfile(manifest_path):
+        raise RuntimeError('Could not find ' + MANIFEST_NAME + ' in ' + path + '. Please check the provided folder.')
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != BUNDLE_VERSION:
+        raise RuntimeError('Unsupported model bundle version ' + str(manifest.get('version')) + ', expected ' + str(BUNDLE_VERSION))
+
+    methods = {}
+    for entry in manifest['classifiers']:
+        clf_class = getattr(importlib.import_module(entry['module']), entry['class'])
+        clf = clf_class(dict(entry['params']))
+        clf.mains_mean = entry['mains_mean']
+        clf.mains_std = entry['mains_std']
+        clf.appliance_params = entry['appliance_params']
+        clf.models = LazyNetworks({appliance: join(path, file_name) for appliance, file_name in entry['networks'].items()})
+        # API skips training for classifiers that load a pretrained model
+        clf.load_model_path = path
+        methods[entry['name']] = clf
+
+    return API({
+        'power': manifest['power'],
+        'sample_rate': manifest['sample_period'],
+        'appliances': manifest['appliances'],
+        'methods': methods,
+        'DROP_ALL_NANS': manifest['DROP_ALL_NANS'],
+        'train': {'datasets': {}},
+        'test': {'datasets': {}, 'metrics': manifest['metrics']},
+    })
+
+
+def import_model(filename):
+    """
+    Loads a model bundle directory, or a pickled API object for older exports
+    """
+    if isdir(filename):
+        return load_bundle(filename)
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def _file_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(name))
+
+
+if __name__ == "__main__":
+    # Converts a pickled API object into a bundle, e.g.
+    # python model_bundle.py trained_models/1sec_99SL.pickle trained_models/1sec_99SL
+    if len(sys.argv) != 3:
+        print("Usage: python model_bundle.py MODEL.pickle BUNDLE_DIRECTORY")
+        sys.exit(1)
+    export_bundle(import_model(sys.argv[1]), sys.argv[2])
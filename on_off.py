@@ -0,0 +1,120 @@
+"""
+ON/OFF state detection for predicted (or measured) appliance power.
+
+Used by the StreamLit application and classification_accuracy.ipynb.
+"""
+import numpy as np
+
+
+def two_cluster_threshold(values, bins=1024, max_iter=100):
+    """
+    Splits the values into an OFF and an ON cluster (1-D k-means with k=2) and returns the midpoint between the two centroids,
+    the same threshold the notebooks used to get from sklearn's KMeans.
+
+    The Lloyd iterations run on a histogram of the values, so the cost is O(n) for the histogram plus O(bins) per iteration.
+
+    Parameters
+    ----------
+    values : array-like of power readings
+    bins : int
+        Histogram resolution. The split between the clusters is exact up to one bin.
+    max_iter : int
+
+    Returns
+    -------
+    float
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return 0.0
+    low, high = values.min(), values.max()
+    if low == high:
+        return float(low)
+
+    counts, edges = np.histogram(values, bins=bins, range=(low, high))
+    sums, _ = np.histogram(values, bins=edges, weights=values)
+    cum_counts = np.cumsum(counts)
+    cum_sums = np.cumsum(sums)
+
+    # Mean of every bin; empty bins take the mean of the previous bin so the means stay sorted
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bin_means = np.where(counts > 0, sums / counts, -np.inf)
+    bin_means = np.maximum.accumulate(bin_means)
+
+    threshold = (low + high) / 2
+    split = None
+    for _ in range(max_iter):
+        # Bins [0, new_split) belong to the OFF cluster
+        new_split = int(np.clip(np.searchsorted(bin_means, threshold, side='right'), 1, bins - 1))
+        if new_split == split:
+            break
+        split = new_split
+        off_count = cum_counts[split - 1]
+        on_count = cum_counts[-1] - off_count
+        if off_count == 0 or on_count == 0:
+            break
+        off_centroid = cum_sums[split - 1] / off_count
+        on_centroid = (cum_sums[-1] - cum_sums[split - 1]) / on_count
+        threshold = (off_centroid + on_centroid) / 2
+    return float(threshold)
+
+
+def on_off_states(values, threshold=None, hysteresis=0.0, min_on=1, min_off=1):
+    """
+    Turns power readings into ON/OFF states.
+
+    Parameters
+    ----------
+    values : array-like of power readings
+    threshold : float, optional
+        Defaults to two_cluster_threshold(values).
+    hysteresis : float
+        Width (W) of the band around the threshold in which the previous state is kept.
+        The appliance turns ON above threshold + hysteresis and OFF below threshold - hysteresis.
+    min_on : int
+        ON periods shorter than this many samples are dropped.
+    min_off : int
+        OFF gaps shorter than this many samples between two ON periods are filled.
+
+    Returns
+    -------
+    np.ndarray of bool, one state per reading
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if threshold is None:
+        threshold = two_cluster_threshold(values)
+
+    if hysteresis > 0:
+        turns_on = values > threshold + hysteresis
+        decided = turns_on | (values < threshold - hysteresis)
+        # Every reading takes the state of the last reading outside the hysteresis band
+        last_decided = np.where(decided, np.arange(len(values)), -1)
+        np.maximum.accumulate(last_decided, out=last_decided)
+        states = (last_decided >= 0) & turns_on[np.maximum(last_decided, 0)]
+    else:
+        states = values > threshold
+
+    states = _drop_short_runs(states, False, min_off)
+    states = _drop_short_runs(states, True, min_on)
+    return states
+
+
+def _drop_short_runs(states, state, min_length):
+    """
+    Flips every run of the given state that is shorter than min_length samples.
+    OFF runs at the start and the end are not gaps between two ON periods, so they are kept.
+    """
+    if min_length <= 1 or len(states) == 0:
+        return states
+    starts = np.r_[0, np.flatnonzero(states[1:] != states[:-1]) + 1]
+    lengths = np.diff(np.r_[starts, len(states)])
+    short = (states[starts] == state) & (lengths < min_length)
+    if not state:
+        short[0] = False
+        short[-1] = False
+    if not short.any():
+        return states
+    states = states.copy()
+    states[np.repeat(short, lengths)] = not state
+    return states
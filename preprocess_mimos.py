@@ -0,0 +1,218 @@
+"""
+Merges the per-session MIMOS recordings in buildings_by_date into one aligned 1 second CSV per building,
+in the input format of convert_mimos.
+
+Every building folder holds the whole-house sessions in main/*.csv (Timestamp, Apparent (VA), Active (W)) and one
+<session>_<appliance>_output.csv per appliance session (Timestamp, Active (W)). The sessions are merged with a
+streaming k-way merge, so only one chunk per session file is held in memory, e.g.
+
+python preprocess_mimos.py data_preprocessing/buildings_by_date data/csv_files/1_sec
+"""
+import os
+import re
+import argparse
+import pandas as pd
+from os.path import join, isdir
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Columns of the converter input files (see convert_mimos)
+MAINS_COLUMNS = ['Apparent (VA)', 'Active (W)']
+APPLIANCES = ['fridge', 'aircond', 'washing_machine', 'dryer', 'kettle', 'vacuum', 'water_heater', 'oven']
+OUTPUT_COLUMNS = ['Timestamp', 'UNIX'] + MAINS_COLUMNS + APPLIANCES
+
+# Other names the appliances were recorded under
+APPLIANCE_ALIASES = {'ac': 'aircond'}
+
+BUILDING_FOLDER_PATTERN = re.compile(r'Building (\d+)$')
+APPLIANCE_FILE_PATTERN = re.compile(r'_(' + '|'.join(APPLIANCES + list(APPLIANCE_ALIASES)) + r')_output\.csv$')
+
+# Number of rows read from every session file at a time
+CHUNKSIZE = 100000
+
+TIMEZONE = 'Asia/Kuala_Lumpur'
+
+
+class SessionReader():
+
+    """
+    Reads one time-sorted session file in chunks, with its readings renamed to the output columns.
+    """
+
+    def __init__(self, filename, channel, columns, chunksize=CHUNKSIZE):
+        self.filename = filename
+        self.channel = channel
+        self.columns = columns
+        self.reader = pd.read_csv(filename, usecols=['Timestamp'] + list(columns), chunksize=chunksize, engine='c')
+        self.buffer = None
+        self.last = None
+        self.exhausted = False
+
+    def refill(self):
+        """
+        Reads chunks until the buffer holds a reading before its last timestamp, since more readings at the
+        last timestamp may follow in the next chunk. Returns False once every reading has been taken.
+        """
+        while not self.exhausted and (self.buffer is None or len(self.buffer) == 0 or self.buffer.index[0] == self.buffer.index[-1]):
+            try:
+                df = next(self.reader)
+            except StopIteration:
+                self.exhausted = True
+                break
+            df.index = pd.DatetimeIndex(pd.to_datetime(df.pop('Timestamp')))
+            if not df.index.is_monotonic_increasing or (self.last is not None and len(df) and df.index[0] < self.last):
+                raise ValueError(self.filename + ' is not sorted by time')
+            if len(df) == 0:
+                continue
+            self.last = df.index[-1]
+            df = df.rename(columns=self.columns)
+            self.buffer = df if self.buffer is None or len(self.buffer) == 0 else pd.concat([self.buffer, df])
+        return self.buffer is not None and len(self.buffer) > 0
+
+    def take(self, until=None):
+        """
+        Removes and returns the buffered readings before the timestamp until, or all of them
+        """
+        n = len(self.buffer) if until is None else self.buffer.index.searchsorted(until, side='left')
+        rows, self.buffer = self.buffer.iloc[:n], self.buffer.iloc[n:]
+        return rows
+
+
+def find_sessions(building_path):
+    """
+    Returns (channel, filename, {column: output column}) for every session file of a building folder,
+    where channel is 'mains' or the appliance name
+    """
+    sessions = []
+    main_path = join(building_path, 'main')
+    if isdir(main_path):
+        for file_name in sorted(os.listdir(main_path)):
+            if file_name.endswith('.csv'):
+                sessions.append(('mains', join(main_path, file_name), {column: column for column in MAINS_COLUMNS}))
+    for file_name in sorted(os.listdir(building_path)):
+        match = APPLIANCE_FILE_PATTERN.search(file_name)
+        if match:
+            appliance = APPLIANCE_ALIASES.get(match.group(1), match.group(1))
+            sessions.append((appliance, join(building_path, file_name), {'Active (W)': appliance}))
+    return sessions
+
+
+def merge_sessions(sessions, on_duplicate='sum', chunksize=CHUNKSIZE):
+    """
+    Streaming k-way merge of time-sorted session files into aligned 1 second readings.
+
+    Every missing second between the first and the last reading is filled with 0, like asfreq('s').fillna(0).
+    Overlapping sessions of the same channel (the mains or one appliance) are reported and combined per on_duplicate.
+
+    Parameters
+    ----------
+    sessions : list of (channel, filename, {column: output column}), see find_sessions
+    on_duplicate : str
+        'sum' adds up the readings of overlapping sessions (e.g. two mains loggers on different circuits),
+        'first' keeps the reading of the first session, 'error' raises a ValueError.
+    chunksize : int
+        Number of rows read from every session file at a time.
+
+    Returns
+    -------
+    iterator of (dataframe with the MAINS_COLUMNS and APPLIANCES indexed by naive local time, number of duplicate readings in it)
+    """
+    if on_duplicate not in ('sum', 'first', 'error'):
+        raise ValueError("on_duplicate must be 'sum', 'first' or 'error'")
+
+    readers = [SessionReader(filename, channel, columns, chunksize) for channel, filename, columns in sessions]
+    next_second = None
+    while True:
+        active = [reader for reader in readers if reader.refill()]
+        if not active:
+            break
+
+        # Every reading before the smallest buffered last timestamp is known, later ones may still get readings from other sessions
+        pending = [reader.buffer.index[-1] for reader in active if not reader.exhausted]
+        watermark = min(pending) if pending else None
+        blocks = []
+        for reader in active:
+            rows = reader.take(watermark)
+            if len(rows):
+                blocks.append(rows.assign(_channel=reader.channel))
+        block = pd.concat(blocks)
+
+        duplicated = block.set_index('_channel', append=True).index.duplicated()
+        n_duplicates = int(duplicated.sum())
+        if n_duplicates and on_duplicate == 'error':
+            raise ValueError(str(n_duplicates) + ' readings overlap before ' + str(block.index.max()))
+        block = block.drop(columns='_channel').groupby(level=0)
+        block = block.sum(min_count=1) if on_duplicate == 'sum' else block.first()
+
+        # Fill the missing seconds since the previous block
+        start = block.index[0] if next_second is None else next_second
+        grid = pd.date_range(start, block.index[-1], freq='s')
+        block = block.reindex(grid.union(block.index), columns=MAINS_COLUMNS + APPLIANCES).fillna(0)
+        next_second = block.index[-1] + pd.Timedelta(seconds=1)
+        yield block, n_duplicates
+
+
+def preprocess_building(building_path, output_filename, on_duplicate='sum', chunksize=CHUNKSIZE, tz=TIMEZONE):
+    """
+    Writes the merged readings of one building folder to output_filename in the input format of convert_mimos.
+    Returns (number of rows, number of duplicate readings).
+    """
+    sessions = find_sessions(building_path)
+    if not sessions:
+        raise RuntimeError('Could not find any session file in ' + building_path + '. Please check the provided folder.')
+
+    n_rows = 0
+    n_duplicates = 0
+    with open(output_filename, 'w', newline='') as f:
+        f.write(','.join(OUTPUT_COLUMNS) + '\n')
+        for block, duplicates in merge_sessions(sessions, on_duplicate, chunksize):
+            block.insert(0, 'UNIX', (block.index.tz_localize(tz) - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1))
+            block.index = block.index.strftime('%Y-%m-%d %H:%M:%S')
+            block.to_csv(f, header=False, index_label='Timestamp')
+            n_rows += len(block)
+            n_duplicates += duplicates
+    return n_rows, n_duplicates
+
+
+def preprocess_mimos(input_path, output_path, on_duplicate='sum', chunksize=CHUNKSIZE, n_workers=None):
+    """
+    Parameters
+    ----------
+    input_path : str
+        Folder holding one 'Building N' folder per building, e.g. data_preprocessing/buildings_by_date.
+    output_path : str
+        Destination folder of the Building_N.csv files, e.g. data/csv_files/1_sec.
+    on_duplicate : str
+        How overlapping sessions are combined, see merge_sessions.
+    chunksize : int
+        Number of rows read from every session file at a time.
+    n_workers : int
+        Number of buildings merged in parallel worker processes. Defaults to the number of CPUs.
+    """
+    buildings = sorted((int(match.group(1)), join(input_path, match.group(0)))
+                       for match in map(BUILDING_FOLDER_PATTERN.match, os.listdir(input_path)) if match)
+    if not buildings:
+        raise RuntimeError('Could not find any Building N folder. Please check the provided folder.')
+    os.makedirs(output_path, exist_ok=True)
+
+    n_workers = min(n_workers or os.cpu_count() or 1, len(buildings))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(preprocess_building, building_path, join(output_path, 'Building_' + str(building) + '.csv'), on_duplicate, chunksize)
+                   for building, building_path in buildings]
+        for (building, building_path), future in zip(buildings, futures):
+            n_rows, n_duplicates = future.result()
+            print("Merged building", building, "-", n_rows, "rows")
+            if n_duplicates:
+                print("Warning: building", building, "has", n_duplicates, "overlapping readings, combined with", on_duplicate)
+    print("Done merging MIMOS sessions into " + output_path + "!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the MIMOS session recordings into one 1 second CSV file per building")
+    parser.add_argument('input_path', help="folder with one 'Building N' folder per building")
+    parser.add_argument('output_path', help="destination folder of the Building_N.csv files")
+    parser.add_argument('--on-duplicate', choices=['sum', 'first', 'error'], default='sum', help="how overlapping sessions are combined")
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help="rows read from every session file at a time")
+    parser.add_argument('--workers', type=int, default=None, help="buildings merged in parallel")
+    args = parser.parse_args()
+    preprocess_mimos(args.input_path, args.output_path, args.on_duplicate, args.chunksize, args.workers)
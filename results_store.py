@@ -0,0 +1,222 @@
+"""
+On-disk store of experiment results.
+
+Every metric value is one row keyed by (sample_period, sequence_length, dataset, building, chunk, metric, appliance,
+classifier) in an HDF5 table whose keys are indexed data columns, so queries and pivots across runs read only the
+matching rows instead of parsing the text dumps in results/. Every run also records its parameters and stage timings.
+
+API appends to the store given as 'results_store' in the experiment parameters. The results of the 12 configurations
+in results/ can be imported with
+
+python results_store.py results/results.json results/results.h5
+"""
+import os
+import json
+import hashlib
+import argparse
+import datetime
+import pandas as pd
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No file locking on Windows, where runs should not write to the same store at the same time
+    fcntl = None
+
+
+RESULT_DTYPES = {'run_id': str, 'sample_period': 'int64', 'sequence_length': 'int64', 'dataset': str, 'building': 'int64',
+                 'chunk': 'int64', 'metric': str, 'appliance': str, 'classifier': str, 'value': 'float64'}
+TIMING_DTYPES = {'run_id': str, 'stage': str, 'dataset': str, 'building': 'int64', 'chunk': 'int64', 'classifier': str,
+                 'depth': 'int64', 'start': 'float64', 'seconds': 'float64', 'rows': 'int64', 'bytes': 'int64'}
+RUN_DTYPES = {'run_id': str, 'created': str, 'sample_period': 'int64', 'classifiers': str}
+TABLES = {'results': RESULT_DTYPES, 'timings': TIMING_DTYPES, 'runs': RUN_DTYPES}
+
+# Widths of the string columns, which HDF5 tables fix on the first append
+STRING_SIZES = {'run_id': 64, 'dataset': 64, 'metric': 32, 'appliance': 64, 'classifier': 64, 'stage': 32, 'created': 32, 'classifiers': 256}
+
+# Stands for "all buildings" or "all chunks" in the building and chunk columns
+ALL = -1
+
+# Group of the metadata of the runs, one node per run
+METADATA_GROUP = 'run_metadata'
+
+
+def new_run_id():
+    return datetime.datetime.now().strftime('%Y%m%d-%H%M%S-') + str(os.getpid())
+
+
+def _metadata_key(run_id):
+    # Run ids are not always valid node names
+    return METADATA_GROUP + '/run_' + hashlib.sha1(str(run_id).encode()).hexdigest()
+
+
+class ResultsStore():
+
+    """
+    Parameters
+    ----------
+    path : str
+        HDF5 file, created on the first append.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _open(self, mode):
+        """
+        Opens the store, holding a lock on path + '.lock' so parallel runs can share it: exclusive while writing, shared while reading
+        """
+        lock = None
+        if fcntl is not None:
+            lock = open(self.path + '.lock', 'a')
+            fcntl.flock(lock, fcntl.LOCK_SH if mode == 'r' else fcntl.LOCK_EX)
+        try:
+            with pd.HDFStore(self.path, mode=mode) as store:
+                yield store
+        finally:
+            if lock is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+
+    def _append(self, key, df, dtypes, store=None):
+        if store is None:
+            with self._open('a') as store:
+                return self._append(key, df, dtypes, store)
+        store.append(key, df[list(dtypes)].astype(dtypes), format='table', data_columns=[column for column in dtypes if column != 'value'],
+                     min_itemsize={column: size for column, size in STRING_SIZES.items() if column in dtypes}, index=False)
+
+    def append_results(self, results, run_id, sample_period, sequence_lengths=None, dataset='', building=ALL, chunk=ALL):
+        """
+        Appends the output of metrics.compute_metrics (columns metric, classifier, appliance and value)
+
+        Parameters
+        ----------
+        sequence_lengths : dict of classifier -> sequence length, 0 for classifiers without one
+        """
+        if len(results) == 0:
+            return
+        sequence_lengths = sequence_lengths or {}
+        results = results.assign(run_id=run_id, sample_period=sample_period, dataset=str(dataset), building=building, chunk=chunk,
+                                 sequence_length=results['classifier'].map(lambda clf_name: sequence_lengths.get(clf_name, 0)))
+        self._append('results', results, RESULT_DTYPES)
+
+    def record_run(self, run_id, sample_period, classifiers, metadata=None):
+        """
+        Records a run, with its metadata (e.g. the experiment parameters). Values that are not JSON serialisable are stored as strings.
+        The metadata is a JSON string in a node of its own, so its size does not depend on the number of runs.
+        """
+        run = pd.DataFrame([{'run_id': run_id, 'created': datetime.datetime.now().isoformat(timespec='seconds'), 'sample_period': sample_period,
+                             'classifiers': ','.join(classifiers)}])
+        with self._open('a') as store:
+            # Written before the row, so every run listed has its metadata
+            store.put(_metadata_key(run_id), pd.Series([json.dumps(metadata or {}, default=str)]), format='fixed')
+            self._append('runs', run, RUN_DTYPES, store)
+
+    def append_timings(self, run_id, timings):
+        """
+        Appends the spans of a timings.Timings
+        """
+        df = timings.to_frame()
+        if df.empty:
+            return
+        df = df.rename(columns={'name': 'stage'}).reindex(columns=list(TIMING_DTYPES))
+        df['run_id'] = run_id
+        df = df.fillna({'dataset': '', 'building': ALL, 'chunk': ALL, 'classifier': '', 'seconds': 0, 'start': 0})
+        self._append('timings', df, TIMING_DTYPES)
+
+    def query(self, table='results', **filters):
+        """
+        Rows of a table ('results', 'timings' or 'runs') matching every filter, e.g.
+        store.query(metric='f1score', sample_period=[1, 6], classifier='Seq2Point')
+        A filter value can be a single value or a list of values.
+        """
+        if not os.path.exists(self.path):
+            return pd.DataFrame(columns=list(TABLES[table]))
+        terms = []
+        for column, value in filters.items():
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            terms.append(column + ' == ' + repr([str(v) if isinstance(v, str) else int(v) for v in values]))
+        with self._open('r') as store:
+            if '/' + table not in store.keys():
+                return pd.DataFrame(columns=list(TABLES[table]))
+            return store.select(table, where=' & '.join(terms) if terms else None).reset_index(drop=True)
+
+    def pivot(self, index=('sample_period', 'sequence_length', 'metric', 'appliance'), columns='classifier', aggfunc='mean', **filters):
+        """
+        Table of the matching metric values, e.g. the layout of results/results.csv:
+        store.pivot(metric='f1score', run_id='legacy')
+        Values of several buildings, chunks or runs in the same cell are combined with aggfunc.
+        """
+        df = self.query('results', **filters)
+        return df.pivot_table(index=list(index), columns=columns, values='value', aggfunc=aggfunc)
+
+    def runs(self):
+        return self.query('runs')
+
+    def timings(self, **filters):
+        """
+        Stage timings of the matching spans, e.g. store.timings(run_id=..., stage='disaggregate_chunk')
+        """
+        return self.query('timings', **filters)
+
+    def run_metadata(self, run_id):
+        with self._open('r') as store:
+            if '/' + _metadata_key(run_id) not in store:
+                raise KeyError('No metadata recorded for run ' + str(run_id))
+            return json.loads(store.get(_metadata_key(run_id)).iloc[0])
+
+    def remove_run(self, run_id):
+        """
+        Removes the results, timings and metadata of a run, e.g. of an interrupted run before it is repeated
+        """
+        if not os.path.exists(self.path):
+            return
+        with self._open('a') as store:
+            for table in TABLES:
+                if '/' + table in store.keys():
+                    store.remove(table, where='run_id == ' + repr(str(run_id)))
+            if '/' + _metadata_key(run_id) in store:
+                store.remove(_metadata_key(run_id))
+
+    def index(self):
+        """
+        Builds the indexes of the key columns, which speeds up queries on large stores. Appends leave them out to stay fast.
+        """
+        with self._open('a') as store:
+            for table in ('results', 'timings', 'runs'):
+                if '/' + table in store.keys():
+                    store.create_table_index(table, kind='full', optlevel=9)
+
+
+def import_results_json(json_path, store, run_id='legacy', dataset='MIMOS'):
+    """
+    Imports results/results.json (sample rate -> sequence length -> metric -> appliance -> classifier -> value),
+    the results of the experiments run before the store existed
+    """
+    with open(json_path) as f:
+        data = json.load(f)
+    rows = []
+    for sample_period, sequence_lengths in data.items():
+        for sequence_length, metrics in sequence_lengths.items():
+            for metric, appliances in metrics.items():
+                for appliance, classifiers in appliances.items():
+                    for classifier, value in classifiers.items():
+                        rows.append({'run_id': run_id, 'sample_period': int(sample_period), 'sequence_length': int(sequence_length),
+                                     'dataset': dataset, 'building': ALL, 'chunk': ALL, 'metric': metric, 'appliance': appliance,
+                                     'classifier': classifier, 'value': float(value)})
+    store._append('results', pd.DataFrame(rows), RESULT_DTYPES)
+    store.record_run(run_id, 0, sorted({row['classifier'] for row in rows}), {'source': json_path})
+    store.index()
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import results.json into a results store")
+    parser.add_argument('json_path', help="e.g. results/results.json")
+    parser.add_argument('store_path', help="e.g. results/results.h5")
+    parser.add_argument('--run-id', default='legacy')
+    args = parser.parse_args()
+    n_rows = import_results_json(args.json_path, ResultsStore(args.store_path), args.run_id)
+    print("Imported", n_rows, "results into " + args.store_path + "!")
@@ -0,0 +1,337 @@
+"""
+Real-time disaggregation of smart-meter feeds.
+
+StreamingDisaggregator takes mains readings of one or more meters as they arrive, one at a time or in small batches,
+and emits the power and ON/OFF state of every appliance with a trained Seq2Point or Seq2Seq classifier. The windows of
+all meters are micro-batched into one network call per appliance, bounded by max_batch windows and max_delay seconds.
+
+Like disaggregate_chunk, the window of a reading is centred on it, so the estimate of a reading is emitted once the
+following sequence_length // 2 readings have arrived, and the estimates are aligned with the readings as in its predictions
+(see window_estimates). replay_hdf plays back the mains of a converted MIMOS file at real time or faster to measure the
+sustained throughput and latency, e.g.
+
+python streaming.py trained_models/1sec_99SL data/mimos_1_sec.h5 --buildings 1 2 3 --speed 0 --cpu
+"""
+import os
+import time
+import argparse
+import collections
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from metrics import F1_THRESHOLD
+
+
+Estimate = collections.namedtuple('Estimate', ['meter', 'timestamps', 'power', 'on', 'latency'])
+Estimate.__doc__ = """
+Appliance estimates of consecutive readings of one meter: power and on are (n_readings x n_appliances) arrays in the
+order of StreamingDisaggregator.appliances, latency the seconds from the arrival of the reading that completed each window.
+"""
+
+
+def predict_windows(clf, appliances, windows):
+    """
+    Runs (n_windows x sequence_length) mains windows through the network of every appliance, in one batch each.
+    Returns the normalised outputs as (n_windows x outputs per window x n_appliances): one output per window for Seq2Point,
+    sequence_length for Seq2Seq.
+    """
+    batch = ((np.asarray(windows) - clf.mains_mean) / clf.mains_std).astype('float32')[..., np.newaxis]
+    return np.stack([np.asarray(clf.models[appliance].predict_on_batch(batch)).reshape(len(batch), -1) for appliance in appliances], axis=-1)
+
+
+def chunk_windows(mains, sequence_length):
+    """
+    The windows disaggregate_chunk makes of a chunk of mains: one per reading, centred on it, with sequence_length // 2 zeros
+    of padding at both ends
+    """
+    return sliding_window_view(np.pad(mains, sequence_length // 2), sequence_length)[:len(mains)]
+
+
+def window_estimates(output, sums=None, n_before=0):
+    """
+    Normalised estimates of consecutive windows, aligned like the rows of disaggregate_chunk: window i gives row i.
+    Seq2Point estimates the reading window i is centred on. Seq2Seq averages the outputs of every window covering position i of
+    the zero-padded mains, which is reading i - sequence_length // 2, so its estimates lag the readings by sequence_length // 2
+    exactly as the predictions of disaggregate_chunk do.
+
+    Parameters
+    ----------
+    output : (n_windows x outputs per window x n_appliances) normalised outputs, see predict_windows
+    sums, n_before : Seq2Seq state of the same stream, see average_windows
+
+    Returns
+    -------
+    (n_windows x n_appliances) estimates, sums to continue the stream with
+    """
+    if output.shape[1] == 1:
+        return output[:, 0], sums
+    return average_windows(output, sums, n_before)
+
+
+def average_windows(output, sums=None, n_before=0):
+    """
+    Seq2Seq: the estimate of a reading is the average of the outputs of every window that covers it, as in disaggregate_chunk,
+    and a reading is final once the window that starts at it has run.
+
+    Parameters
+    ----------
+    output : (n_windows x sequence_length x n_appliances) normalised outputs of consecutive windows
+    sums : the sums returned for the previous windows of the same stream, if any
+    n_before : number of windows of the stream before these
+
+    Returns
+    -------
+    (n_windows x n_appliances) estimates, sums to continue the stream with
+    """
+    n, length = output.shape[:2]
+    totals = np.zeros((n + length - 1, output.shape[2]))
+    if sums is not None:
+        totals[:length - 1] = sums
+    for i in range(n):
+        totals[i:i + length] += output[i]
+    counts = np.minimum(n_before + np.arange(n), length - 1) + 1
+    return totals[:n] / counts[:, np.newaxis], totals[n:]
+
+
+class _Meter():
+
+    """
+    Stream state of one meter
+    """
+
+    def __init__(self, sequence_length, n_appliances):
+        # The last sequence_length - 1 readings. Like disaggregate_chunk, the stream starts with sequence_length // 2 zeros of padding
+        self.history = np.zeros(sequence_length // 2, dtype='float32')
+        self.timestamps = collections.deque()
+        self.n_windows = 0
+        # Seq2Seq sums of the overlapping window outputs of the readings that are not final yet
+        self.sums = np.zeros((sequence_length - 1, n_appliances))
+        self.on = np.zeros(n_appliances, dtype=bool)
+        self.closed = False
+
+
+class StreamingDisaggregator():
+
+    """
+    Parameters
+    ----------
+    clf : trained Seq2Point or Seq2Seq classifier, e.g. from model_bundle.import_model(...).classifiers
+    max_batch : int
+        Windows (of all meters) run through the networks at once.
+    max_delay : float
+        Seconds a window may wait for a batch to fill up.
+    thresholds : dict of appliance -> ON threshold (W), defaults to the F1 score threshold
+    hysteresis : float
+        Width (W) of the band around the threshold in which the previous state is kept, see on_off.on_off_states.
+    """
+
+    def __init__(self, clf, max_batch=256, max_delay=0.05, thresholds=None, hysteresis=0.0):
+        self.clf = clf
+        self.appliances = list(clf.models)
+        self.sequence_length = clf.sequence_length
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.thresholds = np.array([(thresholds or {}).get(appliance, F1_THRESHOLD) for appliance in self.appliances], dtype='float32')
+        self.hysteresis = hysteresis
+        self.means = np.array([clf.appliance_params[appliance]['mean'] for appliance in self.appliances], dtype='float32')
+        self.stds = np.array([clf.appliance_params[appliance]['std'] for appliance in self.appliances], dtype='float32')
+        self.meters = {}
+        # (meter, windows, arrival time) waiting for the next batch
+        self.pending = collections.deque()
+        self.n_pending = 0
+        self.latencies = collections.defaultdict(list)
+        self.n_samples = collections.Counter()
+
+    def push(self, meter, timestamps, values, now=None):
+        """
+        Adds mains readings of a meter and returns the estimates that became ready (a list of Estimate)
+        """
+        now = time.perf_counter() if now is None else now
+        state = self.meters.get(meter)
+        if state is None:
+            state = self.meters[meter] = _Meter(self.sequence_length, len(self.appliances))
+        if state.closed:
+            raise ValueError('Meter ' + str(meter) + ' was already flushed')
+
+        values = np.atleast_1d(np.asarray(values, dtype='float32'))
+        state.timestamps.extend(np.atleast_1d(timestamps))
+        self.n_samples[meter] += len(values)
+        readings = np.concatenate([state.history, values])
+        n_windows = len(readings) - self.sequence_length + 1
+        if n_windows > 0:
+            self.pending.append((meter, sliding_window_view(readings, self.sequence_length)[:n_windows], now))
+            self.n_pending += n_windows
+            state.history = readings[n_windows:]
+        else:
+            state.history = readings
+        return self.poll(now)
+
+    def poll(self, now=None):
+        """
+        Runs the pending windows if the batch is full or the oldest one waited max_delay, and returns the estimates.
+        Call it regularly when readings arrive slower than max_delay.
+        """
+        now = time.perf_counter() if now is None else now
+        if self.n_pending >= self.max_batch or (self.pending and now - self.pending[0][2] >= self.max_delay):
+            return self.run()
+        return []
+
+    def flush(self, meter):
+        """
+        Ends the stream of a meter: pads it with zeros like disaggregate_chunk, so its last readings get an estimate too.
+        Returns every pending estimate.
+        """
+        state = self.meters[meter]
+        # Readings that no window was made for yet
+        padding = len(state.timestamps) - sum(len(windows) for pending_meter, windows, arrival in self.pending if pending_meter == meter)
+        if padding > 0:
+            readings = np.concatenate([state.history, np.zeros(self.sequence_length // 2, dtype='float32')])
+            self.pending.append((meter, sliding_window_view(readings, self.sequence_length)[:padding], time.perf_counter()))
+            self.n_pending += padding
+        state.closed = True
+        return self.run()
+
+    def run(self):
+        """
+        Runs every pending window through the networks in one batch per appliance and returns the estimates
+        """
+        if not self.pending:
+            return []
+        pending = list(self.pending)
+        self.pending.clear()
+        self.n_pending = 0
+
+        outputs = predict_windows(self.clf, self.appliances, np.concatenate([windows for meter, windows, arrival in pending]))
+
+        estimates = []
+        done = time.perf_counter()
+        offset = 0
+        for meter, windows, arrival in pending:
+            output = outputs[offset:offset + len(windows)]
+            offset += len(windows)
+            estimates.append(self._estimate(meter, output, done - arrival))
+        return estimates
+
+    def _estimate(self, meter, output, latency):
+        state = self.meters[meter]
+        n = len(output)
+        normalised, state.sums = window_estimates(output, state.sums, state.n_windows)
+        state.n_windows += n
+
+        power = np.maximum(self.means + normalised * self.stds, 0).astype('float32')
+        timestamps = np.array([state.timestamps.popleft() for i in range(n)])
+        self.latencies[meter].extend([latency] * n)
+        return Estimate(meter, timestamps, power, self._states(state, power), latency)
+
+    def _states(self, state, power):
+        """
+        ON/OFF states with hysteresis, continuing from the last state of the meter
+        """
+        turns_on = power > self.thresholds + self.hysteresis
+        decided = turns_on | (power < self.thresholds - self.hysteresis)
+        last_decided = np.where(decided, np.arange(len(power))[:, np.newaxis], -1)
+        np.maximum.accumulate(last_decided, axis=0, out=last_decided)
+        columns = np.arange(power.shape[1])
+        on = np.where(last_decided >= 0, turns_on[np.maximum(last_decided, 0), columns], state.on)
+        state.on = on[-1]
+        return on
+
+    def latency_summary(self):
+        """
+        Readings, p50, p99 and maximum latency (ms) per meter
+        """
+        rows = {}
+        for meter, latencies in self.latencies.items():
+            latencies = np.array(latencies) * 1000
+            rows[meter] = {'readings': len(latencies), 'p50_ms': np.percentile(latencies, 50), 'p99_ms': np.percentile(latencies, 99), 'max_ms': latencies.max()}
+        return pd.DataFrame.from_dict(rows, orient='index')
+
+
+def replay_hdf(path, buildings=(1,), speed=1.0, batch_size=1, ac_type='active', chunksize=100000):
+    """
+    Plays back the mains of buildings of a converted MIMOS file, e.g. data/mimos_1_sec.h5, as if they arrived live.
+
+    Parameters
+    ----------
+    path : str
+    buildings : list of int
+        Every building is one meter. They are replayed side by side, from their own first reading.
+    speed : float
+        1 replays at real time, 10 ten times faster, 0 as fast as possible.
+    batch_size : int
+        Readings per meter delivered at once.
+
+    Returns
+    -------
+    iterator of (building, timestamps, values)
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        readers = {}
+        for building in buildings:
+            key = '/building' + str(building) + '/elec/meter1'
+            readers[building] = _replay_batches(store.select(key, iterator=True, chunksize=chunksize), ac_type, batch_size)
+
+        started = time.perf_counter()
+        firsts = {}
+        while readers:
+            for building in list(readers):
+                batch = next(readers[building], None)
+                if batch is None:
+                    del readers[building]
+                    continue
+                timestamps, values = batch
+                first = firsts.setdefault(building, timestamps[0])
+                if speed:
+                    # Deliver the batch once its last reading would have been measured
+                    wait = (timestamps[-1] - first) / np.timedelta64(1, 's') / speed - (time.perf_counter() - started)
+                    if wait > 0:
+                        time.sleep(wait)
+                yield building, timestamps, values
+
+
+def _replay_batches(chunks, ac_type, batch_size):
+    for chunk in chunks:
+        column = ('power', ac_type) if ('power', ac_type) in chunk.columns else chunk.columns[0]
+        timestamps = chunk.index.values
+        values = chunk[column].values.astype('float32')
+        for start in range(0, len(chunk), batch_size):
+            yield timestamps[start:start + batch_size], values[start:start + batch_size]
+
+
+def run_replay(clf, path, buildings=(1,), speed=0, batch_size=1, max_batch=256, max_delay=0.05, **kwargs):
+    """
+    Disaggregates a replayed file and returns (readings per second, latency summary per meter)
+    """
+    disaggregator = StreamingDisaggregator(clf, max_batch=max_batch, max_delay=max_delay, **kwargs)
+    started = time.perf_counter()
+    for building, timestamps, values in replay_hdf(path, buildings, speed, batch_size):
+        disaggregator.push(building, timestamps, values)
+    for building in buildings:
+        disaggregator.flush(building)
+    seconds = time.perf_counter() - started
+    return sum(disaggregator.n_samples.values()) / seconds, disaggregator.latency_summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a converted MIMOS file through a streaming disaggregator")
+    parser.add_argument('model', help="model bundle folder or pickled model")
+    parser.add_argument('path', help="converted MIMOS file, e.g. data/mimos_1_sec.h5")
+    parser.add_argument('--buildings', type=int, nargs='+', default=[1], help="buildings replayed as meters")
+    parser.add_argument('--classifier', help="name of the classifier, defaults to the first one")
+    parser.add_argument('--speed', type=float, default=0, help="replay speed, 1 is real time and 0 as fast as possible")
+    parser.add_argument('--batch-size', type=int, default=1, help="readings per meter delivered at once")
+    parser.add_argument('--max-batch', type=int, default=256, help="windows run through the networks at once")
+    parser.add_argument('--max-delay', type=float, default=0.05, help="seconds a window may wait for a batch")
+    parser.add_argument('--cpu', action='store_true', help="hide the GPUs from TensorFlow")
+    args = parser.parse_args()
+
+    if args.cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    from model_bundle import import_model
+    model = import_model(args.model)
+    classifiers = dict(model.classifiers)
+    clf = classifiers[args.classifier] if args.classifier else model.classifiers[0][1]
+
+    samples_per_second, latencies = run_replay(clf, args.path, args.buildings, args.speed, args.batch_size, args.max_batch, args.max_delay)
+    print("Sustained", round(samples_per_second), "readings per second")
+    print(latencies.to_string(float_format='{:.1f}'.format))
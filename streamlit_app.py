@@ -1,43 +1,59 @@
 import streamlit as st
 import os
 from os.path import join
-import pickle
-import nilmtk as ntk
 from nilmtk.api import API
 from tempfile import NamedTemporaryFile
-from sklearn.cluster import KMeans
 import pandas as pd
 import matplotlib.pyplot as plt
+import model_bundle
+from on_off import two_cluster_threshold, on_off_states
+from chart_data import ChartPyramid
+from h5_validation import H5ValidationError, find_h5_errors, file_digest
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
-# Import the model
+# The model path
+TRAINED_MODEL_PATH = "trained_models/1sec_99SL.pickle"
+
+# ON/OFF detection: hysteresis band as a fraction of the threshold, and the shortest ON period and OFF gap (in samples) that are shown
+ON_OFF_HYSTERESIS = 0.1
+ON_OFF_MIN_ON = 30
+ON_OFF_MIN_OFF = 60
+
+# Maximum number of points sent to the browser per chart
+CHART_POINTS = 1000
+
+# Number of disaggregation results kept in memory across all sessions
+MAX_CACHED_RESULTS = 8
+
+# Number of validation results kept in memory across all sessions
+MAX_VALIDATED_FILES = 256
+
+# Import the model, preferring the slim model bundle over the pickled API object when it has been exported
 def import_model(filename):
-    with open(filename, "rb") as f:
-        model = pickle.load(f)
-    return model
+    bundle_path = os.path.splitext(filename)[0]
+    if os.path.isdir(bundle_path):
+        return model_bundle.import_model(bundle_path)
+    return model_bundle.import_model(filename)
 
 # Pre-generate graphs for all appliances
-def pre_generate_graphs():
-    for appliance in st.session_state.appliances:
-        chart_data = st.session_state.model.pred_overall['Seq2Seq'][appliance]
-        X = chart_data.values.reshape(-1, 1)
-        kmeans = KMeans(n_clusters=2)
-        kmeans.fit(X)
-        centroids = kmeans.cluster_centers_
-        threshold = (centroids[0][0] + centroids[1][0]) / 2
-        st.session_state.model.pred_overall['Seq2Seq'][appliance + ' ON/OFF states'] = 0
-        window_size = 2999
-        for k in range(0, len(st.session_state.model.pred_overall['Seq2Seq']), window_size - 1):
-            if st.session_state.model.pred_overall['Seq2Seq'][appliance].iloc[k] > threshold:
-                st.session_state.model.pred_overall['Seq2Seq'][appliance + ' ON/OFF states'].iloc[k:k + window_size] = 1
+def pre_generate_graphs(predictions, appliances):
+    for appliance in appliances:
+        values = predictions[appliance].values
+        threshold = two_cluster_threshold(values)
+        states = on_off_states(values, threshold, hysteresis=ON_OFF_HYSTERESIS * abs(threshold), min_on=ON_OFF_MIN_ON, min_off=ON_OFF_MIN_OFF)
+        predictions[appliance + ' ON/OFF states'] = states.astype('int8')
 
 # Display selected appliance information
 def display_appliance_info(appliance, start_time, end_time):
     st.subheader(appliance.capitalize() + " Usage with ON/OFF states")
-    chart_data = st.session_state.model.pred_overall['Seq2Seq'][appliance].loc[start_time:end_time]
+    chart_data = st.session_state.charts[appliance].get(start_time, end_time, CHART_POINTS)
     chart_data.index = chart_data.index.strftime('%H:%M:%S')
     st.line_chart(chart_data)
     
-    on_off_chart = st.session_state.model.pred_overall['Seq2Seq'][appliance + ' ON/OFF states'].loc[start_time:end_time]
+    on_off_chart = st.session_state.charts[appliance + ' ON/OFF states'].get(start_time, end_time, CHART_POINTS)
     on_off_chart.index = on_off_chart.index.strftime('%H:%M:%S')
     st.line_chart(on_off_chart)
 
@@ -51,27 +67,106 @@ def validate_timestamp(timestamp_str):
     except ValueError:
         return False
     
-def validate_h5_file(filename):
+# Validate the HDF5 file from its key layout and metadata only, reusing the result for files with the same contents
+def validate_h5_file(filename, digest=None):
+    if digest is None:
+        digest = file_digest(filename)
+    validated_files = get_validated_files()
+    errors = validated_files.get(digest)
+    if errors is None:
+        errors = find_h5_errors(filename)
+        validated_files.put(digest, errors)
+    if errors:
+        raise H5ValidationError(errors)
+    return True
+
+# Validate an upload, only writing it to disk if its contents have not been validated before
+def validate_upload(file_bytes, digest):
+    if get_validated_files().get(digest) is None:
+        with uploaded_h5_file(file_bytes) as temp_file_path:
+            return validate_h5_file(temp_file_path, digest)
+    return validate_h5_file(None, digest)
+
+class ResultCache():
+
+    """
+    Process-wide LRU cache shared by every session of the app.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+# Validation errors by file hash, shared by all sessions
+@st.cache_resource
+def get_validated_files():
+    return ResultCache(MAX_VALIDATED_FILES)
+
+# Loaded once per process and shared by all sessions
+@st.cache_resource
+def load_shared_model(filename):
+    return import_model(filename), threading.Lock()
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(MAX_CACHED_RESULTS)
+
+# Write the upload to a temporary HDF5 file that is removed again once it has been read
+@contextmanager
+def uploaded_h5_file(file_bytes):
+    with NamedTemporaryFile(delete=False, suffix=".h5") as temp_file:
+        temp_file.write(file_bytes)
+        temp_file_path = temp_file.name
     try:
-        ds = ntk.DataSet(filename)
-        errors = []
-
-        for i in ds.buildings:
-            mains = ds.buildings[i].elec.mains().available_ac_types('power')
-            submeters = ds.buildings[i].elec.submeters().available_ac_types('power')
-            if mains != ['active']:
-                errors.append(f"The power type for main meter in building {i} should be Active(W) only.")
-            if submeters != ['active']:
-                errors.append(f"The power type for all appliances (sub-meters) in building {i} should be Active(W) only.")
-        
-        if errors:
-            error_message = "\n".join(errors)
-            raise Exception
+        yield temp_file_path
+    finally:
+        os.remove(temp_file_path)
 
-        return True
-    
-    except Exception as e:
-        raise Exception("Invalid HDF5 file format. Please upload a valid file.")
+# Run the model on the uploaded file, or reuse the result of an identical upload, building and window
+def disaggregate_upload(file_bytes, digest, test_params):
+    windows = tuple((building, window['start_time'], window['end_time']) for building, window in test_params['buildings'].items())
+    key = (digest, windows)
+    result_cache = get_result_cache()
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    model, model_lock = load_shared_model(join(os.getcwd(), TRAINED_MODEL_PATH))
+    # test_jointly stores its results on the model, so sessions take turns on the shared model
+    with model_lock:
+        # Another session may have disaggregated the same upload while this one waited for the model
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached
+        with uploaded_h5_file(file_bytes) as temp_file_path:
+            model.test_jointly({'test': dict(test_params, path=temp_file_path)})
+            predictions = model.pred_overall['Seq2Seq'].copy()
+            if hasattr(model, 'close'):
+                model.close()
+
+        appliances = predictions.columns.tolist()
+        # Pre-generate graphs for all appliances
+        pre_generate_graphs(predictions, appliances)
+        charts = {column: ChartPyramid(predictions[column]) for column in predictions.columns}
+        # Cached before the lock is released, so sessions waiting for the same result find it
+        result = (predictions, appliances, charts)
+        result_cache.put(key, result)
+    return result
 
 def main():
     # The UI Title
@@ -88,13 +183,8 @@ def main():
     # Upload and store the input file
     uploaded_file = st.file_uploader("Insert your HDF5 file here (e.g. YOUR_FILE.h5)", accept_multiple_files=False, type = ['h5'])
     
-    model = None
-    
-    if 'loaded' not in st.session_state:
-        st.session_state.loaded = False
-    
-    if 'model' not in st.session_state:
-        st.session_state.model = None
+    if 'digest' not in st.session_state:
+        st.session_state.digest = None
     
     if 'dataframe' not in st.session_state:
         st.session_state.dataframe = None
@@ -102,19 +192,19 @@ def main():
     if 'appliances' not in st.session_state:
         st.session_state.appliances = None
     
+    if 'charts' not in st.session_state:
+        st.session_state.charts = None
+    
     if uploaded_file:
         
-        with NamedTemporaryFile(delete=False, suffix=".h5") as temp_file:
-            temp_file.write(uploaded_file.getvalue())
-            temp_file_path = temp_file.name
+        file_bytes = uploaded_file.getvalue()
+        digest = hashlib.sha256(file_bytes).hexdigest()
         
         try:
-            if validate_h5_file(temp_file_path):
+            if validate_upload(file_bytes, digest):
                 alert = st.success("HDF5 file validation passed")
 
                 test_params = {
-                    # Insert the path to the file from the uploaded file
-                    'path': temp_file_path,
                     'buildings':{
                         5:{
                             'start_time': '2022-11-08',
@@ -123,39 +213,25 @@ def main():
                     }
                 }
                 
-                if st.session_state.loaded == False:
+                if st.session_state.digest != digest:
                     with st.spinner('Running the model...'):
-                        # The model path
-                        trained_model_path = join(os.getcwd(), "trained_models/1sec_99SL.pickle")
-                        
-                        # Import the model
-                        model = import_model(trained_model_path)
-
                         # Test the model using only Seq2Point
-                        model.test_jointly({'test': test_params})
-                        
-                        st.session_state.model = model
-                        st.session_state.loaded = True
-                
-                if st.session_state.dataframe is None and st.session_state.appliances is None:
-                    st.session_state.dataframe = st.session_state.model.pred_overall['Seq2Seq'].copy()
-                    st.session_state.appliances = st.session_state.dataframe.columns.tolist()
-                    # Pre-generate graphs for all appliances
-                    pre_generate_graphs()
+                        st.session_state.dataframe, st.session_state.appliances, st.session_state.charts = disaggregate_upload(file_bytes, digest, test_params)
+                        st.session_state.digest = digest
             
             alert.empty()
 
-            if uploaded_file and st.session_state.loaded:
+            if uploaded_file and st.session_state.digest == digest:
                 # Sidebar with buttons and slider
                 st.sidebar.markdown("### Appliances")
                 selected_appliance = st.sidebar.selectbox("Select Appliance", st.session_state.appliances)
 
                 st.sidebar.markdown("### Adjust Time Range")
-                start_header = "Start Time (Default: " + pd.Timestamp.fromtimestamp(st.session_state.model.pred_overall['Seq2Seq'].index.min().timestamp()).strftime('%Y-%m-%d %H:%M:%S') + ")"
-                start_time_input = st.sidebar.text_input(start_header, value=pd.Timestamp.fromtimestamp(st.session_state.model.pred_overall['Seq2Seq'].index.min().timestamp()).strftime('%Y-%m-%d %H:%M:%S'))
+                start_header = "Start Time (Default: " + pd.Timestamp.fromtimestamp(st.session_state.dataframe.index.min().timestamp()).strftime('%Y-%m-%d %H:%M:%S') + ")"
+                start_time_input = st.sidebar.text_input(start_header, value=pd.Timestamp.fromtimestamp(st.session_state.dataframe.index.min().timestamp()).strftime('%Y-%m-%d %H:%M:%S'))
                 
-                end_header = "End Time (Default: " + pd.Timestamp.fromtimestamp(st.session_state.model.pred_overall['Seq2Seq'].index.max().timestamp()).strftime('%Y-%m-%d %H:%M:%S') + ")"
-                end_time_input = st.sidebar.text_input(end_header, value=pd.Timestamp.fromtimestamp(st.session_state.model.pred_overall['Seq2Seq'].index.max().timestamp()).strftime('%Y-%m-%d %H:%M:%S'))
+                end_header = "End Time (Default: " + pd.Timestamp.fromtimestamp(st.session_state.dataframe.index.max().timestamp()).strftime('%Y-%m-%d %H:%M:%S') + ")"
+                end_time_input = st.sidebar.text_input(end_header, value=pd.Timestamp.fromtimestamp(st.session_state.dataframe.index.max().timestamp()).strftime('%Y-%m-%d %H:%M:%S'))
 
                 # Validate start time input
                 if not validate_timestamp(start_time_input):
@@ -174,7 +250,7 @@ def main():
                     st.error("Error: Please select a valid time range. Start time cannot be greater than end time.")
                     return
                 
-                if start_time_readable < pd.Timestamp.fromtimestamp(st.session_state.model.pred_overall['Seq2Seq'].index.min().timestamp()) or end_time_readable > pd.Timestamp.fromtimestamp(st.session_state.model.pred_overall['Seq2Seq'].index.max().timestamp()):
+                if start_time_readable < pd.Timestamp.fromtimestamp(st.session_state.dataframe.index.min().timestamp()) or end_time_readable > pd.Timestamp.fromtimestamp(st.session_state.dataframe.index.max().timestamp()):
                     st.error("Error: Please enter a valid time range that is within the default start and end time.")
                     return
 
@@ -0,0 +1,298 @@
+"""
+Runs a grid of experiments (by default the results/ grid: 1, 3, 6 and 30 second stores x sequence lengths 99, 199 and 599)
+in a pool of worker processes, e.g.
+
+python sweep.py sweeps/results_grid --sample-rates 1 3 6 30 --sequence-lengths 99 199 599 --cpus 8 --threads 2
+
+Every building window is loaded and resampled once per store into output/cache, as memory-mapped arrays that all the cells
+of that store share read-only, instead of once per cell. Every finished cell writes its model bundle to output/models/<cell>
+and a checkpoint to output/cells/<cell>.json, and appends its results to output/results.h5 (see results_store.py) under
+the run id <cell>. Running the same command again skips the finished cells, so an interrupted sweep resumes where it stopped.
+"""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from os.path import join, isfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from api import planned_loads, load_key
+from benchmark import STORES, SEQUENCE_LENGTHS, APPLIANCES, METRICS, TRAIN_BUILDINGS, TEST_BUILDINGS, QUICK_BUILDINGS
+from results_store import ResultsStore
+
+
+# Grid parameters that are classifier parameters, every other one is an experiment parameter
+CLASSIFIER_PARAMS = ('sequence_length', 'n_epochs', 'batch_size')
+
+
+def grid_cells(grid):
+    """
+    Every combination of the values of a grid, e.g. {'sample_rate': [1, 6], 'sequence_length': [99, 199]},
+    as a list of {parameter: value} dicts
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def cell_name(cell):
+    """
+    Names a cell like the trained models, e.g. 6sec_99SL, followed by its other parameters
+    """
+    parts = []
+    if 'sample_rate' in cell:
+        parts.append(str(cell['sample_rate']) + 'sec')
+    if 'sequence_length' in cell:
+        parts.append(str(cell['sequence_length']) + 'SL')
+    parts.extend(key + '-' + str(value) for key, value in sorted(cell.items()) if key not in ('sample_rate', 'sequence_length'))
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', '_'.join(parts))
+
+
+def cell_experiment(cell, classifiers=('Seq2Point', 'Seq2Seq'), quick=False):
+    """
+    The API parameters of a cell, with the classifiers as {name: parameters} since they are only built in the worker
+    """
+    sample_rate = cell.get('sample_rate', 1)
+    clf_params = {key: value for key, value in cell.items() if key in CLASSIFIER_PARAMS}
+    params = {
+        'power': {'mains': ['active'], 'appliance': ['active']},
+        'sample_rate': sample_rate,
+        'appliances': APPLIANCES,
+        'methods': {name: dict(clf_params) for name in classifiers},
+        'train': {'datasets': {'MIMOS': {'path': STORES[sample_rate], 'buildings': QUICK_BUILDINGS if quick else TRAIN_BUILDINGS}}},
+        'test': {'datasets': {'MIMOS': {'path': STORES[sample_rate], 'buildings': QUICK_BUILDINGS if quick else TEST_BUILDINGS}}, 'metrics': METRICS},
+    }
+    params.update({key: value for key, value in cell.items() if key not in CLASSIFIER_PARAMS})
+    return params
+
+
+def _cache_prefix(cache_dir, key):
+    return join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+
+def save_frame(df, path):
+    """
+    Writes a DataFrame with a DatetimeIndex as .npy files that load_frame can memory-map
+    """
+    np.save(path + '.values.npy', np.ascontiguousarray(df.values))
+    # UTC nanoseconds
+    np.save(path + '.index.npy', df.index.values.astype('datetime64[ns]').view('int64'))
+    return {'columns': [list(column) if isinstance(column, tuple) else column for column in df.columns], 'column_names': list(df.columns.names),
+            'tz': str(df.index.tz) if df.index.tz is not None else None, 'index_name': df.index.name}
+
+
+def load_frame(path, meta):
+    """
+    Reads a frame written by save_frame. Its values stay memory-mapped and read-only, so every process shares the same pages.
+    """
+    index = pd.DatetimeIndex(np.load(path + '.index.npy'), name=meta['index_name'])
+    if meta['tz'] is not None:
+        index = index.tz_localize('UTC').tz_convert(meta['tz'])
+    values = np.load(path + '.values.npy', mmap_mode='r' if len(index) else None)
+    if meta['columns'] and isinstance(meta['columns'][0], list):
+        columns = pd.MultiIndex.from_tuples([tuple(column) for column in meta['columns']], names=meta['column_names'])
+    else:
+        columns = pd.Index(meta['columns'], name=meta['column_names'][0])
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def cache_loads(loads, cache_dir):
+    """
+    Loads every (path, start, end, building, load_args) that is not cached yet and writes it to cache_dir.
+    The manifest of a building is written last, so a building is only reused once all of its files are complete.
+    """
+    from api import DataSetPool, load_building
+    os.makedirs(cache_dir, exist_ok=True)
+    datasets = DataSetPool()
+    try:
+        for path, start, end, building, load_args in loads:
+            prefix = _cache_prefix(cache_dir, load_key(path, start, end, building, *load_args))
+            if isfile(prefix + '.json'):
+                continue
+            dataset = datasets.get(path, start, end)
+            mains_df, appliance_readings = load_building(dataset, building, *load_args)
+            frames = [save_frame(df, prefix + '.' + str(i)) for i, df in enumerate([mains_df] + appliance_readings)]
+            with open(prefix + '.json.tmp', 'w') as f:
+                json.dump({'timezone': dataset.metadata.get('timezone'), 'frames': frames}, f)
+            os.replace(prefix + '.json.tmp', prefix + '.json')
+    finally:
+        datasets.close()
+    return len(loads)
+
+
+def load_cached(loads, cache_dir):
+    """
+    The 'preloaded' parameter of API for the cached loads
+    """
+    preloaded = {}
+    for path, start, end, building, load_args in loads:
+        key = load_key(path, start, end, building, *load_args)
+        prefix = _cache_prefix(cache_dir, key)
+        if not isfile(prefix + '.json'):
+            continue
+        with open(prefix + '.json') as f:
+            manifest = json.load(f)
+        frames = [load_frame(prefix + '.' + str(i), meta) for i, meta in enumerate(manifest['frames'])]
+        preloaded[key] = (manifest['timezone'], frames[0], frames[1:])
+    return preloaded
+
+
+# Variables the worker processes read for their numpy and TensorFlow thread pools
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS')
+
+
+@contextmanager
+def _worker_environment(cpus, threads, cpu_only):
+    """
+    Limits the CPU set and thread pools of the worker processes started inside it, and restores those of this process afterwards.
+    Workers inherit them when they start, and read the variables when numpy and TensorFlow start their thread pools,
+    which happens while a spawned worker imports this module, before any initializer could run.
+    """
+    variables = THREAD_VARIABLES + ('TF_CPP_MIN_LOG_LEVEL', 'CUDA_VISIBLE_DEVICES')
+    environment = {variable: os.environ.get(variable) for variable in variables}
+    affinity = os.sched_getaffinity(0) if hasattr(os, 'sched_setaffinity') else None
+    try:
+        if affinity is not None:
+            os.sched_setaffinity(0, cpus)
+        for variable in THREAD_VARIABLES:
+            os.environ[variable] = str(threads)
+        os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+        if cpu_only:
+            os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+        yield
+    finally:
+        for variable, value in environment.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+        if affinity is not None:
+            os.sched_setaffinity(0, affinity)
+
+
+def run_cell(name, params, output, threads=1):
+    """
+    Trains and tests one cell in a worker process, on the cached readings of its store. Returns its checkpoint.
+    """
+    import tensorflow as tf
+    import nilmtk_contrib.disaggregate
+    from api import API, configure_inference_threads
+    from model_bundle import export_bundle
+
+    configure_inference_threads(threads)
+    params = dict(params)
+    params['methods'] = {clf_name: getattr(nilmtk_contrib.disaggregate, clf_name)(dict(clf_params)) for clf_name, clf_params in params['methods'].items()}
+    params['preloaded'] = load_cached(planned_loads(params), join(output, 'cache'))
+    params['results_store'] = join(output, 'results.h5')
+    params['run_id'] = name
+    params['inference_intra_op_threads'] = threads
+
+    # Results of an earlier, interrupted run of the cell are replaced
+    ResultsStore(params['results_store']).remove_run(name)
+    started = time.perf_counter()
+    model = API(params)
+    export_bundle(model, join(output, 'models', name))
+    checkpoint = {
+        'name': name,
+        'seconds': time.perf_counter() - started,
+        'preloaded_buildings': len(params['preloaded']),
+        'bundle': join(output, 'models', name),
+        'errors': {key: table.to_dict() for key, table in zip(model.errors_keys, model.errors)},
+    }
+    del model, params
+    tf.keras.backend.clear_session()
+
+    with open(join(output, 'cells', name + '.json.tmp'), 'w') as f:
+        json.dump(checkpoint, f, indent=2, default=str)
+    os.replace(join(output, 'cells', name + '.json.tmp'), join(output, 'cells', name + '.json'))
+    return checkpoint
+
+
+def finished_cells(output):
+    cells_dir = join(output, 'cells')
+    if not os.path.isdir(cells_dir):
+        return set()
+    return {file_name[:-len('.json')] for file_name in os.listdir(cells_dir) if file_name.endswith('.json')}
+
+
+def run_sweep(grid, output, classifiers=('Seq2Point', 'Seq2Seq'), cpus=None, threads=1, quick=False, cpu_only=False):
+    """
+    Runs every cell of the grid that has not finished yet and returns (checkpoints of the cells run, names of the failed cells)
+
+    Parameters
+    ----------
+    grid : dict of parameter -> list of values
+        Experiment parameters (e.g. sample_rate, chunk_size) or classifier parameters (sequence_length, n_epochs, batch_size).
+    cpus : int
+        CPUs the sweep may use, all of them by default. Cells run in cpus // threads worker processes.
+    threads : int
+        Threads every worker may use for TensorFlow and numpy.
+    """
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    cpus = min(cpus or len(available), len(available))
+    workers = max(1, cpus // threads)
+
+    cells = {cell_name(cell): cell_experiment(cell, classifiers, quick) for cell in grid_cells(grid)}
+    done = finished_cells(output)
+    todo = {name: params for name, params in cells.items() if name not in done}
+    print("Sweep of " + str(len(cells)) + " cells, " + str(len(cells) - len(todo)) + " already finished, " + str(workers) + " workers x " + str(threads) + " threads")
+    os.makedirs(join(output, 'cells'), exist_ok=True)
+
+    # Every building window is loaded once, however many cells use it, and one store and sample period per worker at a time
+    loads_by_store = {}
+    for params in todo.values():
+        for load in planned_loads(params):
+            # The sample periods of a store are resampled from different levels, so they are cached in parallel
+            loads_by_store.setdefault((load[0], load[4][2]), {})[load_key(*load[:4], *load[4])] = load
+
+    checkpoints, failed = [], []
+    context = multiprocessing.get_context('spawn')
+    with _worker_environment(available[:cpus], threads, cpu_only), ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        for future in [executor.submit(cache_loads, list(loads.values()), join(output, 'cache')) for loads in loads_by_store.values()]:
+            future.result()
+
+        futures = {executor.submit(run_cell, name, params, output, threads): name for name, params in todo.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                checkpoints.append(future.result())
+                print("Finished " + name + " in " + format(checkpoints[-1]['seconds'], '.1f') + "s")
+            except Exception as e:
+                # The cell has no checkpoint, so it runs again when the sweep is resumed
+                failed.append(name)
+                print("Failed " + name + ": " + repr(e))
+    return checkpoints, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a grid of experiments in parallel, resuming an interrupted sweep")
+    parser.add_argument('output', help="folder of the cache, checkpoints, model bundles and results.h5")
+    parser.add_argument('--sample-rates', type=int, nargs='+', default=sorted(STORES), choices=sorted(STORES))
+    parser.add_argument('--sequence-lengths', type=int, nargs='+', default=SEQUENCE_LENGTHS)
+    parser.add_argument('--epochs', type=int, nargs='+', help="n_epochs values, the classifier default if not given")
+    parser.add_argument('--batch-size', type=int, nargs='+', help="batch_size values, the classifier default if not given")
+    parser.add_argument('--classifiers', nargs='+', default=['Seq2Point', 'Seq2Seq'], help="nilmtk_contrib classifiers trained in every cell")
+    parser.add_argument('--cpus', type=int, help="CPUs the sweep may use, all by default")
+    parser.add_argument('--threads', type=int, default=1, help="threads per worker process")
+    parser.add_argument('--quick', action='store_true', help="the first 30 minutes of building 1 only, as in benchmark.py")
+    parser.add_argument('--cpu', action='store_true', help="hide the GPUs from TensorFlow")
+    args = parser.parse_args()
+
+    grid = {'sample_rate': args.sample_rates, 'sequence_length': args.sequence_lengths}
+    if args.epochs:
+        grid['n_epochs'] = args.epochs
+    if args.batch_size:
+        grid['batch_size'] = args.batch_size
+    checkpoints, failed = run_sweep(grid, args.output, args.classifiers, args.cpus, args.threads, args.quick, args.cpu)
+    finished = sorted(finished_cells(args.output))
+    if finished:
+        print(ResultsStore(join(args.output, 'results.h5')).pivot(metric='f1score', run_id=finished))
+    if failed:
+        print("Failed cells, run the sweep again to retry them: " + ', '.join(failed))
+        sys.exit(1)
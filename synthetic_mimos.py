@@ -0,0 +1,324 @@
+"""
+Synthetic MIMOS-like data for scale testing.
+
+The activation signatures of every appliance (ON durations, power levels, noise and duty cycle) are learned from the
+1 second CSV files, and then used to synthesise any number of buildings and days of consistent mains and sub-meter
+readings, either as Building_N.csv files or directly as a nilmtk HDF5 store with matching metadata, e.g.
+
+python synthetic_mimos.py data/synthetic.h5 --buildings 10 --days 365
+python synthetic_mimos.py data/csv_files/synthetic --format CSV --buildings 3 --days 7 --metadata metadata/synthetic
+"""
+import os
+import re
+import copy
+import yaml
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from os.path import join
+from on_off import two_cluster_threshold, on_off_states
+
+
+APPLIANCES = ['fridge', 'aircond', 'washing_machine', 'dryer', 'kettle', 'vacuum', 'water_heater', 'oven']
+COLUMNS = ['UNIX', 'Apparent (VA)', 'Active (W)'] + APPLIANCES
+
+TIMEZONE = 'Asia/Kuala_Lumpur'
+
+# Readings below this (W) mean the appliance was not recorded in a building
+MIN_ACTIVE_POWER = 10
+
+# Shortest ON period and OFF gap (seconds) of an activation, to ignore single-sample spikes
+MIN_ON = 3
+MIN_OFF = 3
+
+# Seconds generated at a time, which bounds the memory use
+CHUNK_SECONDS = 7 * 86400
+
+
+def learn_signatures(csv_path='data/csv_files/1_sec'):
+    """
+    Learns the activation signature of every appliance, and the base load and power factor of the mains, from the Building_N.csv files.
+
+    Returns
+    -------
+    dict of appliance -> {'on_durations', 'off_durations', 'levels', 'noise'} (arrays of observed values) and 'duty_cycle',
+    plus 'mains' -> {'base_load', 'base_load_std', 'power_factor'}
+    """
+    observed = {appliance: {'on_durations': [], 'off_durations': [], 'levels': [], 'noise': [], 'on_time': 0, 'time': 0} for appliance in APPLIANCES}
+    residuals = []
+    ratios = []
+    for file_name in sorted(os.listdir(csv_path)):
+        if not re.match(r'Building_\d+\.csv$', file_name):
+            continue
+        df = pd.read_csv(join(csv_path, file_name), usecols=COLUMNS, dtype={column: 'float64' for column in COLUMNS[1:]})
+        for appliance in APPLIANCES:
+            values = df[appliance].values
+            if np.nanmax(values) < MIN_ACTIVE_POWER:
+                continue
+            threshold = max(two_cluster_threshold(values), MIN_ACTIVE_POWER)
+            states = on_off_states(values, threshold, hysteresis=0.1 * threshold, min_on=MIN_ON, min_off=MIN_OFF)
+            starts, ends = _runs(states)
+            if len(starts) == 0:
+                continue
+            stats = observed[appliance]
+            stats['on_durations'].extend(ends - starts)
+            stats['off_durations'].extend(starts[1:] - ends[:-1])
+            for start, end in zip(starts, ends):
+                stats['levels'].append(np.nanmean(values[start:end]))
+                stats['noise'].append(np.nanstd(values[start:end]))
+            stats['on_time'] += int(states.sum())
+            stats['time'] += len(values)
+
+        # The load that no sub-meter explains, while the mains were recorded
+        mains = df['Active (W)'].values
+        recorded = mains > 0
+        residuals.append(np.clip(mains[recorded] - df[APPLIANCES].values[recorded].sum(axis=1), 0, None))
+        ratios.append(df['Apparent (VA)'].values[recorded] / mains[recorded])
+
+    signatures = {}
+    for appliance, stats in observed.items():
+        if not stats['on_durations']:
+            raise RuntimeError('Could not find any activation of ' + appliance + ' in ' + csv_path + '. Please check the provided folder.')
+        signatures[appliance] = {
+            'on_durations': np.array(stats['on_durations'], dtype='int64'),
+            'off_durations': np.array(stats['off_durations'], dtype='int64'),
+            'levels': np.array(stats['levels']),
+            'noise': np.array(stats['noise']),
+            'duty_cycle': stats['on_time'] / stats['time'],
+        }
+    residuals = np.concatenate(residuals)
+    signatures['mains'] = {
+        'base_load': float(np.median(residuals)),
+        'base_load_std': float(np.std(residuals[residuals < np.percentile(residuals, 90)])),
+        'power_factor': float(np.median(np.concatenate(ratios))),
+    }
+    return signatures
+
+
+def _runs(states):
+    """
+    Returns the start and end (exclusive) positions of the ON runs of a boolean array
+    """
+    edges = np.diff(np.r_[0, states.astype('int8'), 0])
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _activations(signature, n_seconds, rng, duty_cycle=None):
+    """
+    Draws the activations of one appliance over n_seconds: (starts, ends, levels, noise), all vectorized.
+    OFF gaps are resampled from the observed ones, scaled so the appliance keeps its duty cycle.
+    """
+    duty_cycle = signature['duty_cycle'] if duty_cycle is None else duty_cycle
+    mean_on = signature['on_durations'].mean()
+    mean_off = mean_on * (1 - duty_cycle) / max(duty_cycle, 1e-6)
+    # Enough activations to cover the period, with margin
+    n = int(n_seconds / (mean_on + mean_off) * 1.5) + 10
+
+    picks = rng.integers(len(signature['on_durations']), size=n)
+    on = signature['on_durations'][picks]
+    if len(signature['off_durations']):
+        off = rng.choice(signature['off_durations'], size=n).astype('float64')
+        off *= mean_off / max(off.mean(), 1)
+    else:
+        off = rng.exponential(mean_off, size=n)
+    off = np.maximum(off, MIN_OFF).astype('int64')
+
+    # Start at a random point of the first OFF gap, so buildings are not in phase
+    starts = np.cumsum(off) - rng.integers(off[0] + 1) + np.r_[0, np.cumsum(on)[:-1]]
+    ends = starts + on
+    keep = ends > 0
+    keep &= starts < n_seconds
+    # Activations with the same power level and noise as an observed one
+    return starts[keep], ends[keep], signature['levels'][picks][keep], signature['noise'][picks][keep]
+
+
+def generate_building(signatures, start, n_seconds, seed=None, duty_cycles=None, chunk_seconds=CHUNK_SECONDS, tz=TIMEZONE):
+    """
+    Synthesises one building at 1 second.
+
+    Parameters
+    ----------
+    signatures : dict, see learn_signatures
+    start : str or pd.Timestamp
+        First timestamp, in local time.
+    n_seconds : int
+    seed : int, optional
+    duty_cycles : dict of appliance -> fraction of the time it is ON, overriding the learned duty cycles
+    chunk_seconds : int
+        Seconds generated at a time.
+
+    Returns
+    -------
+    iterator of dataframes with the columns of the Building_N.csv files (without Timestamp), indexed by local time
+    """
+    duty_cycles = {} if duty_cycles is None else duty_cycles
+    rng = np.random.default_rng(seed)
+    activations = {appliance: _activations(signatures[appliance], n_seconds, rng, duty_cycles.get(appliance)) for appliance in APPLIANCES}
+    mains = signatures['mains']
+    base_load = max(rng.normal(mains['base_load'], mains['base_load_std'] / 4), 0)
+    first_second = int(pd.Timestamp(start, tz=tz).timestamp())
+
+    for chunk_start in range(0, n_seconds, chunk_seconds):
+        chunk_end = min(chunk_start + chunk_seconds, n_seconds)
+        n = chunk_end - chunk_start
+        seconds = np.arange(chunk_start, chunk_end)
+        df = pd.DataFrame(index=pd.to_datetime(first_second + seconds, unit='s', utc=True).tz_convert(tz))
+        total = np.zeros(n, dtype='float32')
+        for appliance in APPLIANCES:
+            starts, ends, levels, noise = activations[appliance]
+            # Paint the activations overlapping the chunk as steps, whose cumulative sum is the level and noise of every second
+            first, last = np.searchsorted(ends, chunk_start, side='right'), np.searchsorted(starts, chunk_end, side='left')
+            on_at = np.clip(starts[first:last] - chunk_start, 0, n)
+            off_at = np.clip(ends[first:last] - chunk_start, 0, n)
+            steps = np.zeros((2, n + 1))
+            np.add.at(steps, (slice(None), on_at), [levels[first:last], noise[first:last]])
+            np.add.at(steps, (slice(None), off_at), [-levels[first:last], -noise[first:last]])
+            level, spread = np.cumsum(steps[:, :n], axis=1).astype('float32')
+            on = np.flatnonzero(level > 0.5)
+            power = np.zeros(n, dtype='float32')
+            power[on] = np.clip(level[on] + rng.standard_normal(len(on), dtype='float32') * spread[on], 0, None)
+            df[appliance] = power
+            total += power
+
+        # A slowly varying base load on top of the appliances (moving average of white noise)
+        window = 60
+        walk = np.cumsum(rng.standard_normal(n + window))
+        wander = (walk[window:] - walk[:-window]) / np.sqrt(window)
+        active = total + np.clip(base_load + wander * mains['base_load_std'] / 4, 0, None)
+        df.insert(0, 'Active (W)', active.astype('float32'))
+        df.insert(0, 'Apparent (VA)', (active * mains['power_factor']).astype('float32'))
+        df.insert(0, 'UNIX', first_second + seconds)
+        yield df
+
+
+def generate_mimos(output, n_buildings, n_days, format='HDF', start='2023-01-01', seed=0, csv_path='data/csv_files/1_sec',
+                   metadata_path=None, metadata_template='metadata/1_sec', duty_cycles=None, complevel=9, complib='blosc', resolutions=None):
+    """
+    Parameters
+    ----------
+    output : str
+        HDF5 file (format 'HDF') or folder of Building_N.csv files (format 'CSV').
+    n_buildings : int
+    n_days : int
+    format : str
+        'HDF' writes a nilmtk store directly, 'CSV' the input files of convert_mimos.
+    start : str
+        First day, in local time.
+    seed : int
+        Every building uses seed + building number, so runs are reproducible.
+    csv_path : str
+        Folder of the 1 second CSV files the signatures are learned from.
+    metadata_path : str, optional
+        Folder the matching metadata YAML files are written to, e.g. metadata/synthetic for convert_mimos.
+        Required for CSV output, a temporary folder is used for HDF output if not given.
+    metadata_template : str
+        Metadata folder the buildings and meter devices are copied from.
+    duty_cycles : dict of appliance -> fraction of the time it is ON, overriding the learned duty cycles
+    complevel, complib :
+        Compression of the HDF5 tables.
+    resolutions : list of int, optional
+        Levels stored next to the readings in the HDF5 file (see convert_mimos). Defaults to convert_mimos.RESOLUTIONS.
+    """
+    if format == 'CSV' and metadata_path is None:
+        raise ValueError('metadata_path is required for CSV output, since convert_mimos reads the metadata from there')
+
+    signatures = learn_signatures(csv_path)
+    n_seconds = int(n_days * 86400)
+    start = pd.Timestamp(start)
+    temp_dir = tempfile.mkdtemp() if metadata_path is None else None
+    metadata_path = metadata_path or temp_dir
+    try:
+        _write_metadata(metadata_path, metadata_template, n_buildings, start, n_seconds)
+        if format == 'HDF':
+            _write_hdf(output, signatures, n_buildings, start, n_seconds, seed, duty_cycles, metadata_path, complevel, complib, resolutions)
+        else:
+            os.makedirs(output, exist_ok=True)
+            for building in range(1, n_buildings + 1):
+                with open(join(output, 'Building_' + str(building) + '.csv'), 'w', newline='') as f:
+                    f.write(','.join(['Timestamp'] + COLUMNS) + '\n')
+                    for df in generate_building(signatures, start, n_seconds, seed + building, duty_cycles):
+                        df.index = df.index.strftime('%Y-%m-%d %H:%M:%S')
+                        df.to_csv(f, header=False, float_format='%.2f')
+                print("Generated building", building)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    print("Done generating " + str(n_buildings) + " synthetic buildings of " + str(n_days) + " days in " + output + "!")
+
+
+def _write_hdf(output, signatures, n_buildings, start, n_seconds, seed, duty_cycles, metadata_path, complevel, complib, resolutions):
+    from nilmtk.utils import get_datastore
+    from nilmtk.datastore import Key
+    from nilm_metadata import save_yaml_to_datastore
+    from convert_mimos import RESOLUTIONS, AGGREGATIONS, USECOLS, Resampler, append_levels, channel_df, add_resolutions_metadata, resolution_location
+
+    resolutions = RESOLUTIONS if resolutions is None else resolutions
+    with pd.HDFStore(output, mode='w', complevel=complevel, complib=complib) as store:
+        for building in range(1, n_buildings + 1):
+            # Meters are numbered in the column order of convert_mimos
+            keys = [str(Key(building=building, meter=chan_id)) for chan_id in range(1, len(USECOLS))]
+            resamplers = [Resampler(period, AGGREGATIONS) for period in resolutions]
+            for df in generate_building(signatures, start, n_seconds, seed + building, duty_cycles):
+                df = df[USECOLS[1:]]
+                for key, col in zip(keys, df.columns):
+                    store.append(key, channel_df(df, col), format='table', index=False)
+                for resampler in resamplers:
+                    append_levels(store, keys, resampler, resampler.add(df))
+            for resampler in resamplers:
+                append_levels(store, keys, resampler, resampler.flush())
+            for key in keys:
+                for location in [key] + [resolution_location(key, period) for period in resolutions]:
+                    if location in store:
+                        store.create_table_index(location, columns=['index'], kind='full', optlevel=9)
+            print("Generated building", building)
+
+    store = get_datastore(output, 'HDF', mode='a')
+    save_yaml_to_datastore(metadata_path, store)
+    metadata = store.load_metadata('/')
+    add_resolutions_metadata(metadata, resolutions, AGGREGATIONS)
+    store.save_metadata('/', metadata)
+    store.close()
+
+
+def _write_metadata(metadata_path, metadata_template, n_buildings, start, n_seconds, tz=TIMEZONE):
+    """
+    Writes the dataset, meter device and building YAML files of the synthetic buildings, based on the MIMOS metadata
+    """
+    os.makedirs(metadata_path, exist_ok=True)
+    timeframe = {'start': pd.Timestamp(start, tz=tz).isoformat(), 'end': (pd.Timestamp(start, tz=tz) + pd.Timedelta(seconds=n_seconds - 1)).isoformat()}
+
+    with open(join(metadata_template, 'dataset.yaml')) as f:
+        dataset = yaml.safe_load(f)
+    dataset.update({'name': 'SYNTHETIC', 'long_name': 'Synthetic ' + dataset.get('long_name', 'MIMOS'),
+                    'description': 'Synthetic data generated from the activation signatures of the MIMOS dataset',
+                    'number_of_buildings': n_buildings, 'timeframe': timeframe})
+    with open(join(metadata_path, 'dataset.yaml'), 'w') as f:
+        yaml.safe_dump(dataset, f, sort_keys=False)
+    shutil.copyfile(join(metadata_template, 'meter_devices.yaml'), join(metadata_path, 'meter_devices.yaml'))
+
+    # Every MIMOS building has the same meters
+    with open(join(metadata_template, 'building1.yaml')) as f:
+        template = yaml.safe_load(f)
+    for building in range(1, n_buildings + 1):
+        metadata = copy.deepcopy(template)
+        metadata['instance'] = building
+        for meter in metadata['elec_meters'].values():
+            meter['timeframes'] = dict(timeframe)
+        with open(join(metadata_path, 'building' + str(building) + '.yaml'), 'w') as f:
+            yaml.safe_dump(metadata, f, sort_keys=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic MIMOS-like buildings")
+    parser.add_argument('output', help="HDF5 file, or folder of Building_N.csv files with --format CSV")
+    parser.add_argument('--buildings', type=int, default=7, help="number of buildings")
+    parser.add_argument('--days', type=float, default=1, help="days of 1 second data per building")
+    parser.add_argument('--format', choices=['HDF', 'CSV'], default='HDF')
+    parser.add_argument('--start', default='2023-01-01', help="first day, in local time")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv-path', default='data/csv_files/1_sec', help="CSV files the signatures are learned from")
+    parser.add_argument('--metadata', help="folder the metadata YAML files are written to (required for CSV)")
+    args = parser.parse_args()
+    generate_mimos(args.output, args.buildings, args.days, args.format, args.start, args.seed, args.csv_path, args.metadata)
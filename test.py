@@ -3,9 +3,34 @@ import pandas as pd
 import os
 from os.path import join
 import tempfile
+import pickle
+import shutil
 from seleniumbase import BaseCase
 from selenium.webdriver.common.by import By
-from streamlit_app import validate_timestamp, validate_h5_file
+import streamlit_app
+from streamlit_app import validate_timestamp, validate_h5_file, ResultCache, load_shared_model, disaggregate_upload
+import threading
+import time
+import numpy as np
+from nilmtk.timeframe import TimeFrame
+from api import API, align_frames, assemble_ground_truth, assemble_predictions, build_aggregate, disaggregate_in_blocks, DataSetPool, load_building, load_key
+from metrics import compute_metrics, metric_table
+from on_off import two_cluster_threshold, on_off_states
+from h5_validation import find_h5_errors
+from convert_mimos import convert_mimos, _plan_building, Resampler, _convert, _convert_streaming, MANIFEST_ATTR
+import tables
+from preprocess_mimos import merge_sessions
+from benchmark import find_regressions
+from synthetic_mimos import generate_building, APPLIANCES
+from timings import Timings
+from streaming import StreamingDisaggregator
+from chart_data import ChartPyramid
+from inference_server import InferenceServer, HTTPError
+import asyncio
+import json
+from results_store import ResultsStore
+from model_bundle import export_bundle, load_bundle, import_model, LazyNetworks
+from sweep import grid_cells, cell_name, save_frame, load_frame, _worker_environment, THREAD_VARIABLES
 
 @pytest.mark.parametrize("building_number", range(1, 8))
 def test_merge_main_files(building_number):
@@ -174,6 +199,737 @@ def test_validate_h5_file():
     # Test the function with a valid HDF5 file
     assert validate_h5_file('./data/mimos_1_sec.h5')
 
+def test_result_cache():
+    cache = ResultCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1 and cache.get('missing') is None
+    # 'b' is now the least recently used entry
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    cache.put('a', 4)
+    assert list(cache.entries) == ['c', 'a'] and cache.get('a') == 4
+
+def test_load_shared_model(monkeypatch):
+    imported = []
+    monkeypatch.setattr(streamlit_app, 'import_model', lambda filename: imported.append(filename) or object())
+    load_shared_model.clear()
+    model, model_lock = load_shared_model('model.pickle')
+    assert load_shared_model('model.pickle') == (model, model_lock)
+    assert load_shared_model('other.pickle')[0] is not model
+    assert imported == ['model.pickle', 'other.pickle']
+    load_shared_model.clear()
+
+class SlowModel():
+
+    """
+    Stands in for the trained API in the app, taking a while to disaggregate
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def test_jointly(self, params):
+        self.calls += 1
+        time.sleep(0.2)
+        index = pd.date_range('2022-11-08', periods=200, freq='s')
+        self.pred_overall = {'Seq2Seq': pd.DataFrame({'kettle': np.r_[np.zeros(100), np.full(100, 2000.0)]}, index=index)}
+
+def test_disaggregate_upload(monkeypatch):
+    shared_model = (SlowModel(), threading.Lock())
+    model = shared_model[0]
+    monkeypatch.setattr(streamlit_app, 'load_shared_model', lambda filename: shared_model)
+    result_cache = ResultCache(2)
+    monkeypatch.setattr(streamlit_app, 'get_result_cache', lambda: result_cache)
+    test_params = {'buildings': {1: {'start_time': '2022-11-08 00:00:00', 'end_time': '2022-11-08 00:03:20'}}}
+
+    # Sessions uploading the same file at the same time share one run of the model
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(disaggregate_upload(b'upload', 'digest', test_params))) for session in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert model.calls == 1 and all(result is results[0] for result in results)
+
+    predictions, appliances, charts = disaggregate_upload(b'upload', 'digest', test_params)
+    assert model.calls == 1 and appliances == ['kettle']
+    assert list(predictions['kettle ON/OFF states'].iloc[[0, -1]]) == [0, 1]
+    disaggregate_upload(b'other upload', 'other digest', test_params)
+    assert model.calls == 2
+
+def test_align_frames():
+    index = pd.date_range('2022-11-08', periods=6, freq='s')
+    mains = pd.DataFrame({'mains': [1, 2, np.nan, 4, 5, 6]}, index=index, dtype='float64')
+    fridge = pd.DataFrame({'fridge': [1, 1, 1, np.nan, 1, 1]}, index=index, dtype='float64')
+    kettle = pd.DataFrame({'kettle': [2, 2, 2, 2, 2]}, index=index[1:], dtype='float64')
+
+    aligned_index, block, column_slices = align_frames(mains, [fridge, kettle])
+
+    # Timestamps missing or NaN in any frame are dropped from all of them
+    assert list(aligned_index) == [index[1], index[4], index[5]]
+    assert block.dtype == np.float32
+    assert list(block[:, column_slices[0]].ravel()) == [2, 5, 6]
+    assert list(block[:, column_slices[2]].ravel()) == [2, 2, 2]
+
+def test_align_frames_duplicate_timestamps():
+    index = pd.date_range('2022-11-08', periods=4, freq='s')
+    mains = pd.DataFrame({'mains': [1, 2, 3, 4]}, index=index, dtype='float64')
+    # Readings repeated where two loaded sections meet, and out of order
+    fridge = pd.DataFrame({'fridge': [10, 30, 30, 31, 20, np.nan]}, index=index[[0, 2, 2, 2, 1, 3]], dtype='float64')
+
+    aligned_index, block, column_slices = align_frames(mains, [fridge])
+    assert list(aligned_index) == list(index[:3])
+    assert list(block[:, column_slices[1]].ravel()) == [10, 20, 30]
+    assert list(block[:, column_slices[0]].ravel()) == [1, 2, 3]
+
+def test_build_aggregate():
+    index = pd.date_range('2022-11-08', periods=4, freq='s')
+    fridge = pd.DataFrame({'power': [100.0, 100.0, 0.0, 0.0]}, index=index)
+    # Misaligned readings are aligned to the first appliance, and readings missing there count as NaN
+    kettle = pd.DataFrame({'power': [2000.0, 2000.0, 2000.0]}, index=index[[3, 1, 0]])
+
+    aggregate = build_aggregate([fridge, kettle], baseline=50)
+    assert aggregate.index.equals(index) and list(aggregate.columns) == ['power']
+    assert aggregate.dtypes['power'] == np.float32
+    assert list(aggregate['power'].iloc[[0, 1, 3]]) == [2150, 2150, 2050] and np.isnan(aggregate['power'].iloc[2])
+
+    # Noise is clipped at 0, and one generator gives different but reproducible noise on every call
+    off = pd.DataFrame({'power': np.zeros(1000)}, index=pd.date_range('2022-11-08', periods=1000, freq='s'))
+    rng = np.random.default_rng(0)
+    first, second = build_aggregate([off], noise_std=10, rng=rng), build_aggregate([off], noise_std=10, rng=rng)
+    assert (first['power'] >= 0).all() and (first['power'] == 0).mean() > 0.4
+    assert not first.equals(second)
+    assert first.equals(build_aggregate([off], noise_std=10, rng=np.random.default_rng(0)))
+    assert (build_aggregate([off], noise_std=10, baseline=1000, rng=rng)['power'] - 1000).abs().between(0, 60).all()
+
+def test_assemble_ground_truth():
+    index = pd.date_range('2022-11-08', periods=5, freq='s')
+    fridge = pd.DataFrame({'power': [1.0, 2.0, 3.0, 4.0, 5.0]}, index=index)
+    kettle = pd.DataFrame({'power': [20.0, 40.0]}, index=index[[3, 1]])
+
+    gt_index, values, meters = assemble_ground_truth([('fridge', [fridge]), ('kettle', [kettle])])
+    assert gt_index.equals(index) and meters == ['fridge', 'kettle']
+    assert values.dtype == np.float32 and values.flags.f_contiguous
+    expected = pd.concat([fridge['power'], kettle['power']], axis=1).values
+    assert np.array_equal(values, expected, equal_nan=True)
+
+    gt_index, values, meters = assemble_ground_truth([])
+    assert len(gt_index) == 0 and values.shape == (0, 0) and meters == []
+
+def test_assemble_predictions():
+    chunks = [pd.DataFrame({'fridge': [1.0, 2.0, 3.0], 'kettle': [10.0, 20.0, 30.0]}),
+              pd.DataFrame({'fridge': [4.0, 5.0], 'kettle': [40.0, 50.0]})]
+    expected = pd.concat(chunks).values
+
+    # Every chunk is written after the previous one
+    columns, values = assemble_predictions(chunks)
+    assert columns == ['fridge', 'kettle'] and values.dtype == np.float32
+    assert np.array_equal(values, expected)
+
+    # Padded predictions are cut to the length of the ground truth, which may end inside the first chunk
+    assert np.array_equal(assemble_predictions(chunks, 4)[1], expected[:4])
+    assert np.array_equal(assemble_predictions(chunks, 2)[1], expected[:2])
+
+    # Rows without a prediction stay NaN
+    columns, values = assemble_predictions(chunks, 7)
+    assert np.array_equal(values[:5], expected) and np.isnan(values[5:]).all()
+
+    columns, values = assemble_predictions([], 3)
+    assert columns == [] and values.shape == (3, 0)
+
+def test_compute_metrics():
+    gt = pd.DataFrame({'kettle': [0, 20, 30, 0], 'fridge': [5, 5, 5, 5]}, dtype='float32')
+    pred = pd.DataFrame({'kettle': [0, 25, 0, 15], 'fridge': [5, 5, 5, 6]}, dtype='float32')
+
+    results = compute_metrics(gt, {'Seq2Point': pred, 'Perfect': gt}, ['mae', 'rmse', 'f1score', 'not_a_metric'])
+    mae_table = metric_table(results, 'mae', ['Seq2Point', 'Perfect'], ['kettle', 'fridge'])
+
+    assert mae_table.loc['kettle', 'Seq2Point'] == pytest.approx(12.5)
+    assert mae_table.loc['fridge', 'Seq2Point'] == pytest.approx(0.25)
+    assert (mae_table['Perfect'] == 0).all()
+    assert not (results['metric'] == 'not_a_metric').any()
+
+def test_on_off_states():
+    power = np.array([0, 1, 0, 2000, 2010, 1990, 0, 2000, 2000, 1, 0, 0, 1500, 0, 0], dtype='float32')
+
+    threshold = two_cluster_threshold(power)
+    assert 2 < threshold < 1500
+
+    # The single-sample OFF gap is filled and the single-sample ON spike is dropped
+    states = on_off_states(power, threshold, min_on=2, min_off=2)
+    assert states.dtype == bool
+    assert list(np.flatnonzero(states)) == [3, 4, 5, 6, 7, 8]
+
+def test_find_h5_errors():
+    # The bundled dataset is valid for every building
+    assert find_h5_errors('./data/mimos_1_sec.h5') == {}
+
+    # Anything else is reported as a problem with the whole file
+    with tempfile.NamedTemporaryFile(suffix='.h5') as not_h5:
+        not_h5.write(b'not an HDF5 file')
+        not_h5.flush()
+        errors = find_h5_errors(not_h5.name)
+    assert list(errors) == [None]
+
+def test_plan_building():
+    with tempfile.TemporaryDirectory() as folder:
+        csv_filename = join(folder, 'Building_1.csv')
+        with open(csv_filename, 'w') as f:
+            f.write('UNIX,Active (W)\n1667865600,100\n')
+        offset, digest, size = _plan_building(csv_filename, None)
+        assert offset == 0
+        entry = {'size': size, 'sha256': digest, 'rows': 1}
+
+        # Unchanged files are skipped
+        assert _plan_building(csv_filename, entry) is None
+
+        # Rows added at the end are appended from the previous end of the file
+        with open(csv_filename, 'a') as f:
+            f.write('1667865601,120\n')
+        assert _plan_building(csv_filename, entry)[0] == size
+
+        # Any other change converts the building from scratch
+        with open(csv_filename, 'w') as f:
+            f.write('UNIX,Active (W)\n1667865600,101\n1667865601,120\n')
+        assert _plan_building(csv_filename, entry)[0] == 0
+
+def test_convert_streaming():
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(join(folder, 'csv'))
+        pd.read_csv('data/csv_files/1_sec/Building_1.csv', nrows=103).to_csv(join(folder, 'csv', 'Building_2.csv'), index=False)
+        # Building 10 has two readings out of order across a chunk boundary
+        rows = pd.read_csv('data/csv_files/1_sec/Building_2.csv', nrows=57)
+        rows.iloc[[19, 20]] = rows.iloc[[20, 19]].values
+        rows.to_csv(join(folder, 'csv', 'Building_10.csv'), index=False)
+
+        _convert_streaming(join(folder, 'csv'), join(folder, 'streamed.h5'), 'Asia/Kuala_Lumpur', chunksize=10, n_workers=2,
+                           complevel=9, complib='blosc', rebuild=True)
+        with pd.HDFStore(join(folder, 'reference.h5'), mode='w') as reference:
+            _convert(join(folder, 'csv'), reference, 'Asia/Kuala_Lumpur')
+
+        with pd.HDFStore(join(folder, 'streamed.h5'), mode='r') as streamed, pd.HDFStore(join(folder, 'reference.h5'), mode='r') as reference:
+            assert sorted(streamed.keys()) == sorted(reference.keys()) and len(reference.keys()) == 2 * 9
+            for key in reference.keys():
+                expected = reference[key]
+                pd.testing.assert_frame_equal(streamed[key], expected)
+                assert expected.index.is_monotonic_increasing
+        # The buildings are recorded in the order of their numbers, not of their file names
+        with tables.open_file(join(folder, 'streamed.h5'), mode='r') as streamed:
+            manifest = streamed.root._v_attrs[MANIFEST_ATTR]
+        assert list(manifest) == [2, 10] and [manifest[house]['rows'] for house in manifest] == [103, 57]
+
+def test_resampler():
+    index = pd.date_range('2022-11-08', periods=100, freq='s', tz='Asia/Kuala_Lumpur')
+    df = pd.DataFrame({'fridge': np.arange(100, dtype='float32'), 'kettle': np.where(np.arange(100) % 7 == 0, np.nan, 2000).astype('float32')}, index=index)
+    df = df.drop(index[40:55])
+
+    # Streaming the readings in chunks gives the same levels as resampling all of them at once
+    resampler = Resampler(6, ['mean', 'max'])
+    levels = [resampler.add(df.iloc[start:start + 17]) for start in range(0, len(df), 17)] + [resampler.flush()]
+    for aggregation in ['mean', 'max']:
+        streamed = pd.concat([level[aggregation] for level in levels if aggregation in level])
+        expected = getattr(df.resample('6s'), aggregation)().dropna(how='all')
+        assert streamed.index.equals(expected.index)
+        assert np.allclose(streamed.values, expected.values, equal_nan=True)
+
+@pytest.fixture(scope='module')
+def small_store(tmp_path_factory):
+    """
+    The first 10 minutes of every building, converted with a 6 second level
+    """
+    folder = str(tmp_path_factory.mktemp('mimos'))
+    os.makedirs(join(folder, '1_sec'))
+    for file_name in os.listdir('data/csv_files/1_sec'):
+        pd.read_csv(join('data/csv_files/1_sec', file_name), nrows=600).to_csv(join(folder, '1_sec', file_name), index=False)
+    convert_mimos(join(folder, '1_sec'), join(folder, 'mimos.h5'), '1_sec', chunksize=250, n_workers=2, resolutions=[6])
+    return join(folder, 'mimos.h5')
+
+POWER = {'mains': ['active'], 'appliance': ['active']}
+
+def test_load_resolution_levels(small_store, caplog):
+    datasets = DataSetPool()
+    try:
+        dataset = datasets.get(small_store)
+        meter = dataset.buildings[1].elec[1]
+        readings, _ = load_building(dataset, 1, [], POWER, 1)
+        level, (kettle,) = load_building(dataset, 1, ['kettle'], POWER, 6)
+        assert meter.sample_period() == 6
+        assert 'resampled' not in caplog.text
+        # No 3 second level, so the readings are resampled when loaded, with a warning
+        resampled, _ = load_building(dataset, 1, [], POWER, 3)
+        assert meter.sample_period() == 1
+        assert 'no 3 second level' in caplog.text
+    finally:
+        datasets.close()
+
+    assert (level.index.to_series().diff().dropna() >= pd.Timedelta(seconds=6)).all() and kettle.index.equals(level.index)
+    expected = readings.iloc[:, 0].resample('6s').mean().dropna()
+    assert np.allclose(level.iloc[:, 0].values, expected.reindex(level.index).values, atol=0.01, equal_nan=True)
+    assert (resampled.index.to_series().diff().dropna() == pd.Timedelta(seconds=3)).all()
+
+def test_dataset_pool(small_store, tmp_path):
+    other_store = str(tmp_path / 'copy.h5')
+    shutil.copy(small_store, other_store)
+    pool = DataSetPool()
+    try:
+        dataset = pool.get(small_store, '2022-09-27 00:00:00', '2022-09-27 00:05:00')
+        assert dataset.store.window.start == pd.Timestamp('2022-09-27 00:00:00', tz='Asia/Kuala_Lumpur')
+        # One handle per path, with the window of the latest call
+        assert pool.get(small_store) is dataset and dataset.store.window.start is None and dataset.store.window.end is None
+        other = pool.get(other_store)
+        assert other is not dataset and list(pool.datasets) == [small_store, other_store]
+
+        # Exported models start with an empty pool instead of the open handles
+        assert pickle.loads(pickle.dumps(pool)).datasets == {}
+    finally:
+        pool.close()
+    assert not dataset.store.store.is_open and not other.store.store.is_open and pool.datasets == {}
+
+def loading_api(**attrs):
+    # An API with only the attributes load_buildings uses, without running an experiment
+    api = API.__new__(API)
+    api.__dict__.update({'appliances': ['kettle'], 'power': POWER, 'sample_period': 6, 'load_workers': None, 'preloaded': {}}, **attrs)
+    return api
+
+def test_load_buildings_preloaded(small_store):
+    d = {'MIMOS': {'path': small_store, 'buildings': {building: {'start_time': None, 'end_time': None} for building in [1, 2, 3]}}}
+    mains = pd.DataFrame({'power': [0.0]}, index=pd.date_range('2022-09-27', periods=1, tz='Asia/Kuala_Lumpur'))
+    preloaded = ('Asia/Kuala_Lumpur', mains, [mains])
+    api = loading_api(load_workers=2, preloaded={load_key(small_store, None, None, 2, ['kettle'], POWER, 6, None, False, True): preloaded})
+    try:
+        loaded = list(api.load_buildings(d))
+    finally:
+        api.close()
+
+    assert [building for dataset, building, timezone, mains_df, appliance_readings in loaded] == [1, 2, 3]
+    assert loaded[1][2:] == preloaded and len(loaded[0][3]) > 1
+    # The buildings that were not preloaded are still loaded by the workers
+    spans = api.timings.to_frame()
+    loads = spans[spans['name'] == 'load'].set_index('building')
+    assert list(loads['workers'].fillna(0)) == [2, 0, 2] and loads.loc[2, 'preloaded'] == True
+
+def test_load_buildings_in_parallel(small_store):
+    d = {'MIMOS': {'path': small_store, 'buildings': {building: {'start_time': None, 'end_time': None} for building in [3, 1, 2]}}}
+    sequential, parallel = loading_api(), loading_api(load_workers=2)
+    try:
+        expected, loaded = list(sequential.load_buildings(d)), list(parallel.load_buildings(d))
+    finally:
+        sequential.close()
+        parallel.close()
+
+    # Yielded in the order of d, whichever worker finishes first
+    assert [building for dataset, building, timezone, mains_df, appliance_readings in loaded] == [3, 1, 2]
+    for (dataset, building, timezone, mains_df, appliance_readings), expected_building in zip(loaded, expected):
+        assert (dataset, building, timezone) == expected_building[:3] and timezone == 'Asia/Kuala_Lumpur'
+        pd.testing.assert_frame_equal(mains_df, expected_building[3])
+        for readings, expected_readings in zip(appliance_readings, expected_building[4]):
+            pd.testing.assert_frame_equal(readings, expected_readings)
+        assert len(appliance_readings) == len(expected_building[4]) == 1
+
+class FakeMeter():
+
+    """
+    Stands in for an ElecMeter: loads its readings in chunks, or over the given section in two parts
+    """
+
+    def __init__(self, readings, chunks=()):
+        self.readings = readings
+        self.chunks = chunks
+
+    def load(self, chunksize=None, sections=None, **kwargs):
+        if sections is None:
+            return iter(self.chunks)
+        timeframe, = sections
+        section = self.readings[(self.readings.index >= timeframe.start) & (self.readings.index < timeframe.end)]
+        return iter([section.iloc[:len(section) // 2], section.iloc[len(section) // 2:]] if len(section) > 1 else [section])
+
+def test_load_aligned_chunks():
+    index = pd.date_range('2022-09-27', periods=10, freq='6s', tz='Asia/Kuala_Lumpur')
+    mains = pd.DataFrame({'power': np.arange(10.0)}, index=index)
+    kettle = pd.DataFrame({'power': np.arange(10.0) * 10}, index=index)
+    chunks = [mains.iloc[:4], mains.iloc[:0], mains.iloc[4:]]
+    elec = type('Elec', (), {'meters': [], 'mains': lambda self: FakeMeter(mains, chunks), '__getitem__': lambda self, name: FakeMeter(kettle)})()
+    dataset = type('DataSet', (), {'metadata': {}, 'buildings': {1: type('Building', (), {'elec': elec})()}})()
+    api = loading_api(chunk_size=4)
+
+    loaded = list(api.load_aligned_chunks(dataset, 1))
+    assert [len(mains_df) for mains_df, appliance_readings in loaded] == [4, 0, 6]
+    # The appliance readings cover the timeframe of their mains chunk, even when they are loaded in several parts
+    assert loaded[1][1][0].empty
+    for mains_df, (kettle_df,) in loaded[::2]:
+        assert kettle_df.index.equals(mains_df.index)
+        assert np.array_equal(kettle_df['power'].values, mains_df['power'].values * 10)
+
+    # A chunk's own timeframe is used if it has one, otherwise it ends one sample period after its last reading
+    assert api.chunk_timeframe(mains.iloc[:0]) is None
+    timeframe = api.chunk_timeframe(mains.iloc[4:])
+    assert (timeframe.start, timeframe.end) == (index[4], index[-1] + pd.Timedelta(seconds=6))
+    chunk = mains.iloc[:4].copy()
+    chunk.timeframe = TimeFrame(start=index[0], end=index[5])
+    assert api.chunk_timeframe(chunk) is chunk.timeframe
+
+def test_load_aligned_chunks_from_store(small_store):
+    datasets = DataSetPool()
+    for sample_period, chunk_size in [(1, 250), (6, 40)]:
+        api = loading_api(appliances=['fridge', 'kettle'], sample_period=sample_period, chunk_size=chunk_size)
+        try:
+            loaded = list(api.load_aligned_chunks(datasets.get(small_store), 1))
+        finally:
+            datasets.close()
+        assert len(loaded) > 1
+        for mains_df, appliance_readings in loaded:
+            timeframe = api.chunk_timeframe(mains_df)
+            for appliance_df in appliance_readings:
+                assert appliance_df.index.min() >= timeframe.start and appliance_df.index.max() < timeframe.end
+                assert appliance_df.index.equals(mains_df.index)
+        mains_index = pd.DatetimeIndex(np.concatenate([mains_df.index.values for mains_df, appliance_readings in loaded]))
+        assert mains_index.is_monotonic_increasing and mains_index.is_unique
+
+def test_chart_pyramid():
+    index = pd.date_range('2022-11-08', periods=10000, freq='s')
+    values = np.random.default_rng(0).uniform(0, 3000, len(index))
+    series = pd.Series(values, index=index, name='kettle')
+    pyramid = ChartPyramid(series, factor=4, min_buckets=64)
+
+    # Every bucket of every level keeps the min and max of the raw readings it covers
+    for level, (times, mins, maxs, firsts, lasts) in enumerate(pyramid.levels):
+        width = 4 ** level
+        starts = np.arange(0, len(values), width)
+        assert times.equals(index[starts])
+        assert np.array_equal(mins, np.minimum.reduceat(values, starts)) and np.array_equal(maxs, np.maximum.reduceat(values, starts))
+        assert np.array_equal(firsts, values[starts]) and np.array_equal(lasts, values[np.r_[starts[1:], len(values)] - 1])
+    assert len(pyramid.levels[-1][0]) <= 64
+
+    for start, end in [(None, None), (index[1000], index[1999]), (index[5000], None)]:
+        window = series[start:end]
+        for max_points in [10, 100, 1000, 20000]:
+            chart = pyramid.get(start, end, max_points)
+            assert len(chart) <= max_points and chart.name == 'kettle' and chart.index.is_monotonic_increasing
+            if len(window) <= max_points:
+                pd.testing.assert_series_equal(chart, window)
+    # Budgets too small for the coarsest level merge its buckets further, still keeping the extremes
+    for chart_pyramid, readings in [(pyramid, values), (ChartPyramid(series[:50]), values[:50])]:
+        for max_points in [2, 10, 100]:
+            chart = chart_pyramid.get(max_points=max_points)
+            assert len(chart) <= max_points and chart.min() == readings.min() and chart.max() == readings.max()
+
+    # Buckets draw their min and max in the order of their first and last reading, so rising and falling edges keep their direction
+    ramp = ChartPyramid(pd.Series(np.r_[np.arange(5000.0), np.arange(5000.0)[::-1]], index=index))
+    chart = ramp.get(max_points=100).values
+    assert (np.diff(chart[:len(chart) // 2]) >= 0).all() and (np.diff(chart[len(chart) // 2:]) <= 0).all()
+    assert ramp.get(index[2000], index[2000], 10).tolist() == [2000.0]
+
+def test_merge_sessions():
+    with tempfile.TemporaryDirectory() as folder:
+        def session(file_name, rows, columns='Timestamp,Apparent (VA),Active (W)'):
+            with open(join(folder, file_name), 'w') as f:
+                f.write(columns + '\n' + ''.join(row + '\n' for row in rows))
+            return join(folder, file_name)
+
+        mains_columns = {'Apparent (VA)': 'Apparent (VA)', 'Active (W)': 'Active (W)'}
+        sessions = [
+            ('mains', session('main_1.csv', ['2022-11-08 10:00:00,10,8', '2022-11-08 10:00:01,10,8', '2022-11-08 10:00:04,10,8']), mains_columns),
+            ('mains', session('main_2.csv', ['2022-11-08 10:00:04,5,4', '2022-11-08 10:00:05,5,4']), mains_columns),
+            ('kettle', session('kettle.csv', ['2022-11-08 10:00:01,2000', '2022-11-08 10:00:02,2000'], 'Timestamp,Active (W)'), {'Active (W)': 'kettle'}),
+        ]
+        # Small chunks, so the merge has to carry readings over chunk boundaries
+        blocks = list(merge_sessions(sessions, chunksize=1))
+
+    merged = pd.concat([block for block, _ in blocks])
+    assert list(merged.index) == list(pd.date_range('2022-11-08 10:00:00', periods=6, freq='s'))
+    # Missing seconds are filled with 0 and the overlapping mains reading is summed
+    assert list(merged['Active (W)']) == [8, 8, 0, 0, 12, 4]
+    assert list(merged['kettle']) == [0, 2000, 2000, 0, 0, 0]
+    assert sum(duplicates for _, duplicates in blocks) == 1
+
+def test_find_regressions():
+    baseline = [
+        {'stage': 'load', 'sample_period': 1, 'sequence_length': 99, 'seconds': 2.0, 'peak_rss_mb': 500},
+        {'stage': 'predict', 'sample_period': 1, 'sequence_length': 99, 'seconds': 0.01, 'peak_rss_mb': 500},
+    ]
+    results = [
+        {'stage': 'load', 'sample_period': 1, 'sequence_length': 99, 'seconds': 3.0, 'peak_rss_mb': 510},
+        # Large relative but tiny absolute slowdowns are noise
+        {'stage': 'predict', 'sample_period': 1, 'sequence_length': 99, 'seconds': 0.03, 'peak_rss_mb': 800},
+        # Nothing to compare against
+        {'stage': 'score', 'sample_period': 1, 'sequence_length': 99, 'seconds': 9.0, 'peak_rss_mb': 900},
+    ]
+    regressions = find_regressions(results, baseline, tolerance=0.25)
+    assert [(record['stage'], measure) for record, measure, before, after in regressions] == [('load', 'seconds'), ('predict', 'peak_rss_mb')]
+
+def test_generate_building():
+    signature = {'on_durations': np.array([60, 120]), 'off_durations': np.array([600]), 'levels': np.array([100.0, 2000.0]), 'noise': np.array([1.0, 5.0]), 'duty_cycle': 0.1}
+    signatures = {appliance: signature for appliance in APPLIANCES}
+    signatures['mains'] = {'base_load': 20.0, 'base_load_std': 4.0, 'power_factor': 1.02}
+    chunks = list(generate_building(signatures, '2023-01-01', 2 * 86400, seed=1, chunk_seconds=86400))
+    df = pd.concat(chunks)
+    assert len(chunks) == 2 and len(df) == 2 * 86400
+    assert df.index.is_monotonic_increasing and (df.index.to_series().diff().dropna() == pd.Timedelta(seconds=1)).all()
+    # The mains explain every appliance, plus a base load
+    assert (df['Active (W)'] >= df[APPLIANCES].sum(axis=1) - 0.01).all()
+    # Close to the duty cycle, and every activation is at one of the observed levels
+    assert 0.05 < (df['fridge'] > 0).mean() < 0.15
+    assert df['fridge'][df['fridge'] > 0].between(50, 2100).all()
+
+def test_timings():
+    timings = Timings()
+    with timings.span('train', classifier='Seq2Point'):
+        for building in [1, 2]:
+            with timings.span('partial_fit', dataset='MIMOS', building=building) as span:
+                span.add(rows=100 * building, bytes=400 * building)
+    df = timings.to_frame()
+    # Nested spans inherit the attributes of their parent
+    assert list(df['name']) == ['train', 'partial_fit', 'partial_fit']
+    assert list(df['depth']) == [0, 1, 1] and (df['classifier'] == 'Seq2Point').all()
+    summary = timings.summary()
+    assert summary.loc['partial_fit', 'count'] == 2 and summary.loc['partial_fit', 'rows'] == 300
+    assert summary.loc['train', 'seconds'] >= summary.loc['partial_fit', 'seconds']
+
+class WindowMean():
+
+    """
+    Stands in for a trained Seq2Point network: the mean of every normalised window
+    """
+
+    def predict_on_batch(self, windows):
+        return windows.mean(axis=1)
+
+
+def test_streaming_disaggregator():
+    clf = type('Classifier', (), {'sequence_length': 9, 'mains_mean': 100.0, 'mains_std': 50.0,
+                                  'models': {'kettle': WindowMean()}, 'appliance_params': {'kettle': {'mean': 20.0, 'std': 50.0}}})()
+    mains = np.r_[np.zeros(20), np.full(20, 2000.0), np.zeros(20)]
+    disaggregator = StreamingDisaggregator(clf, max_batch=4, max_delay=60)
+    estimates = []
+    for second, value in enumerate(mains):
+        estimates += disaggregator.push('meter', second, value)
+    estimates += disaggregator.flush('meter')
+
+    # Same result as disaggregate_chunk: a zero padded window centred on every reading
+    padded = np.pad(mains, 4)
+    expected = 20 + np.array([padded[i:i + 9].mean() - 100 for i in range(len(mains))])
+    assert list(np.concatenate([estimate.timestamps for estimate in estimates])) == list(range(len(mains)))
+    assert np.allclose(np.concatenate([estimate.power[:, 0] for estimate in estimates]), np.maximum(expected, 0), atol=0.01)
+    on = np.concatenate([estimate.on[:, 0] for estimate in estimates])
+    assert on[20:40].all() and not on[:10].any()
+
+def test_inference_server():
+    clf = type('Classifier', (), {'sequence_length': 5, 'mains_mean': 0.0, 'mains_std': 1.0,
+                                  'models': {'kettle': WindowMean()}, 'appliance_params': {'kettle': {'mean': 0.0, 'std': 1.0}}})()
+    server = InferenceServer(clf, max_batch=16, max_wait=0.01, max_queue=12)
+
+    async def requests():
+        server.wakeup = asyncio.Event()
+        batcher = asyncio.ensure_future(server.batcher())
+        try:
+            bodies = [json.dumps({'meter': meter, 'mains': [meter * 100.0] * 6}).encode() for meter in range(2)]
+            responses = await asyncio.gather(*[server.route('POST', '/disaggregate', body) for body in bodies])
+            with pytest.raises(HTTPError) as error:
+                await server.route('POST', '/disaggregate', json.dumps({'mains': [0.0] * 13}).encode())
+            return responses, error.value.status
+        finally:
+            batcher.cancel()
+
+    responses, status = asyncio.run(requests())
+    # Both meters share one forward pass, every reading gets the mean of its zero padded window, and a request with more
+    # readings than the queue allows is refused
+    assert [response['power'] for response in responses] == [[[0.0]] * 6, [[60.0], [80.0], [100.0], [100.0], [80.0], [60.0]]]
+    assert [response['on'] for response in responses] == [[[0]] * 6, [[1]] * 6]
+    assert server.counts['batches'] == 1 and status == 413
+
+class LinearSeq2Seq():
+
+    """
+    The steps of nilmtk_contrib's Seq2Seq.disaggregate_chunk, with a linear network
+    """
+
+    sequence_length = 9
+
+    def disaggregate_chunk(self, mains_list):
+        length = self.sequence_length
+        pred_list = []
+        for mains in mains_list:
+            padded = np.pad(mains.values.ravel(), length // 2)
+            windows = np.array([padded[i:i + length] for i in range(len(padded) - length + 1)])
+            outputs = windows * np.linspace(-1, 1, length)
+            sums, counts = np.zeros(len(outputs) + length - 1), np.zeros(len(outputs) + length - 1)
+            for i, output in enumerate(outputs):
+                sums[i:i + length] += output
+                counts[i:i + length] += 1
+            pred_list.append(pd.DataFrame({'kettle': np.maximum(sums / counts, 0)}, dtype='float32'))
+        return pred_list
+
+
+def test_online_alignment():
+    # The server and the streaming disaggregator give every reading the Seq2Seq estimate disaggregate_chunk gives it
+    length = LinearSeq2Seq.sequence_length
+    network = type('Network', (), {'predict_on_batch': lambda self, batch: batch[..., 0] * np.linspace(-1, 1, length)})()
+    clf = type('Classifier', (), {'sequence_length': length, 'mains_mean': 0.0, 'mains_std': 1.0,
+                                  'models': {'kettle': network}, 'appliance_params': {'kettle': {'mean': 0.0, 'std': 1.0}}})()
+    mains = np.random.default_rng(0).uniform(0, 3000, 40)
+    expected = LinearSeq2Seq().disaggregate_chunk([pd.DataFrame({'power': mains})])[0]['kettle'].values[:len(mains)]
+
+    server = InferenceServer(clf, max_batch=64, max_wait=0.01, max_queue=64)
+
+    async def request():
+        server.wakeup = asyncio.Event()
+        batcher = asyncio.ensure_future(server.batcher())
+        try:
+            return await server.route('POST', '/disaggregate', json.dumps({'mains': list(mains)}).encode())
+        finally:
+            batcher.cancel()
+
+    assert np.allclose(np.array(asyncio.run(request())['power'])[:, 0], expected, atol=0.01)
+
+    disaggregator = StreamingDisaggregator(clf, max_batch=7, max_delay=60)
+    estimates = []
+    for second, value in enumerate(mains):
+        estimates += disaggregator.push('meter', second, value)
+    estimates += disaggregator.flush('meter')
+    assert list(np.concatenate([estimate.timestamps for estimate in estimates])) == list(range(len(mains)))
+    assert np.allclose(np.concatenate([estimate.power[:, 0] for estimate in estimates]), expected, atol=0.01)
+
+def test_disaggregate_in_blocks():
+    mains = pd.DataFrame({'power': np.random.default_rng(0).uniform(0, 3000, 100)})
+    joint = LinearSeq2Seq().disaggregate_chunk([mains])[0]['kettle'].values[:100]
+    for block_size in [7, 10, 64]:
+        blocks = disaggregate_in_blocks(LinearSeq2Seq(), [mains], block_size)[0]['kettle'].values
+        assert np.allclose(blocks, joint, atol=1e-3)
+
+def inference_api(**attrs):
+    # An API with only the attributes inference uses, without running an experiment
+    api = API.__new__(API)
+    api.__dict__.update({'inference_workers': None, 'inference_memory_mb': None, 'prediction_block_size': None}, **attrs)
+    return api
+
+def test_concurrent_inference():
+    mains = [pd.DataFrame({'power': np.random.default_rng(seed).uniform(0, 3000, 200)}) for seed in range(2)]
+    classifiers = []
+    for sequence_length in [5, 9, 15]:
+        clf = LinearSeq2Seq()
+        clf.sequence_length = sequence_length
+        classifiers.append(('Seq2Seq' + str(sequence_length), clf))
+
+    for block_size in [None, 64]:
+        sequential = inference_api(prediction_block_size=block_size)
+        concurrent = inference_api(inference_workers=3, prediction_block_size=block_size)
+        assert sequential.run_concurrent_inference(classifiers, mains) == {}
+        pred_lists = concurrent.run_concurrent_inference(classifiers, mains)
+        assert list(pred_lists) == [name for name, clf in classifiers]
+        for name, clf in classifiers:
+            for pred, expected in zip(pred_lists[name], sequential.disaggregate(clf, mains)):
+                pd.testing.assert_frame_equal(pred, expected)
+
+def test_inference_worker_count():
+    classifiers = [('Seq2Seq', LinearSeq2Seq())] * 3
+    mains = [pd.DataFrame({'power': np.zeros(2**18)})]
+    assert inference_api().inference_worker_count(classifiers, mains) == 1
+    assert inference_api(inference_workers=8).inference_worker_count(classifiers, mains) == 3
+    # The windows of 2**18 readings take 9 MB per classifier
+    assert inference_api(inference_workers=3, inference_memory_mb=20).inference_worker_count(classifiers, mains) == 2
+    assert inference_api(inference_workers=3, inference_memory_mb=5).inference_worker_count(classifiers, mains) == 1
+    # Block prediction only holds the windows of one block at a time
+    assert inference_api(inference_workers=3, inference_memory_mb=5, prediction_block_size=2**10).inference_worker_count(classifiers, mains) == 3
+
+class StubNetwork():
+
+    """
+    Stands in for a trained Keras network, saving its weights as JSON
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.weights, f)
+
+class StubClassifier():
+
+    MODEL_NAME = 'Stub'
+
+    def __init__(self, params):
+        self.sequence_length = params.get('sequence_length', 99)
+        self.n_epochs = params.get('n_epochs', 10)
+        self.models = {}
+
+def test_model_bundle():
+    clf = StubClassifier({'sequence_length': 9, 'n_epochs': 3})
+    clf.mains_mean, clf.mains_std = np.float32(500.0), np.float32(250.0)
+    clf.appliance_params = {'kettle': {'mean': 20.0, 'std': 300.0}, 'air conditioner': {'mean': 400.0, 'std': 800.0}}
+    clf.models = {'kettle': StubNetwork([1, 2]), 'air conditioner': StubNetwork([3])}
+    model = type('API', (), {'sample_period': 6, 'appliances': ['kettle', 'air conditioner'], 'power': POWER, 'metrics': ['mae'],
+                             'DROP_ALL_NANS': True, 'classifiers': [('Stub model', clf)]})()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        export_bundle(model, join(tmpdir, 'bundle'))
+        loaded = import_model(join(tmpdir, 'bundle'))
+        assert isinstance(loaded, API) and loaded.appliances == model.appliances and loaded.sample_period == 6
+        assert loaded.power == POWER and loaded.metrics == ['mae'] and loaded.DROP_ALL_NANS
+
+        (name, loaded_clf), = loaded.classifiers
+        assert name == 'Stub model' and type(loaded_clf) is StubClassifier
+        assert (loaded_clf.sequence_length, loaded_clf.n_epochs) == (9, 3)
+        assert (loaded_clf.mains_mean, loaded_clf.mains_std) == (500.0, 250.0) and loaded_clf.appliance_params == clf.appliance_params
+
+        # The networks are only read when they are first used, and exported models do not keep them in memory
+        assert isinstance(loaded_clf.models, LazyNetworks) and list(loaded_clf.models) == ['kettle', 'air conditioner']
+        assert loaded_clf.models.loaded == {}
+        for appliance, network in clf.models.items():
+            with open(loaded_clf.models.files[appliance]) as f:
+                assert json.load(f) == network.weights
+        loaded_clf.models.loaded['kettle'] = clf.models['kettle']
+        assert pickle.loads(pickle.dumps(loaded_clf.models)).loaded == {}
+
+        with pytest.raises(RuntimeError):
+            load_bundle(tmpdir)
+
+def test_results_store():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = ResultsStore(join(tmpdir, 'results.h5'))
+        for sample_period in [1, 6]:
+            results = pd.DataFrame({'metric': ['mae', 'mae', 'f1score'], 'classifier': ['Seq2Point', 'Seq2Seq', 'Seq2Point'],
+                                    'appliance': ['kettle'] * 3, 'value': [10.0 * sample_period, 20.0, 0.5]})
+            store.append_results(results, 'run' + str(sample_period), sample_period, {'Seq2Point': 99, 'Seq2Seq': 99}, dataset='MIMOS', building=1)
+        assert len(store.query(metric='mae', sample_period=[1, 6])) == 4
+        assert store.query(classifier='Seq2Seq', sample_period=6)['value'].tolist() == [20.0]
+        table = store.pivot(metric='mae')
+        assert table.loc[(6, 99, 'mae', 'kettle'), 'Seq2Point'] == 60.0
+
+        # The metadata of many runs with realistic parameters, which do not fit in the attributes of one node
+        params = {'appliances': ['fridge'] * 100, 'sample_rate': 6}
+        for run in range(60):
+            store.record_run('run' + str(run), 6, ['Seq2Point'], dict(params, run=run))
+        assert len(store.runs()) == 60 and store.run_metadata('run59')['run'] == 59
+        store.remove_run('run59')
+        assert len(store.runs()) == 59
+        with pytest.raises(KeyError):
+            store.run_metadata('run59')
+
+def test_sweep_cache():
+    assert [cell_name(cell) for cell in grid_cells({'sample_rate': [1, 6], 'sequence_length': [99]})] == ['1sec_99SL', '6sec_99SL']
+    index = pd.date_range('2022-09-27', periods=5, freq='6s', tz='Asia/Kuala_Lumpur')
+    df = pd.DataFrame(np.arange(5, dtype='float32'), index=index, columns=pd.MultiIndex.from_tuples([('power', 'active')]))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cached = load_frame(join(tmpdir, 'mains'), save_frame(df, join(tmpdir, 'mains')))
+        assert cached.index.equals(df.index) and cached.columns.equals(df.columns)
+        assert np.array_equal(cached.values, df.values) and not cached.values.flags.writeable
+        del cached
+
+def test_worker_environment():
+    environment = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES + ('CUDA_VISIBLE_DEVICES',)}
+    affinity = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None
+    with _worker_environment(sorted(affinity or [0])[:1], 2, True):
+        assert all(os.environ[variable] == '2' for variable in THREAD_VARIABLES) and os.environ['CUDA_VISIBLE_DEVICES'] == '-1'
+        if affinity is not None:
+            assert len(os.sched_getaffinity(0)) == 1
+    # The process running the sweep gets its own settings back
+    assert {variable: os.environ.get(variable) for variable in environment} == environment
+    if affinity is not None:
+        assert os.sched_getaffinity(0) == affinity
+
 # Integration test for the Streamlit app
 class StreamlitAppTests(BaseCase):
 
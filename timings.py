@@ -0,0 +1,177 @@
+"""
+Stage timings of an API experiment.
+
+Every stage (loading, dropna, partial_fit, disaggregate_chunk, metrics ...) runs inside a nestable span that records its
+duration, the rows and bytes it processed and the dataset, building, chunk and classifier it ran for. Any stage can also
+be profiled with cProfile or tracemalloc. The spans are kept as plain dicts, so they can be exported as JSON or as a
+Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+"""
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+import pandas as pd
+from contextlib import contextmanager
+
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+# Lines of the cProfile statistics and allocation sites of tracemalloc kept per profiled span
+PROFILE_LINES = 25
+
+
+def frame_bytes(frames):
+    """
+    Bytes held by the values of one or more dataframes
+    """
+    if isinstance(frames, (pd.DataFrame, pd.Series)):
+        frames = [frames]
+    return int(sum(frame.memory_usage(index=True, deep=False).sum() for frame in frames))
+
+
+class Span():
+
+    """
+    A running stage. Rows and bytes can be added while it runs.
+    """
+
+    def __init__(self, record):
+        self.record = record
+
+    def add(self, rows=0, bytes=0):
+        self.record['rows'] += int(rows)
+        self.record['bytes'] += int(bytes)
+
+    def set(self, **attrs):
+        self.record.update(attrs)
+
+
+class Timings():
+
+    """
+    Nestable timing spans of the stages of an experiment.
+
+    Parameters
+    ----------
+    profile : str, optional
+        'cprofile' or 'tracemalloc' to profile the stages in profile_stages.
+    profile_stages : list of str, optional
+        Names of the profiled stages. Every stage is profiled if not given.
+    """
+
+    def __init__(self, profile=None, profile_stages=None):
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError('profile must be one of ' + ', '.join(PROFILERS))
+        self.profile = profile
+        self.profile_stages = None if profile_stages is None else set(profile_stages)
+        self.records = []
+        self.origin = time.perf_counter()
+        self._stack = []
+        self._profiling = False
+
+    def __getstate__(self):
+        # Open spans only make sense in the running process
+        state = self.__dict__.copy()
+        state['_stack'] = []
+        state['_profiling'] = False
+        return state
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Times the block as the stage name. Nested spans inherit the attributes (dataset, building ...) of their parent.
+
+        with timings.span('load', dataset='MIMOS', building=1) as span:
+            ...
+            span.add(rows=len(df), bytes=frame_bytes(df))
+        """
+        parent = self._stack[-1] if self._stack else None
+        record = dict(parent['attrs']) if parent else {}
+        record = {'name': name, 'attrs': dict(record, **attrs), 'depth': len(self._stack),
+                  'parent': parent['id'] if parent else None, 'id': len(self.records),
+                  'thread': threading.get_ident(), 'rows': 0, 'bytes': 0}
+        self.records.append(record)
+        self._stack.append(record)
+
+        profiler = self._start_profiler(name)
+        start = time.perf_counter()
+        try:
+            yield Span(record)
+        finally:
+            end = time.perf_counter()
+            self._stop_profiler(profiler, record)
+            record['start'] = start - self.origin
+            record['seconds'] = end - start
+            self._stack.pop()
+
+    def _start_profiler(self, name):
+        # Profilers cannot be nested, the outermost profiled stage gets the profile
+        if self.profile is None or self._profiling or (self.profile_stages is not None and name not in self.profile_stages):
+            return None
+        self._profiling = True
+        if self.profile == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        return (started, tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[0])
+
+    def _stop_profiler(self, profiler, record):
+        if profiler is None:
+            return
+        self._profiling = False
+        if self.profile == 'cprofile':
+            profiler.disable()
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            record['profile'] = output.getvalue()
+            return
+
+        started, before, traced_before = profiler
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+        record['memory_allocated_bytes'] = current - traced_before
+        # The peak only covers this span if tracing started with it
+        if started:
+            record['memory_peak_bytes'] = peak - traced_before
+            tracemalloc.stop()
+        record['profile'] = '\n'.join(str(statistic) for statistic in statistics[:PROFILE_LINES])
+
+    def to_frame(self):
+        """
+        One row per span, with its attributes as columns
+        """
+        rows = [dict({key: value for key, value in record.items() if key not in ('attrs', 'profile')}, **record['attrs']) for record in self.records]
+        return pd.DataFrame(rows)
+
+    def summary(self, by=('name',)):
+        """
+        Number of spans and total seconds, rows and bytes per stage (or any other attributes)
+        """
+        df = self.to_frame()
+        if df.empty:
+            return df
+        return df.groupby(list(by)).agg(count=('seconds', 'size'), seconds=('seconds', 'sum'), rows=('rows', 'sum'), bytes=('bytes', 'sum'))
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.records, f, indent=2, default=str)
+
+    def to_chrome_trace(self, path):
+        """
+        Writes the spans in the Chrome trace event format
+        """
+        events = []
+        for record in self.records:
+            if 'seconds' not in record:
+                continue
+            args = dict(record['attrs'], rows=record['rows'], bytes=record['bytes'])
+            events.append({'name': record['name'], 'ph': 'X', 'pid': 1, 'tid': record['thread'],
+                           'ts': record['start'] * 1e6, 'dur': record['seconds'] * 1e6, 'args': args})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)